@@ -8,25 +8,51 @@ from flask_cors import CORS
 from werkzeug.utils import secure_filename
 import uuid # For generating unique filenames
 from dotenv import load_dotenv
-from google.generativeai import GenerativeModel, configure as configure_gemini # Renamed configure
+import threading
 import traceback
 
 # Import your ML logic modules
 from ml_logic import id_card_processor
 from ml_logic import face_verifier
 from ml_logic import db_storer
+from ml_logic import pipeline
+from ml_logic import job_queue
+from ml_logic import admission
+from ml_logic import event_stream
+from ml_logic import batch_verifier
+from ml_logic import storage_queue
+from ml_logic import sessions
+from ml_logic import upload_stream
+from ml_logic import idempotency
+from ml_logic import deadline
 
 # --- Configuration ---
 load_dotenv() # Load .env file for local development
 
 # Gemini Configuration
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-if GEMINI_API_KEY:
-    configure_gemini(api_key=GEMINI_API_KEY)
-    gemini_model_instance = GenerativeModel("gemini-2.5-flash") # Or your preferred model
-else:
+GEMINI_MODEL_NAME = "gemini-2.5-flash" # Or your preferred model
+if not GEMINI_API_KEY:
     print("CRITICAL: GEMINI_API_KEY not found. OCR functionality will fail.")
-    gemini_model_instance = None # Handle this appropriately
+
+_gemini_model_instance = None
+_gemini_lock = threading.Lock()
+
+
+def get_gemini_model():
+    """
+    Configures the Gemini client on first use so importing app.py stays cheap.
+    Returns None when no API key is configured.
+    """
+    global _gemini_model_instance
+    if not GEMINI_API_KEY:
+        return None
+    with _gemini_lock:
+        if _gemini_model_instance is None:
+            from google.generativeai import GenerativeModel, configure as configure_gemini
+            configure_gemini(api_key=GEMINI_API_KEY)
+            _gemini_model_instance = GenerativeModel(GEMINI_MODEL_NAME)
+    return _gemini_model_instance
 
 # File Upload Configuration
 UPLOAD_FOLDER = 'uploads' # Make sure this folder exists
@@ -46,27 +72,167 @@ app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16 MB upload limit
 CORS(app) # Enable CORS for all routes, good for development
 
+# File fields of the two-image verification form
+UPLOAD_FILE_FIELDS = ('id_card_image', 'live_face_image')
+
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-# <<< Initialize Database Table on App Start >>>
-with app.app_context(): # Ensures this runs within Flask's application context
-    db_storer.create_user_table_if_not_exists()
-    
-    
-    
+def save_upload(file_storage):
+    """Saves an uploaded file under UPLOAD_FOLDER with a unique secure name and returns the path."""
+    filename = secure_filename(f"{uuid.uuid4()}_{file_storage.filename}")
+    path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    file_storage.save(path)
+    return path
+
+# Schema changes are applied by `python -m ml_logic.migrations` at deploy time;
+# db_storer only checks the schema version on its first call, so importing the
+# app (and answering /healthz) never waits on Postgres.
+
+# Endpoints without the REQUEST_DEADLINE_SECONDS budget (0 = no deadline): a
+# batch has its own, and job / session-document work outlives the request
+# that queued or started it.
+DEADLINE_OVERRIDES = {
+    'batch_verify':      deadline.BATCH_DEADLINE_SECONDS,
+    'submit_job':        0,
+    'get_job':           0,
+    'stream_job_events': 0,
+    'create_session':    0,
+    'get_session':       0,
+}
+
+
+@app.before_request
+def _start_request_deadline():
+    # Every stage checks this budget (see ml_logic/deadline.py); background
+    # threads started for the request carry it along.
+    deadline.start(DEADLINE_OVERRIDES.get(request.endpoint, deadline.REQUEST_DEADLINE_SECONDS))
+
+
+@app.teardown_request
+def _clear_request_deadline(exc):
+    deadline.clear()
+
 
 @app.route('/healthz', methods=['GET'])
 def health_check():
     return jsonify({"status": "healthy"}), 200
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Admission-control gauges and counters in Prometheus text format (per worker
+    process), the /reverify embedding cache, the live-image replay index, plus the write-behind queue backlog
+    (per host) when enabled.
+    """
+    from flask import Response
+    text = admission.controller.prometheus_text()
+    cache = db_storer.embedding_cache_stats()
+    text += (
+        "# TYPE votechain_embedding_cache_entries gauge\n"
+        f"votechain_embedding_cache_entries {cache['entries']}\n"
+        "# TYPE votechain_embedding_cache_lookups_total counter\n"
+        f'votechain_embedding_cache_lookups_total{{result="hit"}} {cache["hits"]}\n'
+        f'votechain_embedding_cache_lookups_total{{result="miss"}} {cache["misses"]}\n'
+    )
+    replay = face_verifier.replay_index_stats()
+    text += (
+        "# TYPE votechain_replay_index_entries gauge\n"
+        f"votechain_replay_index_entries {replay['entries']}\n"
+        "# TYPE votechain_replay_index_hits_total counter\n"
+        f"votechain_replay_index_hits_total {replay['hits']}\n"
+        "# TYPE votechain_replay_suspicious_total counter\n"
+        f"votechain_replay_suspicious_total {replay['suspicious']}\n"
+    )
+    if storage_queue.write_behind_enabled():
+        text += "# TYPE votechain_storage_queue_records gauge\n" + "".join(
+            f'votechain_storage_queue_records{{status="{status}"}} {count}\n'
+            for status, count in storage_queue.backlog().items()
+        )
+    return Response(text, mimetype='text/plain; version=0.0.4')
+
+
+def shed_response(rejected):
+    """Fast 503 for a request the admission controller refused."""
+    response = jsonify({
+        "error": "Server is at capacity, please retry shortly.",
+        "overall_status": "Failed: Server Busy",
+        "reason": rejected.reason,
+        "retry_after": rejected.retry_after,
+    })
+    response.headers['Retry-After'] = str(rejected.retry_after)
+    return response, 503
+
+
+
+def request_payload_hash():
+    """SHA-256 over the form fields and uploaded file contents (not their client-side names)."""
+    import hashlib
+    digest = hashlib.sha256()
+    for name, value in sorted(request.form.items(multi=True)):
+        digest.update(f"field:{name}={value}\n".encode())
+    for name, file_storage in sorted(request.files.items(multi=True), key=lambda item: item[0]):
+        file_hash = hashlib.sha256()
+        for chunk in iter(lambda: file_storage.stream.read(64 * 1024), b""):
+            file_hash.update(chunk)
+        file_storage.stream.seek(0)
+        digest.update(f"file:{name}={file_hash.hexdigest()}\n".encode())
+    return digest.hexdigest()
+
+
+def replay_response(status_code, body):
+    from flask import Response
+    return Response(body, status=status_code, mimetype='application/json',
+                    headers={'Idempotent-Replayed': 'true'})
+
 
 @app.route('/process_and_verify', methods=['POST'])
 def process_and_verify_endpoint():
+    """
+    Synchronous verification. With an Idempotency-Key header, retries of the
+    same request get the original response (see ml_logic/idempotency.py).
+    """
+    idem_key = request.headers.get('Idempotency-Key')
+    if idem_key is not None:
+        if not idempotency.valid_key(idem_key):
+            return jsonify({"error": "Invalid Idempotency-Key header.",
+                            "overall_status": "Failed: Invalid Idempotency-Key"}), 400
+        try:
+            stored = idempotency.begin(request.path, idem_key, request_payload_hash())
+        except idempotency.KeyMismatch as e:
+            return jsonify({"error": str(e), "overall_status": "Failed: Idempotency-Key reused"}), 422
+        except TimeoutError as e:
+            response = jsonify({"error": str(e), "overall_status": "Failed: Request In Progress"})
+            response.headers['Retry-After'] = '5'
+            return response, 409
+        if stored is not None:
+            return replay_response(*stored)
+
+    try:
+        admitted_at = admission.controller.acquire()
+    except admission.Rejected as rejected:
+        if idem_key is not None:
+            idempotency.abandon(request.path, idem_key)
+        return shed_response(rejected)
+    try:
+        response = app.make_response(_process_and_verify())
+    except Exception:
+        if idem_key is not None:
+            idempotency.abandon(request.path, idem_key)
+        raise
+    finally:
+        admission.controller.release(admitted_at)
+    if idem_key is not None:
+        idempotency.complete(request.path, idem_key, response.status_code, response.get_data(as_text=True))
+    return response
+
+
+def _process_and_verify():
     print("id_card_image:", request.files.get('id_card_image'))
     print("live_face_image:", request.files.get('live_face_image'))
+    gemini_model_instance = get_gemini_model()
     if gemini_model_instance is None:
         return jsonify({"error": "OCR service not available due to missing API key.", 
                         "overall_status": "Failed: OCR Service Unavailable"}), 503
@@ -117,8 +283,10 @@ def process_and_verify_endpoint():
 
         # --- STAGE 1: Process ID Card ---
         print("\n>>> Processing ID Card...")
+        # ID crop (and its strong-model embedding, once computed) for escalation and storage
+        id_strong = {"face": None, "embedding": None}
         extracted_details, id_embedding = id_card_processor.extract_text_and_face_from_id(
-            id_card_path, gemini_model_instance
+            id_card_path, gemini_model_instance, face_out=id_strong
         )
         response_data["text_details"] = extracted_details
         if "error" in extracted_details or "id_processing_error" in extracted_details:
@@ -152,7 +320,7 @@ def process_and_verify_endpoint():
         # --- STAGE 3: Face Verification ---
         print("\n>>> Performing Face Verification...")
         verification_passed, verification_details_dict = face_verifier.verify_faces(
-            live_face_path, id_embedding
+            live_face_path, id_embedding, id_strong=id_strong
         )
         response_data["face_verification"] = verification_details_dict
         response_data["face_verification"]["status"] = verification_details_dict.get("message", "Status Unknown")
@@ -166,8 +334,13 @@ def process_and_verify_endpoint():
         # If all checks above passed, proceed to DB
         print("\n>>> Storing verified user details in database...")
         try:
+            # Same as the pipeline's storage stage: the strong embedding is optional work.
+            if deadline.allows_optional():
+                strong_embedding = face_verifier.ensure_strong_embedding(id_strong)
+            else:
+                strong_embedding = id_strong["embedding"]
             db_success, db_message = db_storer.store_verified_user_details(
-                extracted_details, id_embedding # Make sure extracted_details doesn't contain sensitive error messages you don't want to store
+                extracted_details, id_embedding, strong_embedding # Make sure extracted_details doesn't contain sensitive error messages you don't want to store
             )
             response_data["database_storage"]["stored"] = db_success
             response_data["database_storage"]["message"] = db_message
@@ -193,7 +366,8 @@ def process_and_verify_endpoint():
     except Exception as e:
         print(f"Unhandled error in /process_and_verify: {e}")
         traceback.print_exc()
-        response_data["overall_status"] = f"Server Error: {str(e)}"
+        timed_out = isinstance(e, deadline.DeadlineExceeded)
+        response_data["overall_status"] = "Failed: Request deadline exceeded." if timed_out else f"Server Error: {str(e)}"
         response_data["error"] = str(e) # Add general error message
         if 'message' not in response_data["database_storage"] or response_data["database_storage"]["message"] == "Not Attempted":
             response_data["database_storage"]["message"] = "Database operation likely not reached due to earlier error."
@@ -204,9 +378,25 @@ def process_and_verify_endpoint():
         if live_face_path and os.path.exists(live_face_path):
             try: os.remove(live_face_path)
             except Exception as e_clean: print(f"Error cleaning live face file on exception: {e_clean}")
-        return jsonify(response_data), 500
+        return jsonify(response_data), 503 if timed_out else 500
     
 
+STREAM_HEADERS = {
+    'Cache-Control':     'no-cache',
+    'X-Accel-Buffering': 'no',
+}
+
+
+def stream_response(stream, after_seq=0):
+    """SSE response that replays `stream` from after_seq and follows it until the pipeline is done."""
+    from flask import Response, stream_with_context
+    return Response(
+        stream_with_context(event_stream.iter_sse(stream, after_seq)),
+        mimetype='text/event-stream',
+        headers={**STREAM_HEADERS, 'X-Stream-Id': stream.stream_id},
+    )
+
+
 @app.route('/process_and_verify_stream', methods=['POST'])
 def process_and_verify_stream():
     """
@@ -229,256 +419,557 @@ def process_and_verify_stream():
         { "stage": "done", "status": "passed"|"failed",
           "overall": "success"|"failed",
           "data": { ...full BackendResponse... } }
+
+    The pipeline runs in a background thread and every event carries
+    `id: <stream_id>:<seq>`. A request with a Last-Event-ID header for a
+    stream that is still buffered is attached to it (missed events replayed
+    first) instead of starting a second run; see also
+    GET /process_and_verify_stream/<stream_id>.
+
+    The multipart body is not buffered by Flask: parts are hashed, size- and
+    magic-byte-checked as they arrive, and OCR on the ID card starts while
+    the selfie is still uploading. Send id_card_image first to benefit.
+
+    live_face_image may be repeated (up to LIVENESS_BURST_MAX_FRAMES) with a
+    burst of camera frames; liveness then scores them in one batch and stops
+    early once enough frames agree.
     """
     import json
     from flask import Response, stream_with_context
+
+    stream_id, last_seq = event_stream.parse_event_id(request.headers.get('Last-Event-ID'))
+    if stream_id:
+        stream = event_stream.registry.get(stream_id)
+        if stream is not None:
+            return stream_response(stream, last_seq)
  
     def abort_stream(detail):
         def _gen():
             yield f"data: {json.dumps({'stage':'done','status':'failed','overall':'failed','detail':detail})}\n\n"
         return Response(stream_with_context(_gen()), mimetype='text/event-stream')
  
+    gemini_model_instance = get_gemini_model()
     if gemini_model_instance is None:
         return abort_stream("OCR service unavailable — missing Gemini API key.")
  
+    try:
+        admitted_at = admission.controller.acquire()
+    except admission.Rejected as rejected:
+        return shed_response(rejected)
+
+    # The body is read part by part (see ml_logic/upload_stream.py): the
+    # document stage starts as soon as the ID card part is complete, while
+    # the selfie is still uploading. Its thread owns and removes the ID card.
+    # The slot is released by whichever finishes last: the document stage or
+    # the request (its selfie pipeline, or the upload error).
+    session = sessions.VerificationSession(uuid.uuid4().hex)
+    uploads = {}
+    live_frames = []    # one live_face_image, or a burst of several
+    slot_holders = [1]
+    slot_lock = threading.Lock()
+
+    def release_slot():
+        with slot_lock:
+            slot_holders[0] -= 1
+            last = slot_holders[0] == 0
+        if last:
+            admission.controller.release(admitted_at)
+
+    def finish_document(id_part):
+        id_part.remove()
+        release_slot()
+    try:
+        for part in upload_stream.iter_upload(request.stream, request.content_type,
+                                              app.config['UPLOAD_FOLDER'], UPLOAD_FILE_FIELDS):
+            if isinstance(part, tuple):
+                continue    # plain form fields are not used here
+            if part.name == 'live_face_image':
+                duplicate = len(live_frames) >= face_verifier.LIVENESS_BURST_MAX_FRAMES
+            else:
+                duplicate = part.name in uploads
+            if duplicate or not allowed_file(part.filename):
+                part.remove()
+                raise upload_stream.UploadError(
+                    f"Too many {part.name} parts." if duplicate
+                    else "Invalid file type. Allowed: png, jpg, jpeg.")
+            if part.name == 'live_face_image':
+                live_frames.append(part)
+            uploads[part.name] = part
+            if part.name == 'id_card_image':
+                with slot_lock:
+                    slot_holders[0] += 1
+                event_stream.run_in_background(
+                    session.document,
+                    admission.controller.track_stages(
+                        sessions.document_events(session, part.path, gemini_model_instance)
+                    ),
+                    on_finish=lambda id_part=part: finish_document(id_part),
+                )
+        if set(uploads) != set(UPLOAD_FILE_FIELDS):
+            raise upload_stream.UploadError("Missing id_card_image or live_face_image.")
+    except upload_stream.UploadError as e:
+        # A document stage already started stops at its next step, removes its
+        # file and gives up the slot with release_slot().
+        session.cancelled.set()
+        release_slot()
+        for frame in live_frames:
+            frame.remove()
+        return abort_stream(str(e))
+
+    def finish():
+        # The slot is held for the pipeline's lifetime, not the connection's:
+        # a dropped client does not stop the run it may reattach to.
+        release_slot()
+        for frame in live_frames:
+            try:
+                frame.remove()
+            except Exception as e_clean:
+                print(f"Cleanup error: {e_clean}")
+
+    stream = event_stream.registry.create()
+    event_stream.run_in_background(
+        stream,
+        session.selfie_events([frame.path for frame in live_frames], DUMMY_LIVENESS_REF_IMAGE,
+                              track=admission.controller.track_stages),
+        on_finish=finish,
+    )
+    return stream_response(stream)
+
+
+@app.route('/process_and_verify_stream/<stream_id>', methods=['GET'])
+def resume_verification_stream(stream_id):
+    """
+    Reattaches to a running (or recently finished) streamed verification.
+    Replays events after Last-Event-ID (or `?after=<seq>`), then follows live.
+    Streams are buffered per worker process for STREAM_TTL_SECONDS after they finish.
+    """
+    stream = event_stream.registry.get(stream_id)
+    if stream is None:
+        return jsonify({"error": "Unknown or expired stream id"}), 404
+    header_stream_id, last_seq = event_stream.parse_event_id(request.headers.get('Last-Event-ID'))
+    if header_stream_id != stream_id:
+        last_seq = request.args.get('after', 0, type=int)
+    return stream_response(stream, last_seq)
+
+
+
+# ════════════════════════════════════════════════════════════════════════════
+# Two-phase sessions — ID card first, selfie later
+# ════════════════════════════════════════════════════════════════════════════
+@app.route('/sessions', methods=['POST'])
+def create_session():
+    """
+    Starts a verification session from the `id_card_image` alone. The document
+    stage (OCR + ID face extraction) begins immediately in the background;
+    returns 202 with the session id. Send the selfie to
+    POST /sessions/<session_id>/selfie on the same worker.
+    """
+    gemini_model_instance = get_gemini_model()
+    if gemini_model_instance is None:
+        return jsonify({"error": "OCR service not available due to missing API key.",
+                        "overall_status": "Failed: OCR Service Unavailable"}), 503
+    id_card_file = request.files.get('id_card_image')
+    if id_card_file is None or id_card_file.filename == '':
+        return jsonify({"error": "Missing id_card_image file",
+                        "overall_status": "Failed: Missing Files"}), 400
+    if not allowed_file(id_card_file.filename):
+        return jsonify({"error": "Invalid file type. Allowed types: png, jpg, jpeg",
+                        "overall_status": "Failed: Invalid file type"}), 400
+
+    try:
+        admitted_at = admission.controller.acquire()
+    except admission.Rejected as rejected:
+        return shed_response(rejected)
+    try:
+        id_card_path = save_upload(id_card_file)
+    except Exception:
+        admission.controller.release(admitted_at)
+        raise
+
+    def finish_document():
+        # The document stage has its own slot; the selfie request takes another.
+        admission.controller.release(admitted_at)
+        if os.path.exists(id_card_path):
+            try:
+                os.remove(id_card_path)
+            except Exception as e_clean:
+                print(f"Cleanup error: {e_clean}")
+
+    session = sessions.registry.create()
+    event_stream.run_in_background(
+        session.document,
+        admission.controller.track_stages(
+            sessions.document_events(session, id_card_path, gemini_model_instance)
+        ),
+        on_finish=finish_document,
+    )
+    return jsonify(session.summary()), 202
+
+
+@app.route('/sessions/<session_id>', methods=['GET'])
+def get_session(session_id):
+    """Document-stage progress of a session (running | passed | failed)."""
+    session = sessions.registry.get(session_id)
+    if session is None:
+        return jsonify({"error": "Unknown or expired session id"}), 404
+    return jsonify(session.summary()), 200
+
+
+@app.route('/sessions/<session_id>/selfie', methods=['POST'])
+def submit_session_selfie(session_id):
+    """
+    Attaches `live_face_image` to a session and streams SSE events as
+    /process_and_verify_stream does: the document events first (replayed, or
+    live if OCR is still running), then liveness, face match and storage.
+    live_face_image may be repeated with a burst of frames, as for
+    /process_and_verify_stream. One selfie per session; a second one gets 409 with the stream id to
+    resume at GET /process_and_verify_stream/<stream_id>.
+    """
+    session = sessions.registry.get(session_id)
+    if session is None:
+        return jsonify({"error": "Unknown or expired session id"}), 404
+    if session.verification_stream_id is not None:
+        return jsonify({"error": "A selfie was already submitted for this session.",
+                        "stream_id": session.verification_stream_id}), 409
+    live_face_files = request.files.getlist('live_face_image')
+    if not live_face_files or any(f.filename == '' for f in live_face_files):
+        return jsonify({"error": "Missing live_face_image file",
+                        "overall_status": "Failed: Missing Files"}), 400
+    if len(live_face_files) > face_verifier.LIVENESS_BURST_MAX_FRAMES:
+        return jsonify({"error": f"At most {face_verifier.LIVENESS_BURST_MAX_FRAMES} live_face_image frames",
+                        "overall_status": "Failed: Too many frames"}), 400
+    if not all(allowed_file(f.filename) for f in live_face_files):
+        return jsonify({"error": "Invalid file type. Allowed types: png, jpg, jpeg",
+                        "overall_status": "Failed: Invalid file type"}), 400
+
+    try:
+        admitted_at = admission.controller.acquire()
+    except admission.Rejected as rejected:
+        return shed_response(rejected)
+    stream = event_stream.registry.create()
+    if not session.attach_selfie(stream.stream_id):
+        admission.controller.release(admitted_at)
+        return jsonify({"error": "A selfie was already submitted for this session.",
+                        "stream_id": session.verification_stream_id}), 409
+    live_face_paths = []
+    try:
+        for live_face_file in live_face_files:
+            live_face_paths.append(save_upload(live_face_file))
+    except Exception:
+        admission.controller.release(admitted_at)
+        for path in live_face_paths:
+            os.remove(path)
+        raise
+
+    def finish():
+        admission.controller.release(admitted_at)
+        for path in live_face_paths:
+            if os.path.exists(path):
+                try:
+                    os.remove(path)
+                except Exception as e_clean:
+                    print(f"Cleanup error: {e_clean}")
+
+    event_stream.run_in_background(
+        stream,
+        session.selfie_events(live_face_paths, DUMMY_LIVENESS_REF_IMAGE,
+                              track=admission.controller.track_stages),
+        on_finish=finish,
+    )
+    return stream_response(stream)
+
+
+# ════════════════════════════════════════════════════════════════════════════
+# Batch verification — kiosk uploads of many (ID card, selfie) pairs
+# ════════════════════════════════════════════════════════════════════════════
+@app.route('/batch/verify', methods=['POST'])
+def batch_verify():
+    """
+    Verifies many pairs in one request (see ml_logic/batch_verifier.py).
+
+    Accepts either an `archive` file (zip/tar with <pair_id>/id_card.* and
+    <pair_id>/live_face.*) or repeated id_card_image / live_face_image fields
+    with optional repeated `pair_id` fields. Streams one JSON result per line
+    (application/x-ndjson) as each chunk finishes, ending with a summary line.
+    """
+    import json
+    import shutil
+    import tempfile
+    from flask import Response, stream_with_context
+
+    request.max_content_length = batch_verifier.BATCH_MAX_UPLOAD_BYTES
+    gemini_model_instance = get_gemini_model()
+    if gemini_model_instance is None:
+        return jsonify({"error": "OCR service not available due to missing API key.",
+                        "overall_status": "Failed: OCR Service Unavailable"}), 503
+
+    batch_dir = tempfile.mkdtemp(prefix="batch_", dir=app.config['UPLOAD_FOLDER'])
+    try:
+        if 'archive' in request.files:
+            archive_path = os.path.join(batch_dir, "archive")
+            request.files['archive'].save(archive_path)
+            pairs, rejected = batch_verifier.unpack_archive(archive_path, batch_dir)
+            os.remove(archive_path)
+        else:
+            id_files   = request.files.getlist('id_card_image')
+            live_files = request.files.getlist('live_face_image')
+            pair_ids   = request.form.getlist('pair_id') or [str(i) for i in range(len(id_files))]
+            if not id_files or len(id_files) != len(live_files) or len(pair_ids) != len(id_files):
+                raise batch_verifier.BatchError(
+                    "Send an archive, or matching numbers of id_card_image, live_face_image (and pair_id) fields.")
+            if len(id_files) > batch_verifier.BATCH_MAX_PAIRS:
+                raise batch_verifier.BatchError(f"Batch has more than {batch_verifier.BATCH_MAX_PAIRS} pairs.")
+            pairs, rejected = [], []
+            for pair_id, id_file, live_file in zip(pair_ids, id_files, live_files):
+                if not (allowed_file(id_file.filename) and allowed_file(live_file.filename)):
+                    rejected.append((pair_id, "Invalid file type. Allowed types: png, jpg, jpeg"))
+                    continue
+                paths = []
+                for file_storage in (id_file, live_file):
+                    path = os.path.join(batch_dir, secure_filename(f"{uuid.uuid4()}_{file_storage.filename}"))
+                    file_storage.save(path)
+                    paths.append(path)
+                pairs.append((pair_id, *paths))
+    except batch_verifier.BatchError as e:
+        shutil.rmtree(batch_dir, ignore_errors=True)
+        return jsonify({"error": str(e)}), 400
+    except Exception:
+        shutil.rmtree(batch_dir, ignore_errors=True)
+        raise
+
+    # The whole batch takes one pipeline slot; its own thread pools bound the work inside it.
+    try:
+        admitted_at = admission.controller.acquire()
+    except admission.Rejected as rejected_req:
+        shutil.rmtree(batch_dir, ignore_errors=True)
+        return shed_response(rejected_req)
+    released = threading.Event()
+
+    def release_slot():
+        if not released.is_set():
+            released.set()
+            admission.controller.release(admitted_at)
+
+    def generate():
+        try:
+            for pair_id, reason in rejected:
+                yield json.dumps(batch_verifier.rejected_result(pair_id, reason)) + "\n"
+            for result in batch_verifier.run_batch(pairs, gemini_model_instance):
+                if "summary" in result:
+                    result["summary"]["rejected"] = len(rejected)
+                yield json.dumps(result, default=str) + "\n"
+        finally:
+            release_slot()
+            shutil.rmtree(batch_dir, ignore_errors=True)
+
+    response = Response(stream_with_context(generate()), mimetype='application/x-ndjson', headers=STREAM_HEADERS)
+    response.call_on_close(release_slot)
+    return response
+
+
+@app.route('/reverify', methods=['POST'])
+def reverify():
+    """
+    Re-authenticates a registered voter from a document number and a live
+    selfie: liveness plus a match against the embedding stored at registration.
+    No ID card, Gemini OCR or ID-card face detection.
+
+    Form fields: doc_type (aadhaar | voter_id | pan | license), doc_number,
+    live_face_image.
+    """
+    doc_type = request.form.get('doc_type', '').strip().lower()
+    doc_number = request.form.get('doc_number', '').strip()
+    live_face_file = request.files.get('live_face_image')
+    doc_types = sorted(code for code, _ in db_storer.DOCUMENT_TYPES.values())
+    if doc_type not in doc_types or not doc_number:
+        return jsonify({"error": f"doc_type (one of {', '.join(doc_types)}) and doc_number are required.",
+                        "overall_status": "Failed: Missing Document"}), 400
+    if live_face_file is None or live_face_file.filename == '':
+        return jsonify({"error": "Missing live_face_image file",
+                        "overall_status": "Failed: Missing Files"}), 400
+    if not allowed_file(live_face_file.filename):
+        return jsonify({"error": "Invalid file type. Allowed types: png, jpg, jpeg",
+                        "overall_status": "Failed: Invalid file type"}), 400
+
+    try:
+        admitted_at = admission.controller.acquire()
+    except admission.Rejected as rejected:
+        return shed_response(rejected)
+
+    response_data = {
+        "user": None,
+        "liveness_check": {"passed": False, "status": "Not Performed"},
+        "face_verification": {"verified": False, "status": "Not Performed"},
+        "overall_status": "Failed",
+    }
+    live_face_path = None
+    try:
+        stored = db_storer.get_stored_embedding(doc_type, doc_number)
+        if stored is None:
+            response_data["overall_status"] = "Failed: Document not registered."
+            return jsonify(response_data), 404
+        response_data["user"] = {"user_id": stored["user_id"], "name": stored["name"]}
+
+        live_face_path = save_upload(live_face_file)
+        liveness_passed, liveness_msg, verified, match_details = face_verifier.reverify_against_embedding(
+            live_face_path, stored["face_embedding"], stored["face_embedding_strong"]
+        )
+        response_data["liveness_check"] = {"passed": liveness_passed, "status": liveness_msg}
+        if not liveness_passed:
+            response_data["overall_status"] = "Failed: Liveness check failed."
+            return jsonify(response_data), 400
+
+        match_details["status"] = match_details.get("message", "Status Unknown")
+        response_data["face_verification"] = match_details
+        if not verified:
+            response_data["overall_status"] = "Failed: Face verification failed."
+            return jsonify(response_data), 400
+        response_data["overall_status"] = "Success: Liveness and Face Verification Passed."
+        return jsonify(response_data), 200
+    except deadline.DeadlineExceeded as e:
+        print(f"/reverify stopped: {e}")
+        response_data["overall_status"] = "Failed: Request deadline exceeded."
+        response_data["error"] = str(e)
+        return jsonify(response_data), 503
+    except Exception as e:
+        print(f"Unhandled error in /reverify: {e}")
+        traceback.print_exc()
+        response_data["overall_status"] = f"Server Error: {str(e)}"
+        response_data["error"] = str(e)
+        return jsonify(response_data), 500
+    finally:
+        admission.controller.release(admitted_at)
+        if live_face_path and os.path.exists(live_face_path):
+            try: os.remove(live_face_path)
+            except Exception as e_clean: print(f"Error cleaning live face file: {e_clean}")
+
+
+# ════════════════════════════════════════════════════════════════════════════
+# Asynchronous jobs — submit now, poll / stream / webhook later
+# ════════════════════════════════════════════════════════════════════════════
+def _run_verification_job(id_card_path, live_face_path):
+    """
+    Job-queue handler: the same stages as /process_and_verify_stream. Jobs run
+    on queue workers, outside any request, so no deadline applies.
+    """
+    gemini_model_instance = get_gemini_model()
+    if gemini_model_instance is None:
+        yield pipeline.evt("done", "failed", overall="failed",
+                           detail="OCR service unavailable — missing Gemini API key.")
+        return
+    # Jobs share the per-process pipeline slots with HTTP requests but never get shed.
+    admitted_at = admission.controller.acquire(shed=False)
+    try:
+        yield from admission.controller.track_stages(pipeline.run_verification_pipeline(
+            id_card_path, live_face_path, gemini_model_instance, DUMMY_LIVENESS_REF_IMAGE
+        ))
+    finally:
+        admission.controller.release(admitted_at)
+
+
+@app.before_request
+def _start_job_workers():
+    # Cheap after the first call; keeps thread start-up out of module import.
+    job_queue.start_workers(_run_verification_job)
+    storage_queue.start_writers()
+
+
+@app.route('/storage/<write_id>', methods=['GET'])
+def get_storage_status(write_id):
+    """Read-your-writes for STORAGE_MODE=write_behind: queued | writing | stored | failed."""
+    write = storage_queue.get_write(write_id)
+    if write is None:
+        return jsonify({"error": "Unknown write id"}), 404
+    return jsonify(write), 200
+
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """
+    Accepts the same multipart fields as /process_and_verify plus an optional
+    `webhook_url`, queues the pipeline and returns 202 with the job id. The
+    webhook (only to JOB_WEBHOOK_ALLOWED_HOSTS) receives {job_id, status};
+    the result itself is read from GET /jobs/<id>.
+    """
     if 'id_card_image' not in request.files or 'live_face_image' not in request.files:
-        return abort_stream("Missing id_card_image or live_face_image.")
- 
+        return jsonify({"error": "Missing id_card_image or live_face_image file"}), 400
     id_card_file   = request.files['id_card_image']
     live_face_file = request.files['live_face_image']
- 
     if not (allowed_file(id_card_file.filename) and allowed_file(live_face_file.filename)):
-        return abort_stream("Invalid file type. Allowed: png, jpg, jpeg.")
- 
-    # Save files before entering the generator (can't read request.files inside it)
-    id_filename   = secure_filename(f"{uuid.uuid4()}_{id_card_file.filename}")
-    live_filename = secure_filename(f"{uuid.uuid4()}_{live_face_file.filename}")
-    id_card_path   = os.path.join(app.config['UPLOAD_FOLDER'], id_filename)
-    live_face_path = os.path.join(app.config['UPLOAD_FOLDER'], live_filename)
-    id_card_file.save(id_card_path)
-    live_face_file.save(live_face_path)
- 
-    _id_card_path   = id_card_path
-    _live_face_path = live_face_path
-    _gemini         = gemini_model_instance
-    _liveness_ref   = DUMMY_LIVENESS_REF_IMAGE
- 
-    def evt(stage, status, detail=None, substage=None, overall=None, data=None):
-        payload = {"stage": stage, "status": status}
-        if substage: payload["substage"] = substage
-        if detail:   payload["detail"]   = detail
-        if overall:  payload["overall"]  = overall
-        if data:     payload["data"]     = data
-        return f"data: {json.dumps(payload)}\n\n"
- 
+        return jsonify({"error": "Invalid file type. Allowed types: png, jpg, jpeg"}), 400
+
+    webhook_url = request.form.get('webhook_url') or None
+    if webhook_url:
+        webhook_error = job_queue.validate_webhook_url(webhook_url)
+        if webhook_error:
+            return jsonify({"error": webhook_error}), 400
+
+    id_card_path   = save_upload(id_card_file)
+    live_face_path = save_upload(live_face_file)
+    try:
+        job_id = job_queue.submit(id_card_path, live_face_path, webhook_url)
+    except job_queue.QueueFull as full:
+        for path in (id_card_path, live_face_path):
+            if os.path.exists(path): os.remove(path)
+        response = jsonify({"error": "Verification queue is full, retry later.",
+                            "pending": full.pending, "retry_after": full.retry_after})
+        response.headers['Retry-After'] = str(full.retry_after)
+        return response, 503
+
+    return jsonify({
+        "job_id": job_id,
+        "status": "queued",
+        "status_url": f"/jobs/{job_id}",
+        "events_url": f"/jobs/{job_id}/events",
+    }), 202
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Job status and stage events. `?after=<n>` returns only events with id > n."""
+    job = job_queue.get_job(job_id, after_seq=request.args.get('after', 0, type=int))
+    if job is None:
+        return jsonify({"error": "Unknown job id"}), 404
+    return jsonify(job), 200
+
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def stream_job_events(job_id):
+    """
+    SSE view of a job's stage events. Each event carries `id: <n>`, so a client
+    that reconnects with Last-Event-ID resumes where it left off.
+    """
+    import json
+    import time
+    from flask import Response, stream_with_context
+
+    last_seen = request.headers.get('Last-Event-ID', request.args.get('after', '0'))
+    last_seen = int(last_seen) if str(last_seen).isdigit() else 0
+    if job_queue.get_job(job_id, after_seq=last_seen) is None:
+        return jsonify({"error": "Unknown job id"}), 404
+
     def generate():
-        response_data = {
-            "text_details": None,
-            "id_card_processing_status": "Not Processed",
-            "liveness_check":    {"passed": False, "status": "Not Performed"},
-            "face_verification": {"verified": False, "status": "Not Performed"},
-            "database_storage":  {"stored": False, "message": "Not Attempted"},
-            "overall_status": "Failed",
-        }
-        extracted_details = {}
-        id_embedding      = None
- 
-        try:
-            # ════════════════════════════════════════════════════════════════════
-            # STAGE 1 — Document Processing  (2 visible sub-steps)
-            # ════════════════════════════════════════════════════════════════════
-            yield evt("document", "running",
-                      "Starting document processing — OCR then face extraction...")
- 
-            # ── Sub-step 1a: Gemini OCR ──────────────────────────────────────
-            yield evt("document", "running",
-                      substage="ocr",
-                      detail="Sending ID card to Gemini Vision for text extraction...")
- 
-            try:
-                extracted_details = id_card_processor.extract_text_from_id(
-                    _id_card_path, _gemini
-                )
-            except Exception as ocr_err:
-                traceback.print_exc()
-                extracted_details = {"error": str(ocr_err)}
- 
-            response_data["text_details"] = extracted_details
- 
-            if "error" in extracted_details or "id_processing_error" in extracted_details:
-                err = extracted_details.get("error",
-                      extracted_details.get("id_processing_error", "Unknown OCR error"))
-                yield evt("document", "failed",
-                          substage="ocr",
-                          detail=f"Gemini OCR failed: {err}")
-                yield evt("document", "failed",
-                          detail=f"OCR could not extract details from the ID card. {err}")
-                for s in ("liveness", "face_match", "storage"):
-                    yield evt(s, "skipped", "Skipped — document OCR failed.")
-                response_data["id_card_processing_status"] = f"Failed: {err}"
-                response_data["overall_status"] = "Failed: ID card OCR error."
-                yield evt("done", "failed", overall="failed", data=response_data)
-                return
- 
-            # Build a human-readable OCR summary
-            name    = extracted_details.get("name", "")
-            card    = extracted_details.get("card_type", "ID card")
-            dob     = extracted_details.get("dob", "")
-            doc_num = (extracted_details.get("aadhaar_no")
-                       or extracted_details.get("pan_no")
-                       or extracted_details.get("voter_id_number")
-                       or extracted_details.get("license_no", ""))
-            ocr_summary = (
-                f"{card} — Name: {name}"
-                + (f" | DOB: {dob}" if dob else "")
-                + (f" | Doc No: {doc_num}" if doc_num else "")
-            )
- 
-            yield evt("document", "passed",
-                      substage="ocr",
-                      detail=ocr_summary)
- 
-            # ── Sub-step 1b: Face Extraction ─────────────────────────────────
-            yield evt("document", "running",
-                      substage="face",
-                      detail="Detecting face on ID card using RetinaFace → CLAHE preprocessing → Facenet embedding...")
- 
-            id_embedding, face_info = id_card_processor.extract_face_from_id(_id_card_path)
- 
-            if id_embedding is None:
-                yield evt("document", "failed",
-                          substage="face",
-                          detail=f"Face extraction failed: {face_info}")
-                yield evt("document", "failed",
-                          detail=f"Could not extract face from ID card. {face_info}")
-                for s in ("liveness", "face_match", "storage"):
-                    yield evt(s, "skipped", "Skipped — no face found on ID card.")
-                response_data["id_card_processing_status"] = f"Failed: {face_info}"
-                response_data["overall_status"] = "Failed: No face detected on ID card."
-                yield evt("done", "failed", overall="failed", data=response_data)
-                return
- 
-            yield evt("document", "passed",
-                      substage="face",
-                      detail=f"{face_info}")
- 
-            # Stage 1 fully passed
-            response_data["id_card_processing_status"] = \
-                "Successfully processed ID card text and face."
-            yield evt("document", "passed",
-                      detail=f"{card} verified. OCR complete, face embedding ready.")
- 
-            # ════════════════════════════════════════════════════════════════════
-            # STAGE 2 — Liveness Detection
-            # ════════════════════════════════════════════════════════════════════
-            yield evt("liveness", "running",
-                      "Checking that the live photo is a real person (anti-spoofing)...")
- 
-            liveness_passed, liveness_msg = face_verifier.perform_liveness_check(
-                _live_face_path, _liveness_ref
-            )
-            response_data["liveness_check"]["passed"] = liveness_passed
-            response_data["liveness_check"]["status"]  = liveness_msg
- 
-            if not liveness_passed:
-                yield evt("liveness", "failed",
-                          f"Liveness failed: {liveness_msg}. "
-                          "Ensure you're using a real photo in good lighting — "
-                          "not a screen or printout.")
-                yield evt("face_match", "skipped", "Skipped — liveness check did not pass.")
-                yield evt("storage",    "skipped", "Skipped — liveness check did not pass.")
-                response_data["overall_status"] = "Failed: Liveness check failed."
-                yield evt("done", "failed", overall="failed", data=response_data)
+        seq = last_seen
+        last_write = time.monotonic()
+        while True:
+            job = job_queue.get_job(job_id, after_seq=seq)
+            if job is None:
                 return
- 
-            yield evt("liveness", "passed", f"Real person confirmed. {liveness_msg}")
- 
-            # ════════════════════════════════════════════════════════════════════
-            # STAGE 3 — Face Matching
-            # ════════════════════════════════════════════════════════════════════
-            yield evt("face_match", "running",
-                      "Comparing live face to ID card embedding using cosine similarity...")
- 
-            verification_passed, vd = face_verifier.verify_faces(
-                _live_face_path, id_embedding
-            )
-            response_data["face_verification"] = vd
-            response_data["face_verification"]["status"] = vd.get("message", "Unknown")
- 
-            distance  = vd.get("distance",  "N/A")
-            threshold = vd.get("threshold", "N/A")
-            model     = vd.get("model",     "Facenet")
- 
-            if not verification_passed:
-                yield evt("face_match", "failed",
-                          f"Face did not match. Distance: {distance} "
-                          f"(threshold: {threshold}, model: {model}). "
-                          "The live photo does not match the face on the ID card.")
-                yield evt("storage", "skipped", "Skipped — face verification failed.")
-                response_data["overall_status"] = "Failed: Face verification failed."
-                yield evt("done", "failed", overall="failed", data=response_data)
+            for event in job["events"]:
+                seq = event.pop("id")
+                yield f"id: {seq}\ndata: {json.dumps(event)}\n\n"
+                last_write = time.monotonic()
+                if event.get("stage") == "done":
+                    return
+            if job["status"] in ("done", "failed") and not job["events"]:
                 return
- 
-            yield evt("face_match", "passed",
-                      f"Face matched. Distance: {distance} "
-                      f"(threshold: {threshold}, model: {model})")
- 
-            # ════════════════════════════════════════════════════════════════════
-            # STAGE 4 — Database Storage
-            # ════════════════════════════════════════════════════════════════════
-            yield evt("storage", "running",
-                      "Storing verified identity securely in the database...")
- 
-            try:
-                db_success, db_message = db_storer.store_verified_user_details(
-                    extracted_details, id_embedding
-                )
-                response_data["database_storage"]["stored"]  = db_success
-                response_data["database_storage"]["message"] = db_message
- 
-                if db_success:
-                    yield evt("storage", "passed", f"Stored successfully. {db_message}")
-                    response_data["overall_status"] = \
-                        "Success: Liveness, Face Verification, and Database Storage Passed."
-                    yield evt("done", "passed", overall="success", data=response_data)
-                else:
-                    yield evt("storage", "failed", f"Storage warning: {db_message}")
-                    response_data["overall_status"] = \
-                        "Partial Success: Verification passed but database storage failed."
-                    yield evt("done", "passed", overall="success", data=response_data)
- 
-            except Exception as db_err:
-                traceback.print_exc()
-                yield evt("storage", "failed", f"Database error: {str(db_err)}")
-                response_data["database_storage"]["message"] = str(db_err)
-                response_data["overall_status"] = "Partial: Verification passed, storage failed."
-                yield evt("done", "passed", overall="success", data=response_data)
- 
-        except Exception as e:
-            traceback.print_exc()
-            yield evt("done", "failed",
-                      detail=f"Unexpected server error: {str(e)}",
-                      overall="failed",
-                      data=response_data)
- 
-        finally:
-            for path in [_id_card_path, _live_face_path]:
-                if path and os.path.exists(path):
-                    try:
-                        os.remove(path)
-                    except Exception as e_clean:
-                        print(f"Cleanup error: {e_clean}")
- 
-    return Response(
-        stream_with_context(generate()),
-        mimetype='text/event-stream',
-        headers={
-            'Cache-Control':     'no-cache',
-            'X-Accel-Buffering': 'no',
-        },
-    )
- 
- 
+            if time.monotonic() - last_write >= event_stream.SSE_HEARTBEAT_SECONDS:
+                yield event_stream.HEARTBEAT_FRAME
+                last_write = time.monotonic()
+            time.sleep(job_queue.JOB_POLL_INTERVAL_SECONDS)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers=STREAM_HEADERS)
+
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=int(os.getenv('PORT', 5000)), debug=True)
@@ -1,4 +1,4 @@
-import { useState } from "react";
+import { useRef, useState } from "react";
 import { Button } from "@/components/ui/button";
 import { FileText, User, Eye, Camera, ArrowLeft } from "lucide-react";
 import { toast } from "sonner";
@@ -21,6 +21,7 @@ interface BackendResponse {
   face_verification?: {
     distance: string; message: string; metric: string;
     model: string; status: string; threshold: string; verified: boolean;
+    tier?: "fast" | "strong";
   };
   id_card_processing_status?: string;
   liveness_check?: { passed: boolean; status: string };
@@ -34,7 +35,7 @@ interface BackendResponse {
 interface SSEEvent {
   stage:    "document" | "liveness" | "face_match" | "storage" | "done";
   substage?: "ocr" | "face";        // only for document stage
-  status:   "running" | "passed" | "failed" | "skipped";
+  status:   "running" | "progress" | "passed" | "failed" | "skipped";
   detail?:  string;
   overall?: "success" | "failed";
   data?:    BackendResponse;
@@ -85,6 +86,8 @@ const INITIAL_STAGES: PipelineStage[] = [
 export default function IdentityVerification() {
   const [documentImage, setDocumentImage] = useState<File | null>(null);
   const [faceImage, setFaceImage]         = useState<File | null>(null);
+  // Every frame of the camera burst (faceImage is the first); scored together for liveness
+  const [faceFrames, setFaceFrames]       = useState<File[]>([]);
   const [documentPreview, setDocumentPreview] = useState<string | null>(null);
   const [facePreview, setFacePreview]         = useState<string | null>(null);
   const [showCamera, setShowCamera]       = useState(false);
@@ -93,6 +96,9 @@ export default function IdentityVerification() {
   const [isStreaming, setIsStreaming]     = useState(false);
   const [stages, setStages]               = useState<PipelineStage[]>(INITIAL_STAGES);
   const [completedStages, setCompletedStages] = useState<PipelineStage[]>([]);
+  // Server-side session whose document stage started when the ID card was chosen
+  const [sessionId, setSessionId]         = useState<string | null>(null);
+  const sessionDocument = useRef<File | null>(null);
 
   // ── Helpers ────────────────────────────────────────────────────────────────
   /** Update a top-level stage by id */
@@ -119,26 +125,49 @@ export default function IdentityVerification() {
       };
     });
 
+  /** Start OCR + ID face extraction now, while the user takes the selfie. */
+  const startSession = (file: File) => {
+    sessionDocument.current = file;
+    setSessionId(null);
+    const body = new FormData();
+    body.append("id_card_image", file);
+    fetch("http://localhost:5000/sessions", { method: "POST", body })
+      .then((r) => (r.ok ? r.json() : null))
+      .then((session) => {
+        // Ignore a late answer for a document that has since been replaced
+        if (sessionDocument.current === file) setSessionId(session?.session_id ?? null);
+      })
+      .catch(() => {});
+  };
+
   const handleDocumentUpload = (file: File) => {
     setDocumentImage(file);
     const reader = new FileReader();
     reader.onload = (e) => setDocumentPreview(e.target?.result as string);
     reader.readAsDataURL(file);
+    startSession(file);
   };
 
-  const handleCameraCapture = (imageSrc: string) => {
-    fetch(imageSrc)
-      .then((r) => r.blob())
-      .then((blob) => {
-        const file = new File([blob], "profile-photo.png", { type: "image/png" });
-        setFaceImage(file);
+  const handleCameraCapture = (imageSrc: string, burst: string[]) => {
+    Promise.all(burst.map((src) => fetch(src).then((r) => r.blob())))
+      .then((blobs) => {
+        const files = blobs.map(
+          (blob, i) => new File([blob], `profile-photo-${i + 1}.jpg`, { type: "image/jpeg" })
+        );
+        setFaceImage(files[0]);
+        setFaceFrames(files);
         setFacePreview(imageSrc);
         setShowCamera(false);
       });
   };
 
-  const removeDocumentImage = () => { setDocumentImage(null); setDocumentPreview(null); };
-  const removeFaceImage     = () => { setFaceImage(null);     setFacePreview(null); };
+  const removeDocumentImage = () => {
+    setDocumentImage(null); setDocumentPreview(null);
+    sessionDocument.current = null; setSessionId(null);
+  };
+  const removeFaceImage     = () => {
+    setFaceImage(null); setFaceFrames([]); setFacePreview(null);
+  };
 
   // ── Submit → SSE stream ──────────────────────────────────────────────────
   const handleSubmit = async () => {
@@ -158,16 +187,55 @@ export default function IdentityVerification() {
     setVerificationStatus(null);
     setIsStreaming(true);
 
+    // A camera burst goes up as repeated live_face_image parts
+    const liveFrames = faceFrames.length ? faceFrames : [faceImage];
     const formData = new FormData();
     formData.append("id_card_image",   documentImage);
-    formData.append("live_face_image", faceImage);
+    for (const frame of liveFrames) formData.append("live_face_image", frame);
+
+    // Every event carries `id: <streamId>:<seq>`. If the connection drops
+    // before "done", reattach to the same server-side run with Last-Event-ID
+    // instead of re-uploading and restarting the pipeline.
+    let lastEventId: string | null = null;
+    let finished = false;
 
-    try {
-      const response = await fetch(
-        "http://localhost:5000/process_and_verify_stream",
-        { method: "POST", body: formData }
-      );
+    const handleEvent = (event: SSEEvent) => {
+      if (event.stage === "done") {
+        finished = true;
+        setCompletedStages((prev) => (prev.length ? prev : stages));
+        setIsStreaming(false);
+        if (event.data) setBackendResponse(event.data);
+        setVerificationStatus(event.overall === "success" ? "success" : "failed");
+        toast[event.overall === "success" ? "success" : "error"](
+          event.overall === "success"
+            ? "Identity verification completed successfully!"
+            : "Verification failed. See details below."
+        );
+      } else if (event.substage) {
+        // Sub-step event — update the sub-step inside document stage
+        // ("progress" only refreshes the detail of a step that is still running)
+        setStages((prev) => {
+          const updated = patchSubStep(prev, event.substage!, {
+            status: event.status === "progress" ? "running" : event.status,
+            detail: event.detail,
+          });
+          setCompletedStages(updated);
+          return updated;
+        });
+      } else {
+        // Top-level stage event
+        setStages((prev) => {
+          const updated = patchStage(prev, event.stage, {
+            status: event.status === "progress" ? "running" : event.status,
+            detail: event.detail,
+          });
+          setCompletedStages(updated);
+          return updated;
+        });
+      }
+    };
 
+    const readStream = async (response: Response) => {
       if (!response.ok || !response.body) {
         throw new Error(`Server error: ${response.status}`);
       }
@@ -185,51 +253,66 @@ export default function IdentityVerification() {
         buffer = parts.pop() ?? "";
 
         for (const part of parts) {
-          const line = part.trim();
-          if (!line.startsWith("data: ")) continue;
+          let data: string | null = null;
+          let id: string | null   = null;
+          for (const line of part.trim().split("\n")) {
+            if (line.startsWith("id: "))   id   = line.slice(4);
+            if (line.startsWith("data: ")) data = line.slice(6);
+          }
+          if (data === null) continue;
 
           let event: SSEEvent;
-          try { event = JSON.parse(line.slice(6)); }
+          try { event = JSON.parse(data); }
           catch { continue; }
 
-          if (event.stage === "done") {
-            setCompletedStages((prev) => (prev.length ? prev : stages));
-            setIsStreaming(false);
-            if (event.data) setBackendResponse(event.data);
-            setVerificationStatus(event.overall === "success" ? "success" : "failed");
-            toast[event.overall === "success" ? "success" : "error"](
-              event.overall === "success"
-                ? "Identity verification completed successfully!"
-                : "Verification failed. See details below."
+          if (id) lastEventId = id;
+          handleEvent(event);
+        }
+      }
+    };
+
+    const MAX_RESUME_ATTEMPTS = 3;
+    let attempt = 0;
+    while (!finished) {
+      try {
+        if (attempt === 0) {
+          // Prefer the session whose document stage is already under way; fall
+          // back to the one-shot stream if it expired or another worker answers.
+          let response: Response | null = null;
+          if (sessionId) {
+            const selfie = new FormData();
+            for (const frame of liveFrames) selfie.append("live_face_image", frame);
+            setSessionId(null); // one selfie per session
+            response = await fetch(
+              `http://localhost:5000/sessions/${sessionId}/selfie`,
+              { method: "POST", body: selfie }
             );
-          } else if (event.substage) {
-            // Sub-step event — update the sub-step inside document stage
-            setStages((prev) => {
-              const updated = patchSubStep(prev, event.substage!, {
-                status: event.status,
-                detail: event.detail,
-              });
-              setCompletedStages(updated);
-              return updated;
-            });
-          } else {
-            // Top-level stage event
-            setStages((prev) => {
-              const updated = patchStage(prev, event.stage, {
-                status: event.status,
-                detail: event.detail,
-              });
-              setCompletedStages(updated);
-              return updated;
-            });
+            if (!response.ok) response = null;
           }
+          await readStream(response ?? await fetch(
+            "http://localhost:5000/process_and_verify_stream",
+            { method: "POST", body: formData }
+          ));
+        } else {
+          const streamId = lastEventId!.slice(0, lastEventId!.lastIndexOf(":"));
+          await readStream(await fetch(
+            `http://localhost:5000/process_and_verify_stream/${streamId}`,
+            { headers: { "Last-Event-ID": lastEventId! } }
+          ));
+        }
+        if (!finished) throw new Error("Stream ended before completion");
+      } catch (err) {
+        console.error("SSE stream error:", err);
+        if (finished) break;
+        attempt += 1;
+        if (!lastEventId || attempt > MAX_RESUME_ATTEMPTS) {
+          toast.error("Connection error. Please try again.");
+          setIsStreaming(false);
+          setVerificationStatus("failed");
+          break;
         }
+        await new Promise((resolve) => setTimeout(resolve, 1000 * attempt));
       }
-    } catch (err) {
-      console.error("SSE stream error:", err);
-      toast.error("Connection error. Please try again.");
-      setIsStreaming(false);
-      setVerificationStatus("failed");
     }
   };
 
@@ -247,8 +330,9 @@ export default function IdentityVerification() {
 
   const handleRetry     = reset;
   const handleStartOver = () => {
-    setDocumentImage(null); setFaceImage(null);
+    setDocumentImage(null); setFaceImage(null); setFaceFrames([]);
     setDocumentPreview(null); setFacePreview(null);
+    sessionDocument.current = null; setSessionId(null);
     reset();
   };
 
@@ -3,15 +3,21 @@ import { Camera, X, RotateCw } from "lucide-react";
 import { Button } from "@/components/ui/button";
 import { cn } from "@/lib/utils";
 
+// Gap between burst frames; 4 frames span about a third of a second.
+const BURST_INTERVAL_MS = 100;
+
 interface CameraCaptureProps {
-  onCapture: (imageSrc: string) => void;
+  /** imageSrc is the first frame; burst holds every frame (JPEG data URLs) */
+  onCapture: (imageSrc: string, burst: string[]) => void;
   onClose: () => void;
+  burstFrames?: number;
   className?: string;
 }
 
 export function CameraCapture({
   onCapture,
   onClose,
+  burstFrames = 4,
   className,
 }: CameraCaptureProps) {
   const videoRef = useRef<HTMLVideoElement>(null);
@@ -19,6 +25,7 @@ export function CameraCapture({
   const [stream, setStream] = useState<MediaStream | null>(null);
   const [isCameraReady, setIsCameraReady] = useState(false);
   const [error, setError] = useState<string | null>(null);
+  const [isCapturing, setIsCapturing] = useState(false);
   const [facingMode, setFacingMode] = useState<"user" | "environment">("user");
 
   useEffect(() => {
@@ -81,8 +88,10 @@ export function CameraCapture({
     setFacingMode((prev) => (prev === "user" ? "environment" : "user"));
   };
 
-  const capturePhoto = () => {
-    if (!isCameraReady || !videoRef.current || !canvasRef.current) return;
+  // Grabs a short burst of frames so the server can score liveness on
+  // several of them at once instead of the user retrying single shots.
+  const capturePhoto = async () => {
+    if (!isCameraReady || isCapturing || !videoRef.current || !canvasRef.current) return;
 
     const video = videoRef.current;
     const canvas = canvasRef.current;
@@ -93,11 +102,16 @@ export function CameraCapture({
     canvas.width = video.videoWidth;
     canvas.height = video.videoHeight;
 
-    context.drawImage(video, 0, 0, canvas.width, canvas.height);
-
-    const imageSrc = canvas.toDataURL("image/png");
+    setIsCapturing(true);
+    const burst: string[] = [];
+    for (let i = 0; i < Math.max(1, burstFrames); i++) {
+      if (i > 0) await new Promise((resolve) => setTimeout(resolve, BURST_INTERVAL_MS));
+      context.drawImage(video, 0, 0, canvas.width, canvas.height);
+      burst.push(canvas.toDataURL("image/jpeg", 0.92));
+    }
+    setIsCapturing(false);
 
-    onCapture(imageSrc);
+    onCapture(burst[0], burst);
 
     stopCamera();
   };
@@ -164,7 +178,7 @@ export function CameraCapture({
           size="lg"
           className="rounded-full w-16 h-16 p-0 bg-white text-black hover:bg-white/90"
           onClick={capturePhoto}
-          disabled={!isCameraReady}
+          disabled={!isCameraReady || isCapturing}
         >
           <Camera className="h-6 w-6" />
         </Button>
@@ -24,6 +24,8 @@ interface BackendResponse {
   database_storage?: {
     message: string;
     stored: boolean;
+    accepted?: boolean;   // write-behind mode: queued, written in the background
+    write_id?: string;
   };
   face_verification?: {
     distance: string;
@@ -33,6 +35,7 @@ interface BackendResponse {
     status: string;
     threshold: string;
     verified: boolean;
+    tier?: "fast" | "strong";     // "strong": borderline Facenet distance, re-decided by the bigger model
   };
   id_card_processing_status?: string;
   liveness_check?: {
@@ -176,7 +179,9 @@ export function VerificationResult({
           id: "face_match",
           title: "Face Matching",
           description: backendData.face_verification
-            ? `${backendData.face_verification.model} • Distance: ${backendData.face_verification.distance}`
+            ? `${backendData.face_verification.model}${
+                backendData.face_verification.tier === "strong" ? " (escalated)" : ""
+              } • Distance: ${backendData.face_verification.distance}`
             : "Cosine similarity check",
           status: backendData.face_verification
             ? backendData.face_verification.verified ? "passed" : "failed"
@@ -188,7 +193,8 @@ export function VerificationResult({
           title: "Data Storage",
           description: "Secure database persistence",
           status: backendData.database_storage
-            ? backendData.database_storage.stored ? "passed" : "failed"
+            ? backendData.database_storage.stored || backendData.database_storage.accepted
+              ? "passed" : "failed"
             : "skipped",
           detail: backendData.database_storage?.message,
         },
@@ -0,0 +1,164 @@
+# ml_logic/admission.py
+"""
+Admission control for the verification pipeline.
+
+Each worker process runs at most ADMISSION_MAX_CONCURRENT pipelines. Up to
+ADMISSION_MAX_QUEUE further requests wait for a slot, each for at most
+ADMISSION_QUEUE_TIMEOUT_SECONDS. Anything beyond that is shed at once with
+Rejected, carrying a Retry-After computed from measured stage latencies, so
+an overloaded worker keeps finishing the requests it has instead of letting
+all of them run into the gunicorn timeout together.
+
+The queue only sees concurrent requests when the worker serves them
+concurrently: run gunicorn with --worker-class gthread and --threads of at
+least ADMISSION_MAX_CONCURRENT + ADMISSION_MAX_QUEUE, as the Dockerfile does.
+A sync worker handles one request at a time, so nothing ever waits or is shed.
+"""
+import math
+import os
+import threading
+import time
+
+# --- Configuration ---
+ADMISSION_MAX_CONCURRENT        = int(os.getenv("ADMISSION_MAX_CONCURRENT", "2"))
+ADMISSION_MAX_QUEUE             = int(os.getenv("ADMISSION_MAX_QUEUE", "4"))
+ADMISSION_QUEUE_TIMEOUT_SECONDS = float(os.getenv("ADMISSION_QUEUE_TIMEOUT_SECONDS", "15"))
+# Weight of the newest sample in the latency moving averages.
+LATENCY_EWMA_ALPHA              = 0.2
+# Used for Retry-After until real measurements exist.
+DEFAULT_PIPELINE_SECONDS        = 20.0
+
+PIPELINE_STAGES = ("document", "liveness", "face_match", "storage")
+
+
+class Rejected(Exception):
+    """The request was shed. retry_after is in whole seconds."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f"Request shed ({reason})")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    def __init__(self, max_concurrent, max_queue, queue_timeout):
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+        self._admitted_total = 0
+        self._shed_total = {"queue_full": 0, "queue_timeout": 0}
+        self._stage_seconds = {}
+        self._pipeline_seconds = None
+
+    # ── Slots ──
+    def acquire(self, shed=True):
+        """
+        Blocks until a pipeline slot is free. With shed=True (HTTP requests) the
+        wait is bounded by the queue size and timeout and Rejected is raised
+        instead; shed=False (background jobs) waits as long as it takes.
+        Returns the admission timestamp to pass to release().
+        """
+        with self._cond:
+            if self._active < self.max_concurrent and self._waiting == 0:
+                return self._admit()
+            if shed and self._waiting >= self.max_queue:
+                self._shed_total["queue_full"] += 1
+                raise Rejected("queue_full", self.retry_after_seconds())
+
+            self._waiting += 1
+            deadline = time.monotonic() + self.queue_timeout if shed else None
+            try:
+                while self._active >= self.max_concurrent:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        self._shed_total["queue_timeout"] += 1
+                        raise Rejected("queue_timeout", self.retry_after_seconds())
+                    self._cond.wait(remaining)
+            finally:
+                self._waiting -= 1
+            return self._admit()
+
+    def _admit(self):
+        self._active += 1
+        self._admitted_total += 1
+        return time.monotonic()
+
+    def release(self, admitted_at):
+        with self._cond:
+            self._active -= 1
+            self._pipeline_seconds = self._ewma(self._pipeline_seconds, time.monotonic() - admitted_at)
+            self._cond.notify()
+
+    # ── Latency tracking ──
+    @staticmethod
+    def _ewma(current, sample):
+        return sample if current is None else (1 - LATENCY_EWMA_ALPHA) * current + LATENCY_EWMA_ALPHA * sample
+
+    def record_stage(self, stage, seconds):
+        with self._cond:
+            self._stage_seconds[stage] = self._ewma(self._stage_seconds.get(stage), seconds)
+
+    def expected_pipeline_seconds(self):
+        if all(stage in self._stage_seconds for stage in PIPELINE_STAGES):
+            return sum(self._stage_seconds[stage] for stage in PIPELINE_STAGES)
+        return self._pipeline_seconds or DEFAULT_PIPELINE_SECONDS
+
+    def retry_after_seconds(self):
+        """Time for the current backlog (running + queued) to drain through the slots."""
+        backlog = self._active + self._waiting + 1
+        return max(1, math.ceil(self.expected_pipeline_seconds() * backlog / self.max_concurrent))
+
+    def track_stages(self, events):
+        """
+        Passes pipeline events through, timing each stage from its first
+        'running' event to its first terminal event.
+        """
+        started = {}
+        for event in events:
+            stage, status = event.get("stage"), event.get("status")
+            if stage in PIPELINE_STAGES and not event.get("substage"):
+                if status == "running" and stage not in started:
+                    started[stage] = time.monotonic()
+                elif status in ("passed", "failed") and stage in started:
+                    self.record_stage(stage, time.monotonic() - started.pop(stage))
+            yield event
+
+    # ── Metrics ──
+    def snapshot(self):
+        with self._cond:
+            return {
+                "active": self._active,
+                "queue_depth": self._waiting,
+                "max_concurrent": self.max_concurrent,
+                "max_queue": self.max_queue,
+                "admitted_total": self._admitted_total,
+                "shed_total": dict(self._shed_total),
+                "stage_seconds": {k: round(v, 3) for k, v in self._stage_seconds.items()},
+                "pipeline_seconds": round(self._pipeline_seconds, 3) if self._pipeline_seconds else None,
+            }
+
+    def prometheus_text(self):
+        snap = self.snapshot()
+        lines = [
+            "# TYPE votechain_pipeline_active gauge",
+            f"votechain_pipeline_active {snap['active']}",
+            "# TYPE votechain_pipeline_queue_depth gauge",
+            f"votechain_pipeline_queue_depth {snap['queue_depth']}",
+            "# TYPE votechain_pipeline_admitted_total counter",
+            f"votechain_pipeline_admitted_total {snap['admitted_total']}",
+            "# TYPE votechain_pipeline_shed_total counter",
+        ]
+        for reason, count in snap["shed_total"].items():
+            lines.append(f'votechain_pipeline_shed_total{{reason="{reason}"}} {count}')
+        lines.append("# TYPE votechain_stage_latency_seconds gauge")
+        for stage, seconds in snap["stage_seconds"].items():
+            lines.append(f'votechain_stage_latency_seconds{{stage="{stage}"}} {seconds}')
+        return "\n".join(lines) + "\n"
+
+
+controller = AdmissionController(
+    ADMISSION_MAX_CONCURRENT, ADMISSION_MAX_QUEUE, ADMISSION_QUEUE_TIMEOUT_SECONDS
+)
@@ -0,0 +1,313 @@
+# ml_logic/batch_verifier.py
+"""
+Bulk verification for kiosk uploads (POST /batch/verify).
+
+Kiosks collect (ID card, selfie) pairs offline and upload them in one go,
+either as a zip / tar(.gz) archive laid out as
+
+    <pair_id>/id_card.<png|jpg|jpeg>
+    <pair_id>/live_face.<png|jpg|jpeg>
+
+or as a multipart request with repeated id_card_image / live_face_image
+fields (paired by order). The pairs run in chunks of BATCH_CHUNK_SIZE:
+
+  - Gemini OCR runs one chunk ahead on a pool of BATCH_GEMINI_CONCURRENCY
+    threads, so OCR overlaps the model work without going over the API quota
+    or queueing calls for pairs that may never be reached.
+  - Detection (ID card face; live face with anti-spoofing) runs on
+    BATCH_MODEL_WORKERS threads. The live crop from the liveness pass is
+    reused for the embedding instead of being detected a second time.
+  - All ID and live faces of a chunk are embedded with one represent_batch().
+    Borderline distances escalate to the strong model as in verify_faces, and
+    the strong ID embeddings stored for /reverify are computed in one more
+    batch for the pairs that did not escalate.
+  - The verified rows of a chunk are stored in one database transaction.
+
+run_batch() yields one result per pair in the /process_and_verify response
+shape plus "pair_id", then a final {"summary": ...} record.
+"""
+import os
+import tarfile
+import time
+import traceback
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import PurePosixPath
+
+from ml_logic import db_storer
+from ml_logic import deadline
+from ml_logic import face_verifier
+from ml_logic import id_card_processor
+from ml_logic import inference_backend
+
+# --- Configuration ---
+BATCH_MAX_PAIRS          = int(os.getenv("BATCH_MAX_PAIRS", "500"))
+BATCH_MAX_IMAGE_BYTES    = int(os.getenv("BATCH_MAX_IMAGE_BYTES", str(16 * 1024 * 1024)))
+# Replaces the app-wide 16 MB MAX_CONTENT_LENGTH for /batch/verify only.
+BATCH_MAX_UPLOAD_BYTES   = int(os.getenv("BATCH_MAX_UPLOAD_BYTES", str(2 * 1024 * 1024 * 1024)))
+BATCH_CHUNK_SIZE         = int(os.getenv("BATCH_CHUNK_SIZE", "32"))
+BATCH_GEMINI_CONCURRENCY = int(os.getenv("BATCH_GEMINI_CONCURRENCY", "4"))
+BATCH_MODEL_WORKERS      = int(os.getenv("BATCH_MODEL_WORKERS", "2"))
+
+IMAGE_EXTENSIONS = ("png", "jpg", "jpeg")
+ID_CARD_STEM     = "id_card"
+LIVE_FACE_STEM   = "live_face"
+
+
+class BatchError(ValueError):
+    """The uploaded batch is malformed or over the configured limits."""
+
+
+# ── Unpacking ─────────────────────────────────────────────────────────────────
+def _archive_members(archive_path):
+    """Yields (member_name, declared_size, open_fn) for every regular file in a zip or tar."""
+    if zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as zf:
+            for info in zf.infolist():
+                if not info.is_dir():
+                    yield info.filename, info.file_size, lambda info=info: zf.open(info)
+    elif tarfile.is_tarfile(archive_path):
+        with tarfile.open(archive_path) as tf:
+            for member in tf.getmembers():
+                if member.isfile():
+                    yield member.name, member.size, lambda member=member: tf.extractfile(member)
+    else:
+        raise BatchError("Batch archive must be a zip or tar file.")
+
+
+def unpack_archive(archive_path, dest_dir):
+    """
+    Writes the pair images of an archive into dest_dir under generated names
+    (member names are never used as paths).
+
+    Returns:
+        (pairs, rejected) — pairs is [(pair_id, id_card_path, live_face_path)]
+        sorted by pair_id; rejected is [(pair_id, reason)] for incomplete pairs.
+    """
+    found = {}
+    for name, size, open_member in _archive_members(archive_path):
+        parts = PurePosixPath(name).parts
+        if len(parts) < 2 or parts[0] == "__MACOSX":
+            continue
+        stem, _, ext = parts[-1].rpartition(".")
+        ext = ext.lower()
+        if stem not in (ID_CARD_STEM, LIVE_FACE_STEM) or ext not in IMAGE_EXTENSIONS:
+            continue
+        if size > BATCH_MAX_IMAGE_BYTES:
+            raise BatchError(f"{name} is larger than {BATCH_MAX_IMAGE_BYTES} bytes.")
+        pair_id = parts[-2]
+        if pair_id not in found and len(found) >= BATCH_MAX_PAIRS:
+            raise BatchError(f"Batch has more than {BATCH_MAX_PAIRS} pairs.")
+
+        with open_member() as src:
+            data = src.read(BATCH_MAX_IMAGE_BYTES + 1)
+        if len(data) > BATCH_MAX_IMAGE_BYTES:
+            raise BatchError(f"{name} is larger than {BATCH_MAX_IMAGE_BYTES} bytes.")
+        path = os.path.join(dest_dir, f"{uuid.uuid4().hex}.{ext}")
+        with open(path, "wb") as dst:
+            dst.write(data)
+        found.setdefault(pair_id, {})[stem] = path
+
+    pairs, rejected = [], []
+    for pair_id in sorted(found):
+        files = found[pair_id]
+        if ID_CARD_STEM in files and LIVE_FACE_STEM in files:
+            pairs.append((pair_id, files[ID_CARD_STEM], files[LIVE_FACE_STEM]))
+        else:
+            missing = LIVE_FACE_STEM if ID_CARD_STEM in files else ID_CARD_STEM
+            rejected.append((pair_id, f"Missing {missing} image."))
+    if not pairs and not rejected:
+        raise BatchError(f"No <pair_id>/{ID_CARD_STEM}.* and <pair_id>/{LIVE_FACE_STEM}.* images found.")
+    return pairs, rejected
+
+
+# ── Processing ────────────────────────────────────────────────────────────────
+def _new_result(pair_id):
+    return {
+        "pair_id": pair_id,
+        "text_details": None,
+        "id_card_processing_status": "Not Processed",
+        "liveness_check":    {"passed": False, "status": "Not Performed"},
+        "face_verification": {"verified": False, "status": "Not Performed"},
+        "database_storage":  {"stored": False, "message": "Not Attempted"},
+        "overall": "failed",
+        "overall_status": "Failed",
+    }
+
+
+def rejected_result(pair_id, reason):
+    result = _new_result(pair_id)
+    result["error"] = reason
+    result["overall_status"] = f"Failed: {reason}"
+    return result
+
+
+def _ocr(id_card_path, gemini_model):
+    try:
+        return id_card_processor.extract_text_from_id(id_card_path, gemini_model)
+    except Exception as ocr_err:
+        traceback.print_exc()
+        return {"error": str(ocr_err)}
+
+
+def _detect_pair(id_card_path, live_face_path):
+    """Detector passes for one pair; nothing here raises."""
+    out = {"id_face": None, "id_info": None}
+    try:
+        out["id_face"], detector_used, confidence = id_card_processor.prepare_id_face(id_card_path)
+        out["id_info"] = f"Face detected by {detector_used} (confidence {confidence:.2f})."
+    except Exception as e:
+        out["id_info"] = f"Face extraction failed: {e}"
+    (out["live_passed"], out["live_msg"],
+     out["live_face"], out["live_detector"]) = face_verifier.liveness_and_live_face(live_face_path)
+    return out
+
+
+def _finish_pair(result, details, detected, id_embedding, live_embedding):
+    """Applies the pipeline's stage rules to one pair. Returns the record to store, or None."""
+    result["text_details"] = details
+    if "error" in details or "id_processing_error" in details:
+        err = details.get("error", details.get("id_processing_error", "Unknown OCR error"))
+        result["id_card_processing_status"] = f"Failed: {err}"
+        result["overall_status"] = "Failed: ID card OCR error."
+        return None
+    result["id_card_face_detection"] = detected["id_info"]
+    if id_embedding is None:
+        result["id_card_processing_status"] = f"Failed: {detected['id_info']}"
+        result["overall_status"] = "Failed: No face detected on ID card."
+        return None
+    result["id_card_processing_status"] = "Successfully processed ID card text and face."
+
+    result["liveness_check"] = {"passed": detected["live_passed"], "status": detected["live_msg"]}
+    if not detected["live_passed"]:
+        result["overall_status"] = "Failed: Liveness check failed."
+        return None
+
+    id_strong = {"face": detected["id_face"], "embedding": None}
+    passed, match_details = face_verifier.match_embeddings(
+        live_embedding, id_embedding, detected["live_detector"],
+        live_face=detected["live_face"], id_strong=id_strong,
+    )
+    match_details["status"] = match_details.get("message", "Unknown")
+    result["face_verification"] = match_details
+    if not passed:
+        result["overall_status"] = "Failed: Face verification failed."
+        return None
+    return details, id_embedding, id_strong
+
+
+def _embed(backend, faces, model_name=face_verifier.VERIFICATION_MODEL_NAME):
+    """represent_batch over the non-None faces; returns embeddings aligned with `faces`."""
+    present = [i for i, face in enumerate(faces) if face is not None]
+    embeddings = [None] * len(faces)
+    if present:
+        for i, embedding in zip(present, backend.represent_batch(
+            [faces[i] for i in present], model_name
+        )):
+            embeddings[i] = embedding
+    return embeddings
+
+
+def _strong_embeddings(backend, id_strongs):
+    """
+    Strong-model ID embeddings to store for /reverify, aligned with id_strongs
+    (see face_verifier.ensure_strong_embedding): the one an escalation already
+    computed, otherwise one batch over the remaining ID crops. None when
+    escalation is disabled, or for the batch when the deadline is near.
+    """
+    model = face_verifier.STRONG_MODEL_NAME
+    if face_verifier.ESCALATION_MARGIN <= 0:
+        return [None] * len(id_strongs)
+    stored = [s["embedding"] if s["embedding"] and s["embedding"].get("model") == model else None
+              for s in id_strongs]
+    if not deadline.allows_optional():
+        return stored
+    try:
+        computed = _embed(backend, [s["face"] if stored[i] is None else None for i, s in enumerate(id_strongs)],
+                          model)
+    except Exception as e_strong:
+        print(f"[Batch] Could not compute {model} ID embeddings: {e_strong}")
+        traceback.print_exc()
+        return stored
+    return [stored[i] or ({"model": model, "embedding": embedding} if embedding else None)
+            for i, embedding in enumerate(computed)]
+
+
+def run_batch(pairs, gemini_model):
+    """
+    Verifies [(pair_id, id_card_path, live_face_path)] and yields one result
+    dict per pair, then a summary. Files are left for the caller to remove.
+    Chunks that start after the deadline (BATCH_DEADLINE_SECONDS for
+    /batch/verify) fail straight away, and the pool threads see the caller's
+    deadline. Closing the generator (the client went away) cancels the
+    queued OCR and model work without waiting for it.
+    """
+    started = time.perf_counter()
+    counts = {"pairs": len(pairs), "success": 0, "failed": 0, "stored": 0}
+    backend = inference_backend.get_backend()
+
+    ocr_pool = ThreadPoolExecutor(BATCH_GEMINI_CONCURRENCY, thread_name_prefix="batch-ocr")
+    model_pool = ThreadPoolExecutor(BATCH_MODEL_WORKERS, thread_name_prefix="batch-model")
+    ocr = deadline.bind(_ocr)
+    ocr_futures = {}
+    detect_pair = deadline.bind(lambda pair: _detect_pair(pair[1], pair[2]))
+
+    def submit_ocr(start):
+        for index in range(start, min(start + BATCH_CHUNK_SIZE, len(pairs))):
+            if index not in ocr_futures:
+                ocr_futures[index] = ocr_pool.submit(ocr, pairs[index][1], gemini_model)
+
+    try:
+        for start in range(0, len(pairs), BATCH_CHUNK_SIZE):
+            chunk = pairs[start:start + BATCH_CHUNK_SIZE]
+            results = [_new_result(pair_id) for pair_id, _, _ in chunk]
+            try:
+                deadline.check("batch")
+                submit_ocr(start)
+                submit_ocr(start + BATCH_CHUNK_SIZE)
+                detected = list(model_pool.map(detect_pair, chunk))
+                id_embeddings = _embed(backend, [d["id_face"] for d in detected])
+                live_embeddings = _embed(backend, [d["live_face"] for d in detected])
+
+                to_store = []
+                for offset, result in enumerate(results):
+                    details = ocr_futures.pop(start + offset).result()
+                    record = _finish_pair(result, details, detected[offset],
+                                          id_embeddings[offset], live_embeddings[offset])
+                    if record is not None:
+                        to_store.append((offset, record))
+
+                strong = _strong_embeddings(backend, [id_strong for _, (_, _, id_strong) in to_store])
+                outcomes = db_storer.store_verified_users_batch(
+                    [(details, id_embedding, strong_embedding)
+                     for (_, (details, id_embedding, _)), strong_embedding in zip(to_store, strong)]
+                )
+                for (offset, _), (db_success, db_message, _superseded) in zip(to_store, outcomes):
+                    results[offset]["database_storage"] = {"stored": db_success, "message": db_message}
+                    counts["stored"] += int(db_success)
+                for offset, _ in to_store:
+                    result = results[offset]
+                    result["overall"] = "success"
+                    if result["database_storage"]["stored"]:
+                        result["overall_status"] = \
+                            "Success: Liveness, Face Verification, and Database Storage Passed."
+                    else:
+                        result["overall_status"] = \
+                            "Partial Success: Verification passed but database storage failed."
+            except Exception as e:
+                traceback.print_exc()
+                for result in results:
+                    if result["overall"] != "success":
+                        result["overall_status"] = f"Server Error: {str(e)}"
+
+            for result in results:
+                counts["success" if result["overall"] == "success" else "failed"] += 1
+                yield result
+    finally:
+        ocr_pool.shutdown(wait=False, cancel_futures=True)
+        model_pool.shutdown(wait=False, cancel_futures=True)
+
+    counts["seconds"] = round(time.perf_counter() - started, 2)
+    print(f"[Batch] {counts}")
+    yield {"summary": counts}
@@ -0,0 +1,308 @@
+# ml_logic/calibrate.py
+"""
+Offline threshold calibration for the face matcher over labelled pairs.
+
+  python -m ml_logic.calibrate <pairs.csv> [--model Facenet] [--out calibration_report]
+                               [--thresholds 0.35,0.40,0.45] [--no-cross] [--refresh]
+
+pairs.csv lists (ID card, selfie) pairs, paths relative to the CSV file;
+card_type and subject are optional:
+
+  id_card,live_face,label,card_type,subject
+  alice/id.jpg,alice/selfie.jpg,genuine,Aadhaar card,alice
+  bob/id.jpg,carol/selfie.jpg,impostor,PAN card,
+
+Each ID card and selfie is detected and embedded once, with the same
+preprocessing as the pipeline (CLAHE on the ID side), in batches through
+represent_batch. Embeddings are cached on disk in CALIBRATION_CACHE_DIR, keyed
+by file content, side, model and detector/backend settings, so re-running
+after a reporting change takes seconds and a model change only re-embeds.
+--refresh ignores the cache (e.g. after a preprocessing change).
+
+Distances come from one ID × selfie cosine matrix. Besides the labelled
+impostor rows, every genuine ID card against every other subject's genuine
+selfie counts as an impostor pair (--no-cross to disable; the subject
+defaults to the ID card's directory).
+
+The JSON report covers all pairs, then each card type, ID-side detector and
+selfie-side detector. For each it gives the EER, FAR/FRR at the candidate
+thresholds (the configured one, DeepFace's standard one and --thresholds),
+and the thresholds that reach FAR 1% and 0.1%. ROC / DET curves are written
+as CSV to --out, plus PNG when matplotlib is installed. Apply a new threshold
+with FACE_MATCH_THRESHOLD (or STRONG_MODEL_THRESHOLD for --model ArcFace).
+"""
+import csv
+import hashlib
+import json
+import os
+import re
+
+import numpy as np
+
+from ml_logic import face_detector
+from ml_logic import face_verifier
+from ml_logic import id_card_processor
+from ml_logic import inference_backend
+
+CALIBRATION_CACHE_DIR  = os.getenv("CALIBRATION_CACHE_DIR", "calibration_cache")
+CALIBRATION_BATCH_SIZE = int(os.getenv("CALIBRATION_BATCH_SIZE", "32"))
+# Cross impostor pairs beyond this are sampled (fixed seed) to bound memory.
+CALIBRATION_MAX_CROSS_PAIRS = int(os.getenv("CALIBRATION_MAX_CROSS_PAIRS", "5000000"))
+
+# Cosine distance grid the curves are evaluated on.
+THRESHOLD_GRID = np.round(np.arange(0.0, 2.0005, 0.001), 3)
+TARGET_FARS = (0.01, 0.001)
+
+
+# ── Pairs ─────────────────────────────────────────────────────────────────────
+def load_pairs(csv_path):
+    """Rows of pairs.csv with absolute paths; label is 'genuine' or 'impostor'."""
+    base = os.path.dirname(os.path.abspath(csv_path))
+    pairs = []
+    with open(csv_path, newline="") as f:
+        for line, row in enumerate(csv.DictReader(f), start=2):
+            label = (row.get("label") or "").strip().lower()
+            if label not in ("genuine", "impostor"):
+                raise SystemExit(f"{csv_path}:{line}: label must be 'genuine' or 'impostor'")
+            id_card = os.path.join(base, row["id_card"].strip())
+            pairs.append({
+                "id_card": id_card,
+                "live_face": os.path.join(base, row["live_face"].strip()),
+                "genuine": label == "genuine",
+                "card_type": (row.get("card_type") or "").strip() or "unknown",
+                "subject": (row.get("subject") or "").strip() or os.path.dirname(id_card),
+            })
+    return pairs
+
+
+# ── Embedding with an on-disk cache ───────────────────────────────────────────
+def _settings_fingerprint(model_name):
+    return "|".join(str(v) for v in (
+        model_name, inference_backend.INFERENCE_BACKEND, inference_backend.INFERENCE_PRECISION,
+        face_detector.FAST_DETECTOR_BACKEND, face_detector.FALLBACK_DETECTOR_BACKEND,
+        face_detector.DETECTOR_CASCADE_ENABLED, face_detector.DETECTION_MAX_SIDE,
+    ))
+
+
+def _cache_path(image_path, side, model_name):
+    digest = hashlib.sha256()
+    with open(image_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    digest.update(f"|{side}|{_settings_fingerprint(model_name)}".encode())
+    return os.path.join(CALIBRATION_CACHE_DIR, f"{digest.hexdigest()}.npz")
+
+
+def _detect(image_path, side):
+    """(face_bgr_uint8, detector_used) as the pipeline embeds it; raises ValueError without a face."""
+    if side == "id":
+        face, detector_used, _ = id_card_processor.prepare_id_face(image_path)
+        return face, detector_used
+    faces, detector_used = face_detector.detect_faces(image_path)
+    face = (faces[0]["face"] * 255).astype(np.uint8)[:, :, ::-1].copy()
+    return face, detector_used
+
+
+def _flush(pending, model_name, results):
+    if not pending:
+        return
+    embeddings = inference_backend.get_backend().represent_batch([face for _, _, face, _ in pending], model_name)
+    for (path, cache_file, _, detector_used), embedding in zip(pending, embeddings):
+        embedding = np.asarray(embedding, dtype=np.float64)
+        np.savez(cache_file, embedding=embedding, detector=np.array(detector_used))
+        results[path] = (embedding, detector_used)
+    pending.clear()
+
+
+def embed_images(image_paths, side, model_name, refresh=False):
+    """
+    {path: (embedding or None, detector or None)} for one side ('id' | 'live').
+    Images without a detectable face are cached too, with an empty embedding.
+    """
+    os.makedirs(CALIBRATION_CACHE_DIR, exist_ok=True)
+    results, pending, hits = {}, [], 0
+    for n, path in enumerate(image_paths, start=1):
+        cache_file = _cache_path(path, side, model_name)
+        if not refresh and os.path.exists(cache_file):
+            with np.load(cache_file) as cached:
+                embedding, detector_used = cached["embedding"], str(cached["detector"])
+            results[path] = (embedding, detector_used) if embedding.size else (None, None)
+            hits += 1
+            continue
+        try:
+            face, detector_used = _detect(path, side)
+        except ValueError as e_detect:
+            print(f"  [{side}] no face in {path}: {e_detect}")
+            np.savez(cache_file, embedding=np.zeros(0), detector=np.array(""))
+            results[path] = (None, None)
+            continue
+        pending.append((path, cache_file, face, detector_used))
+        if len(pending) >= CALIBRATION_BATCH_SIZE:
+            _flush(pending, model_name, results)
+            print(f"  [{side}] {n}/{len(image_paths)} images")
+    _flush(pending, model_name, results)
+    print(f"  [{side}] {len(image_paths)} images, {hits} from cache")
+    return results
+
+
+# ── Scores and rates ──────────────────────────────────────────────────────────
+def _normalised(vectors):
+    matrix = np.stack(vectors)
+    return matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+
+
+def score_pairs(pairs, id_results, live_results, cross=True, rng=None):
+    """
+    Distances of every scored pair plus their attributes, as parallel arrays:
+    {"distance", "genuine", "card_type", "id_detector", "live_detector"}.
+    Also returns the number of pairs with no face on either side.
+    """
+    id_paths = sorted(p for p, (emb, _) in id_results.items() if emb is not None)
+    live_paths = sorted(p for p, (emb, _) in live_results.items() if emb is not None)
+    id_index = {p: i for i, p in enumerate(id_paths)}
+    live_index = {p: i for i, p in enumerate(live_paths)}
+    usable = [p for p in pairs if p["id_card"] in id_index and p["live_face"] in live_index]
+    if not usable:
+        raise SystemExit("No pair has a detectable face on both sides")
+
+    distances = 1.0 - _normalised([id_results[p][0] for p in id_paths]) @ \
+        _normalised([live_results[p][0] for p in live_paths]).T
+    id_detectors = np.array([id_results[p][1] for p in id_paths], dtype=object)
+    live_detectors = np.array([live_results[p][1] for p in live_paths], dtype=object)
+
+    rows = np.array([id_index[p["id_card"]] for p in usable])
+    cols = np.array([live_index[p["live_face"]] for p in usable])
+    scored = {
+        "distance": distances[rows, cols],
+        "genuine": np.array([p["genuine"] for p in usable]),
+        "card_type": np.array([p["card_type"] for p in usable], dtype=object),
+        "id_detector": id_detectors[rows],
+        "live_detector": live_detectors[cols],
+    }
+
+    genuine = [p for p in usable if p["genuine"]]
+    if cross and len(genuine) > 1:
+        g_rows = np.array([id_index[p["id_card"]] for p in genuine])
+        g_cols = np.array([live_index[p["live_face"]] for p in genuine])
+        subjects = np.array([p["subject"] for p in genuine], dtype=object)
+        ii, jj = np.nonzero(subjects[:, None] != subjects[None, :])
+        if len(ii) > CALIBRATION_MAX_CROSS_PAIRS:
+            keep = (rng or np.random.default_rng(0)).choice(len(ii), CALIBRATION_MAX_CROSS_PAIRS, replace=False)
+            ii, jj = ii[keep], jj[keep]
+        card_types = np.array([p["card_type"] for p in genuine], dtype=object)
+        cross_scored = {
+            "distance": distances[g_rows[ii], g_cols[jj]],
+            "genuine": np.zeros(len(ii), dtype=bool),
+            "card_type": card_types[ii],
+            "id_detector": id_detectors[g_rows[ii]],
+            "live_detector": live_detectors[g_cols[jj]],
+        }
+        scored = {k: np.concatenate([scored[k], cross_scored[k]]) for k in scored}
+        print(f"  {len(ii)} cross impostor pairs added")
+    return scored, len(pairs) - len(usable)
+
+
+def error_rates(genuine, impostor, thresholds=THRESHOLD_GRID):
+    """(FAR, FRR) arrays at each threshold; a pair is accepted when distance <= threshold."""
+    far = np.searchsorted(np.sort(impostor), thresholds, side="right") / len(impostor)
+    frr = 1.0 - np.searchsorted(np.sort(genuine), thresholds, side="right") / len(genuine)
+    return far, frr
+
+
+def summarise(genuine, impostor, candidates):
+    far, frr = error_rates(genuine, impostor)
+    eer_at = int(np.argmin(np.abs(far - frr)))
+    at_far = {}
+    for target in TARGET_FARS:
+        idx = int(np.searchsorted(far, target, side="right")) - 1
+        at_far[str(target)] = None if idx < 0 else {
+            "threshold": float(THRESHOLD_GRID[idx]), "frr": round(float(frr[idx]), 5),
+        }
+    cand_far, cand_frr = error_rates(genuine, impostor, np.array(candidates))
+    return {
+        "genuine_pairs": int(len(genuine)),
+        "impostor_pairs": int(len(impostor)),
+        "eer": round(float((far[eer_at] + frr[eer_at]) / 2), 5),
+        "eer_threshold": float(THRESHOLD_GRID[eer_at]),
+        "at_thresholds": {
+            f"{t:.4f}": {"far": round(float(a), 5), "frr": round(float(r), 5)}
+            for t, a, r in zip(candidates, cand_far, cand_frr)
+        },
+        "threshold_at_far": at_far,
+    }, (far, frr)
+
+
+# ── Report ────────────────────────────────────────────────────────────────────
+def _write_curves(out_dir, group, far, frr):
+    name = re.sub(r"[^A-Za-z0-9_.-]+", "_", group)
+    with open(os.path.join(out_dir, f"curve_{name}.csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["threshold", "far", "frr", "tar"])
+        for t, a, r in zip(THRESHOLD_GRID, far, frr):
+            writer.writerow([f"{t:.3f}", f"{a:.6f}", f"{r:.6f}", f"{1 - r:.6f}"])
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+    except ImportError:
+        return
+    fig, (roc, det) = plt.subplots(1, 2, figsize=(10, 4))
+    roc.plot(far, 1 - frr)
+    roc.set(xscale="log", xlabel="FAR", ylabel="TAR", title=f"ROC — {group}")
+    det.plot(far, frr)
+    det.set(xscale="log", yscale="log", xlabel="FAR", ylabel="FRR", title=f"DET — {group}")
+    fig.tight_layout()
+    fig.savefig(os.path.join(out_dir, f"curve_{name}.png"))
+    plt.close(fig)
+
+
+def calibration_report(csv_path, model_name=face_verifier.VERIFICATION_MODEL_NAME, out_dir="calibration_report",
+                       extra_thresholds=(), cross=True, refresh=False):
+    pairs = load_pairs(csv_path)
+    print(f"Calibrating {model_name} on {len(pairs)} labelled pairs")
+    id_results = embed_images(sorted({p["id_card"] for p in pairs}), "id", model_name, refresh)
+    live_results = embed_images(sorted({p["live_face"] for p in pairs}), "live", model_name, refresh)
+    scored, unusable = score_pairs(pairs, id_results, live_results, cross=cross)
+
+    configured = (face_verifier.STRONG_MODEL_THRESHOLD if model_name == face_verifier.STRONG_MODEL_NAME
+                  else face_verifier.CUSTOM_SYSTEM_THRESHOLD)
+    candidates = sorted({configured, *extra_thresholds})
+    if model_name == face_verifier.VERIFICATION_MODEL_NAME:
+        candidates = sorted({*candidates, face_verifier.get_standard_deepface_threshold()})
+
+    os.makedirs(out_dir, exist_ok=True)
+    report = {"model": model_name, "configured_threshold": configured,
+              "pairs_without_face": unusable, "groups": {}}
+    groups = [("all", np.ones(len(scored["distance"]), dtype=bool))]
+    for attribute in ("card_type", "id_detector", "live_detector"):
+        groups += [(f"{attribute}={value}", scored[attribute] == value)
+                   for value in sorted(set(scored[attribute]))]
+    for group, mask in groups:
+        genuine = scored["distance"][mask & scored["genuine"]]
+        impostor = scored["distance"][mask & ~scored["genuine"]]
+        if not len(genuine) or not len(impostor):
+            report["groups"][group] = {"genuine_pairs": int(len(genuine)), "impostor_pairs": int(len(impostor)),
+                                       "note": "needs both genuine and impostor pairs"}
+            continue
+        report["groups"][group], (far, frr) = summarise(genuine, impostor, candidates)
+        _write_curves(out_dir, group, far, frr)
+
+    with open(os.path.join(out_dir, "report.json"), "w") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(prog="python -m ml_logic.calibrate",
+                                     description="FAR/FRR, EER and ROC/DET curves over labelled pairs.")
+    parser.add_argument("pairs_csv")
+    parser.add_argument("--model", default=face_verifier.VERIFICATION_MODEL_NAME)
+    parser.add_argument("--out", default="calibration_report")
+    parser.add_argument("--thresholds", default="", help="extra candidate thresholds, comma-separated")
+    parser.add_argument("--no-cross", action="store_true", help="only score the labelled impostor rows")
+    parser.add_argument("--refresh", action="store_true", help="ignore cached embeddings")
+    args = parser.parse_args()
+    extra = [float(t) for t in args.thresholds.split(",") if t.strip()]
+    print(json.dumps(calibration_report(args.pairs_csv, args.model, args.out, extra,
+                                        cross=not args.no_cross, refresh=args.refresh), indent=2))
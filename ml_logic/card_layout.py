@@ -0,0 +1,148 @@
+# ml_logic/card_layout.py
+"""
+Card rectification and per-card-type face regions for the ID-card detector.
+
+The face detectors used to see the whole ID card photo. On Aadhaar, PAN,
+Voter ID and Driving Licence cards the holder's photo sits in a fairly fixed
+part of the card, so:
+
+  1. find the card outline (largest convex 4-point contour) in a downscaled
+     copy of the photo,
+  2. warp it flat to a landscape ID-1 rectangle (perspective transform on the
+     full-resolution pixels),
+  3. crop the photo region from FACE_REGIONS for the OCR'd card type.
+
+The outline alone does not say which way up the card is: _order_corners
+makes the long edge horizontal, so a card photographed sideways or upside
+down comes out either upright or rotated by 180°. face_search_images()
+therefore returns the region of the upright card and then the same region of
+the card turned by 180°.
+
+id_card_processor.prepare_id_face runs the detector cascade on those crops in
+order and falls back to the full image when there is no card outline, no
+template for the card type, or no face in either crop. For an unknown card
+type the whole rectified card (both ways up) is searched, which still takes
+the skew out of the photo.
+"""
+import numpy as np
+import os
+
+# cv2 is imported where it is used so that importing this module stays cheap.
+
+# --- Configuration ---
+CARD_LAYOUT_ENABLED        = os.getenv("CARD_LAYOUT_ENABLED", "true").lower() in ("1", "true", "yes")
+# Longest side (px) of the copy the outline is searched on.
+CARD_OUTLINE_MAX_SIDE      = int(os.getenv("CARD_OUTLINE_MAX_SIDE", "640"))
+# The outline must cover at least this fraction of the photo.
+CARD_MIN_AREA_FRACTION     = float(os.getenv("CARD_MIN_AREA_FRACTION", "0.20"))
+# Width limits (px) of the rectified card; the warp keeps the photo's own resolution in between.
+CARD_RECTIFIED_MIN_WIDTH   = int(os.getenv("CARD_RECTIFIED_MIN_WIDTH", "640"))
+CARD_RECTIFIED_MAX_WIDTH   = int(os.getenv("CARD_RECTIFIED_MAX_WIDTH", "1600"))
+
+# ISO/IEC 7810 ID-1 (85.60 x 53.98 mm), the size of every card below.
+CARD_ASPECT = 85.60 / 53.98
+
+# card_type (as returned by OCR) → photo region on the rectified landscape card,
+# as (x0, y0, x1, y1) fractions of its width and height. Regions are generous:
+# they have to cover old and new layouts and some slack in the outline.
+FACE_REGIONS = {
+    'Aadhaar card':    (0.00, 0.15, 0.42, 0.95),
+    'PAN card':        (0.00, 0.25, 0.40, 1.00),
+    'Voter ID':        (0.00, 0.15, 0.45, 0.95),
+    'Driving License': (0.00, 0.10, 0.45, 1.00),
+}
+
+
+def face_region(card_type):
+    """FACE_REGIONS entry for an OCR card_type (case-insensitive), or None."""
+    if not card_type:
+        return None
+    wanted = card_type.strip().lower()
+    for name, region in FACE_REGIONS.items():
+        if name.lower() == wanted:
+            return region
+    return None
+
+
+def _order_corners(quad):
+    """Orders four (x, y) points as top-left, top-right, bottom-right, bottom-left."""
+    pts = np.asarray(quad, dtype=np.float32).reshape(4, 2)
+    s, d = pts.sum(axis=1), np.diff(pts, axis=1).ravel()
+    ordered = np.array([pts[np.argmin(s)], pts[np.argmin(d)], pts[np.argmax(s)], pts[np.argmax(d)]],
+                       dtype=np.float32)
+    top = np.linalg.norm(ordered[1] - ordered[0])
+    side = np.linalg.norm(ordered[3] - ordered[0])
+    if side > top:
+        # Card photographed on its side: start from the bottom-left so the long edge is the top.
+        ordered = np.roll(ordered, 1, axis=0)
+    return ordered
+
+
+def find_card_quad(img):
+    """
+    Corners of the card in a BGR image (full-resolution coordinates, ordered
+    by _order_corners), or None when no plausible outline is found.
+    """
+    import cv2
+    h, w = img.shape[:2]
+    scale = min(1.0, CARD_OUTLINE_MAX_SIDE / float(max(h, w)))
+    small = cv2.resize(img, (max(1, round(w * scale)), max(1, round(h * scale))),
+                       interpolation=cv2.INTER_AREA) if scale < 1.0 else img
+
+    gray = cv2.GaussianBlur(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), (5, 5), 0)
+    edges = cv2.Canny(gray, 50, 150)
+    edges = cv2.dilate(edges, np.ones((3, 3), np.uint8), iterations=1)
+    contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    min_area = CARD_MIN_AREA_FRACTION * small.shape[0] * small.shape[1]
+    for contour in sorted(contours, key=cv2.contourArea, reverse=True):
+        if cv2.contourArea(contour) < min_area:
+            break
+        approx = cv2.approxPolyDP(contour, 0.02 * cv2.arcLength(contour, True), True)
+        if len(approx) == 4 and cv2.isContourConvex(approx):
+            return _order_corners(approx.reshape(4, 2) / scale)
+    return None
+
+
+def rectify(img, quad):
+    """Warps the card inside `quad` to a flat landscape CARD_ASPECT rectangle."""
+    import cv2
+    top = np.linalg.norm(quad[1] - quad[0])
+    bottom = np.linalg.norm(quad[2] - quad[3])
+    width = int(min(CARD_RECTIFIED_MAX_WIDTH, max(CARD_RECTIFIED_MIN_WIDTH, top, bottom)))
+    height = int(round(width / CARD_ASPECT))
+    target = np.array([[0, 0], [width - 1, 0], [width - 1, height - 1], [0, height - 1]], dtype=np.float32)
+    homography = cv2.getPerspectiveTransform(quad.astype(np.float32), target)
+    return cv2.warpPerspective(img, homography, (width, height), flags=cv2.INTER_CUBIC)
+
+
+def _search_crop(card, card_type):
+    region = face_region(card_type)
+    if region is None:
+        return card, f"rectified card ({card_type or 'unknown type'}: no template)"
+    h, w = card.shape[:2]
+    x0, y0, x1, y1 = region
+    roi = card[int(y0 * h):int(y1 * h), int(x0 * w):int(x1 * w)]
+    return roi, f"{card_type} photo region ({100 * (x1 - x0) * (y1 - y0):.0f}% of card)"
+
+
+def face_search_images(img, card_type):
+    """
+    The parts of the ID card photo the face detector should search first, in order.
+
+    Returns:
+        (candidates, reason) — candidates is [(image, description)]: BGR crops
+        of the rectified card (the template region for card_type, or the
+        whole card when there is no template), upright and then rotated by
+        180°. Empty, with the reason, when the card outline could not be found.
+    """
+    import cv2
+    if not CARD_LAYOUT_ENABLED:
+        return [], "card layout disabled"
+    quad = find_card_quad(img)
+    if quad is None:
+        return [], "no card outline found"
+    card = rectify(img, quad)
+    upright, where = _search_crop(card, card_type)
+    flipped, _ = _search_crop(cv2.rotate(card, cv2.ROTATE_180), card_type)
+    return [(upright, where), (flipped, f"{where}, card rotated 180°")], where
@@ -1,13 +1,30 @@
 #---------------------------------------LOCAL----------------------------------------------
 
 # ml_logic/db_storer.py
-import psycopg2
-from psycopg2 import sql
+# psycopg2 is imported inside the functions that talk to Postgres so that
+# importing this module (and therefore app.py) does not load the driver.
+import datetime
+import threading
 import traceback
 import os
 import re
+import time
 import json # To store embedding as JSON string
 
+from ml_logic import deadline
+from ml_logic import ttl_cache
+
+# Runs pending migrations from the first write instead of failing (local development only).
+DB_AUTO_MIGRATE = os.getenv("DB_AUTO_MIGRATE", "0") == "1"
+
+# Per-process cache of stored embeddings for /reverify (see get_stored_embedding).
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "300"))
+USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", "10000"))
+
+_schema_ready = False
+_schema_lock = threading.Lock()
+_stored_embeddings = ttl_cache.TTLCache(USER_CACHE_MAX_ENTRIES, USER_CACHE_TTL_SECONDS)
+
 def get_db_connection_params():
     """Retrieves database connection parameters from environment variables."""
     return {
@@ -18,50 +35,205 @@ def get_db_connection_params():
         "password": os.getenv("DB_PASSWORD", "root")
     }
 
-def create_user_table_if_not_exists():
-    """Creates the user_id_details table if it doesn't already exist."""
-    conn = None
-    cur = None
+def _connect(stage="storage"):
+    """
+    psycopg2 connection. Inside a request deadline the connect and every
+    statement are capped at the time left (connect_timeout, statement_timeout),
+    and DeadlineExceeded(stage) is raised if it has already passed.
+    """
+    import psycopg2
     params = get_db_connection_params()
-    try:
-        conn = psycopg2.connect(**params)
-        cur = conn.cursor()
-        create_table_query = """
-        CREATE TABLE IF NOT EXISTS user_id_details (
-            id SERIAL PRIMARY KEY,
-            card_type VARCHAR(50),
-            name VARCHAR(255),
-            dob VARCHAR(20),
-            aadhaar_no VARCHAR(50) UNIQUE,      -- For Aadhaar
-            pan_no VARCHAR(50) UNIQUE,          -- For PAN
-            license_no VARCHAR(50) UNIQUE,      -- For Driving License
-            voter_id_number VARCHAR(50) UNIQUE, -- For Voter ID
-            expiration_date VARCHAR(20),        -- For Driving License
-            father_mother_name VARCHAR(255),
-            face_embedding TEXT,                -- Storing as JSON string
-            registration_timestamp TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
-        );
-        """
-        cur.execute(create_table_query)
-        conn.commit()
-        print("Table 'user_id_details' checked/created successfully.")
-    except psycopg2.Error as db_err:
-        print(f"Database error during table creation: {db_err}")
-        traceback.print_exc()
-    except Exception as e:
-        print(f"An unexpected error occurred during table creation: {e}")
-        traceback.print_exc()
-    finally:
-        if cur: cur.close()
-        if conn: conn.close()
+    if deadline.current() is not None:
+        deadline.check(stage)
+        budget = deadline.call_timeout()
+        params["connect_timeout"] = max(1, int(budget))
+        params["options"] = f"-c statement_timeout={int(budget * 1000)}"
+    return psycopg2.connect(**params)
+
+def ensure_schema():
+    """
+    Checks once per process that the database is at migrations.LATEST_VERSION;
+    raises RuntimeError otherwise. Only a passing check is cached, so a worker
+    started ahead of its migration recovers once the migration has run.
+    Workers never run DDL unless DB_AUTO_MIGRATE=1 (local development).
+    """
+    global _schema_ready
+    if _schema_ready:
+        return
+    from ml_logic import migrations
+    with _schema_lock:
+        if _schema_ready:
+            return
+        version = migrations.schema_version()
+        if version < migrations.LATEST_VERSION and DB_AUTO_MIGRATE:
+            migrations.migrate()
+            version = migrations.schema_version()
+        if version < migrations.LATEST_VERSION:
+            raise RuntimeError(
+                f"Database schema is at version {version}, expected {migrations.LATEST_VERSION}; "
+                "run 'python -m ml_logic.migrations'."
+            )
+        _schema_ready = True
+
+USER_COLUMNS = ("card_type", "name", "dob", "aadhaar_no", "pan_no", "license_no",
+                "voter_id_number", "expiration_date", "father_mother_name", "face_embedding",
+                "face_embedding_strong", "verified_at")
+
+# Outcome message for a row not written because its document already holds a
+# newer verification; final, retrying it would not change anything.
+SUPERSEDED_MESSAGE = "Not stored: a newer verification of this document is already stored."
+
+# card_type → (user_documents.doc_type, user_id_details column holding the number)
+DOCUMENT_TYPES = {
+    'Aadhaar card':    ('aadhaar', 'aadhaar_no'),
+    'Voter ID':        ('voter_id', 'voter_id_number'),
+    'PAN card':        ('pan', 'pan_no'),
+    'Driving License': ('license', 'license_no'),
+}
+
+def _prepare_user_row(extracted_details, id_face_embedding_list, strong_embedding=None, verified_at=None):
+    """
+    Cleans the OCR fields into a row for user_id_details: a dict with every
+    USER_COLUMNS key plus doc_type / doc_number (both None when the card has
+    no usable document number). verified_at (epoch seconds, default now) is
+    when the verification ran; an older verification never replaces a newer one.
+    """
+    # Prepare data from extracted_details
+    row = {
+        "card_type": extracted_details.get("card_type"),
+        "name": extracted_details.get("name"),
+        "dob": extracted_details.get("dob"),
+        "expiration_date": extracted_details.get("expiration_date"),
+        "father_mother_name": extracted_details.get("father_mother_name"),
+        # Convert embedding list to JSON string for storage
+        "face_embedding": json.dumps(id_face_embedding_list),
+        # {"model", "embedding"} from the escalation model, if it was computed
+        "face_embedding_strong": json.dumps(strong_embedding) if strong_embedding else None,
+        "verified_at": datetime.datetime.fromtimestamp(
+            verified_at if verified_at is not None else time.time(), datetime.timezone.utc),
+    }
+
+    # Standardize and clean ID numbers
+    aadhaar_no = extracted_details.get("aadhaar_no")
+    if aadhaar_no: aadhaar_no = re.sub(r'\s+', '', str(aadhaar_no))
+
+    pan_no = extracted_details.get("pan_no")
+    if pan_no: pan_no = re.sub(r'\s+', '', str(pan_no))
+
+    license_no = extracted_details.get("license_no")
+    # Add more specific cleaning for license_no if needed
+    if license_no: license_no = re.sub(r'\s+', '', str(license_no)).upper()
+
+    voter_id_number = extracted_details.get("voter_id_number")
+    if voter_id_number: voter_id_number = re.sub(r'\s+', '', str(voter_id_number)).upper()
+
+    row.update(aadhaar_no=aadhaar_no, pan_no=pan_no, license_no=license_no, voter_id_number=voter_id_number)
+
+    # The card type's own document number is the identity key
+    doc_type, column = DOCUMENT_TYPES.get(row["card_type"], (None, None))
+    row["doc_type"] = doc_type if column and row[column] else None
+    row["doc_number"] = row[column] if row["doc_type"] else None
+    return row
+
+_INSERT_COLUMNS = ", ".join(USER_COLUMNS) + ", dob_date, expiry_date"
+
+# On an existing document only the card-independent fields change; the
+# document column already holds this number. A row verified before the stored
+# one (e.g. a retried write-behind record) leaves it alone.
+_UPSERT_SET_CLAUSE = """
+        card_type = EXCLUDED.card_type,
+        name = EXCLUDED.name,
+        dob = EXCLUDED.dob,
+        dob_date = EXCLUDED.dob_date,
+        expiration_date = EXCLUDED.expiration_date,
+        expiry_date = EXCLUDED.expiry_date,
+        father_mother_name = EXCLUDED.father_mother_name,
+        face_embedding = EXCLUDED.face_embedding,
+        face_embedding_strong = EXCLUDED.face_embedding_strong,
+        verified_at = EXCLUDED.verified_at,
+        registration_timestamp = CURRENT_TIMESTAMP
+    WHERE user_id_details.verified_at IS NULL
+       OR user_id_details.verified_at <= EXCLUDED.verified_at"""
+
+# Finds the owner of (doc_type, doc_number), or claims the document for a new
+# user id from the sequence; the id is only allocated when the document is
+# new, so re-registrations do not use up the SERIAL. The user row is then
+# inserted or updated on the fixed primary key. The user_documents FK is
+# deferred to commit, so the document row may be written before its user row.
+# If another transaction registers the same document in between, the claim
+# does nothing and no row is returned; _write_user_row then runs it again.
+# A row skipped as older than the stored one comes back as (NULL, NULL).
+_UPSERT_BY_DOCUMENT = """
+    WITH existing AS (
+        SELECT user_id FROM user_documents
+        WHERE doc_type = %(doc_type)s AND doc_number = %(doc_number)s
+    ), claimed AS (
+        INSERT INTO user_documents (doc_type, doc_number, user_id)
+        SELECT %(doc_type)s, %(doc_number)s, nextval(pg_get_serial_sequence('user_id_details', 'id'))
+        WHERE NOT EXISTS (SELECT 1 FROM existing)
+        ON CONFLICT (doc_type, doc_number) DO NOTHING
+        RETURNING user_id
+    ), doc AS (
+        SELECT user_id FROM existing
+        UNION ALL
+        SELECT user_id FROM claimed
+    ), written AS (
+        INSERT INTO user_id_details (id, """ + _INSERT_COLUMNS + """)
+        SELECT doc.user_id, %(card_type)s, %(name)s, %(dob)s, %(aadhaar_no)s, %(pan_no)s, %(license_no)s,
+               %(voter_id_number)s, %(expiration_date)s, %(father_mother_name)s, %(face_embedding)s,
+               %(face_embedding_strong)s, %(verified_at)s,
+               votechain_parse_date(%(dob)s), votechain_parse_date(%(expiration_date)s)
+        FROM doc
+        ON CONFLICT (id) DO UPDATE SET
+        """ + _UPSERT_SET_CLAUSE + """
+        RETURNING id, (xmax = 0) AS inserted
+    )
+    SELECT written.id, written.inserted
+    FROM doc LEFT JOIN written ON written.id = doc.user_id;
+    """
+
+# For a voting system, a unique ID (Aadhaar, Voter ID) should be enforced.
+# If allowing other cards, a robust unique key strategy is needed.
+# For now, we'll proceed with a plain insert if there is no document number.
+_INSERT_WITHOUT_DOCUMENT = """
+    INSERT INTO user_id_details (""" + _INSERT_COLUMNS + """)
+    VALUES (%(card_type)s, %(name)s, %(dob)s, %(aadhaar_no)s, %(pan_no)s, %(license_no)s,
+            %(voter_id_number)s, %(expiration_date)s, %(father_mother_name)s, %(face_embedding)s,
+            %(face_embedding_strong)s, %(verified_at)s,
+            votechain_parse_date(%(dob)s), votechain_parse_date(%(expiration_date)s))
+    RETURNING id, TRUE;
+    """
 
-def store_verified_user_details(extracted_details, id_face_embedding_list):
+def _write_user_row(cur, row):
+    """
+    Runs the UPSERT (or plain INSERT) for one prepared row. Returns (user id,
+    inserted), or None when the stored row is a newer verification (superseded).
+    """
+    if row["doc_type"] is None and row["name"]: # Fallback to name if no clear ID, less ideal
+        print(f"Warning: No clear unique ID field for {row['card_type']}. This might lead to issues if name is not unique.")
+    cur.execute(_UPSERT_BY_DOCUMENT if row["doc_type"] else _INSERT_WITHOUT_DOCUMENT, row)
+    written = cur.fetchone()
+    if written is None and row["doc_type"]:
+        # Lost a race to claim a new document; its owner is visible to a new statement.
+        cur.execute(_UPSERT_BY_DOCUMENT, row)
+        written = cur.fetchone()
+    if written is None or written[0] is None:
+        return None
+    return written
+
+def _stored_message(name, row_id, inserted):
+    action = "stored" if inserted else "updated"
+    return f"User details for '{name}' (ID: {row_id}) {action} successfully."
+
+def store_verified_user_details(extracted_details, id_face_embedding_list, strong_embedding=None):
     """
     Stores the extracted text details and the ID face embedding into the database.
-    Uses UPSERT logic based on the card type's unique identifier.
+    Uses UPSERT logic keyed on the card's (doc_type, doc_number) in user_documents.
     Args:
         extracted_details (dict): Dictionary of text details from OCR.
         id_face_embedding_list (list): The face embedding from the ID card.
+        strong_embedding (dict): Optional {"model", "embedding"} of the ID face
+            from the escalation model (face_verifier.strong_embedding).
     Returns:
         bool: True if storage was successful, False otherwise.
         str: Message indicating success or failure.
@@ -74,108 +246,33 @@ def store_verified_user_details(extracted_details, id_face_embedding_list):
         # For a voting system, embedding is likely mandatory.
         return False, "Cannot store: ID face embedding is missing."
 
+    import psycopg2
+
     conn = None
     cur = None
-    params = get_db_connection_params()
     success = False
     message = "Storage failed."
 
     try:
-        conn = psycopg2.connect(**params)
+        ensure_schema()
+        conn = _connect()
         cur = conn.cursor()
 
-        # Prepare data from extracted_details
-        card_type = extracted_details.get("card_type")
-        name = extracted_details.get("name")
-        dob = extracted_details.get("dob")
-        
-        # Standardize and clean ID numbers
-        aadhaar_no = extracted_details.get("aadhaar_no")
-        if aadhaar_no: aadhaar_no = re.sub(r'\s+', '', str(aadhaar_no))
-
-        pan_no = extracted_details.get("pan_no")
-        if pan_no: pan_no = re.sub(r'\s+', '', str(pan_no))
-
-        license_no = extracted_details.get("license_no")
-        # Add more specific cleaning for license_no if needed
-        if license_no: license_no = re.sub(r'\s+', '', str(license_no)).upper()
-
-
-        voter_id_number = extracted_details.get("voter_id_number")
-        if voter_id_number: voter_id_number = re.sub(r'\s+', '', str(voter_id_number)).upper()
-        
-        expiration_date = extracted_details.get("expiration_date")
-        father_mother_name = extracted_details.get("father_mother_name")
-        
-        # Convert embedding list to JSON string for storage
-        face_embedding_json = json.dumps(id_face_embedding_list)
-
-        # Determine conflict target for UPSERT
-        conflict_target_column_name = None
-        if card_type == 'Aadhaar card' and aadhaar_no:
-            conflict_target_column_name = 'aadhaar_no'
-        elif card_type == 'Voter ID' and voter_id_number:
-            conflict_target_column_name = 'voter_id_number'
-        elif card_type == 'PAN card' and pan_no:
-            conflict_target_column_name = 'pan_no'
-        elif card_type == 'Driving License' and license_no:
-            conflict_target_column_name = 'license_no'
-        
-        if conflict_target_column_name is None and name: # Fallback to name if no clear ID, less ideal
-            print(f"Warning: No clear unique ID field for {card_type}. This might lead to issues if name is not unique.")
-            # For a voting system, a unique ID (Aadhaar, Voter ID) should be enforced.
-            # If allowing other cards, a robust unique key strategy is needed.
-            # For now, we'll proceed with a plain insert if no conflict target.
-            insert_query_plain = sql.SQL("""
-             INSERT INTO user_id_details
-             (card_type, name, dob, aadhaar_no, pan_no, license_no, voter_id_number, expiration_date, father_mother_name, face_embedding)
-             VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING id;
-             """)
-            cur.execute(insert_query_plain, (
-                 card_type, name, dob, aadhaar_no, pan_no, license_no, voter_id_number,
-                 expiration_date, father_mother_name, face_embedding_json
-             ))
-        else:
-            # Build UPSERT query dynamically for the conflict target
-            # Ensures that other unique ID fields are not inadvertently overwritten with NULL
-            # if an update occurs on a different ID type.
-            conflict_target = sql.Identifier(conflict_target_column_name)
-            upsert_query = sql.SQL("""
-            INSERT INTO user_id_details
-            (card_type, name, dob, aadhaar_no, pan_no, license_no, voter_id_number, expiration_date, father_mother_name, face_embedding)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ON CONFLICT ({conflict_col})
-            DO UPDATE SET
-                card_type = EXCLUDED.card_type,
-                name = EXCLUDED.name,
-                dob = EXCLUDED.dob,
-                aadhaar_no = CASE WHEN EXCLUDED.card_type = 'Aadhaar card' THEN EXCLUDED.aadhaar_no ELSE user_id_details.aadhaar_no END,
-                pan_no = CASE WHEN EXCLUDED.card_type = 'PAN card' THEN EXCLUDED.pan_no ELSE user_id_details.pan_no END,
-                license_no = CASE WHEN EXCLUDED.card_type = 'Driving License' THEN EXCLUDED.license_no ELSE user_id_details.license_no END,
-                voter_id_number = CASE WHEN EXCLUDED.card_type = 'Voter ID' THEN EXCLUDED.voter_id_number ELSE user_id_details.voter_id_number END,
-                expiration_date = EXCLUDED.expiration_date,
-                father_mother_name = EXCLUDED.father_mother_name,
-                face_embedding = EXCLUDED.face_embedding,
-                registration_timestamp = CURRENT_TIMESTAMP
-            RETURNING id;
-            """).format(conflict_col=conflict_target)
-
-            cur.execute(upsert_query, (
-                card_type, name, dob, aadhaar_no, pan_no, license_no, voter_id_number,
-                expiration_date, father_mother_name, face_embedding_json
-            ))
-        
-        inserted_id = cur.fetchone()
-        if inserted_id:
+        row = _prepare_user_row(extracted_details, id_face_embedding_list, strong_embedding)
+        written = _write_user_row(cur, row)
+        if written:
             conn.commit()
+            _stored_embeddings.pop((row["doc_type"], row["doc_number"]))
             success = True
-            message = f"User details for '{name}' (ID: {inserted_id[0]}) stored/updated successfully."
+            message = _stored_message(row["name"], *written)
             print(message)
         else:
-            conn.rollback() # Should not happen if query is correct and RETURNING id is used
-            message = "Storage failed: No ID returned after insert/update."
+            conn.rollback()
+            message = SUPERSEDED_MESSAGE
             print(message)
 
+    except deadline.DeadlineExceeded:
+        raise
     except psycopg2.Error as db_err:
         print(f"Database error during user detail storage: {db_err}")
         message = f"Database error: {db_err}"
@@ -192,21 +289,280 @@ def store_verified_user_details(extracted_details, id_face_embedding_list):
     
     return success, message
 
+def _store_rows_individually(cur, rows, outcomes):
+    """Per-row fallback: each (index, row) under its own SAVEPOINT."""
+    import psycopg2
+    for i, row in rows:
+        cur.execute("SAVEPOINT batch_row")
+        try:
+            written = _write_user_row(cur, row)
+            cur.execute("RELEASE SAVEPOINT batch_row")
+            if written:
+                outcomes[i] = (True, _stored_message(row["name"], *written), False)
+            else:
+                outcomes[i] = (False, SUPERSEDED_MESSAGE, True)
+        except psycopg2.Error as row_err:
+            cur.execute("ROLLBACK TO SAVEPOINT batch_row")
+            outcomes[i] = (False, f"Database error: {row_err}", False)
+
+# Set-based version of _UPSERT_BY_DOCUMENT over the staging table. If the batch
+# holds the same document twice, the latest verification wins (DISTINCT ON ...
+# verified_at DESC, ord DESC). Only new documents take an id from the sequence.
+# Documents whose stored row is newer come back with a NULL id (superseded);
+# documents another transaction claimed in between do not come back at all
+# and are reported as not stored.
+_MERGE_STAGED = """
+    WITH latest AS (
+        SELECT DISTINCT ON (doc_type, doc_number) *
+        FROM user_id_details_staging
+        WHERE doc_type IS NOT NULL
+        ORDER BY doc_type, doc_number, verified_at DESC, ord DESC
+    ), existing AS (
+        SELECT d.user_id, d.doc_type, d.doc_number
+        FROM user_documents d JOIN latest USING (doc_type, doc_number)
+    ), claimed AS (
+        INSERT INTO user_documents (doc_type, doc_number, user_id)
+        SELECT latest.doc_type, latest.doc_number, nextval(pg_get_serial_sequence('user_id_details', 'id'))
+        FROM latest
+        WHERE NOT EXISTS (SELECT 1 FROM existing
+                          WHERE existing.doc_type = latest.doc_type AND existing.doc_number = latest.doc_number)
+        ON CONFLICT (doc_type, doc_number) DO NOTHING
+        RETURNING user_id, doc_type, doc_number
+    ), doc AS (
+        SELECT user_id, doc_type, doc_number FROM existing
+        UNION ALL
+        SELECT user_id, doc_type, doc_number FROM claimed
+    ), written AS (
+        INSERT INTO user_id_details (id, """ + _INSERT_COLUMNS + """)
+        SELECT doc.user_id, """ + ", ".join(f"latest.{c}" for c in USER_COLUMNS) + """,
+               votechain_parse_date(latest.dob), votechain_parse_date(latest.expiration_date)
+        FROM doc JOIN latest USING (doc_type, doc_number)
+        ON CONFLICT (id) DO UPDATE SET
+        """ + _UPSERT_SET_CLAUSE + """
+        RETURNING id, (xmax = 0) AS inserted
+    )
+    SELECT doc.doc_type, doc.doc_number, written.id, written.inserted
+    FROM doc LEFT JOIN written ON written.id = doc.user_id;
+    """
 
+def store_verified_users_batch(records):
+    """
+    Stores many verified users with a handful of round trips and one commit,
+    whatever the batch size:
+
+      1. rows with a document number go into a temporary staging table with
+         execute_values;
+      2. one statement merges them all (_MERGE_STAGED), with the same rules
+         as store_verified_user_details;
+      3. rows without a document number are inserted with one multi-row INSERT.
+
+    If a set-based step fails as a whole it is rolled back to its SAVEPOINT
+    and its rows are retried one by one, so one bad row costs only its own
+    outcome.
+    Args:
+        records (list): (extracted_details, id_face_embedding_list) pairs,
+            optionally followed by the strong-model embedding and the
+            verification time (epoch seconds, see _prepare_user_row).
+    Returns:
+        list: one (success, message, superseded) tuple per record, in order.
+        superseded is True when the record lost to a newer verification of
+        the same document (in this batch or already stored); that outcome is
+        final.
+    """
+    outcomes = [(False, "Storage failed.", False)] * len(records)
+    rows = []   # (index, prepared row)
+    for i, (extracted_details, embedding, *extra) in enumerate(records):
+        if not extracted_details:
+            outcomes[i] = (False, "No valid details to store.", False)
+        elif embedding is None:
+            outcomes[i] = (False, "Cannot store: ID face embedding is missing.", False)
+        else:
+            rows.append((i, _prepare_user_row(extracted_details, embedding, *extra)))
+    if not rows:
+        return outcomes
 
+    import psycopg2
+    from psycopg2.extras import execute_values
 
+    conn = None
+    cur = None
+    try:
+        ensure_schema()
+        conn = _connect()
+        cur = conn.cursor()
 
+        keyed = [(i, row) for i, row in rows if row["doc_type"]]
+        keyed_rows = dict(keyed)
+        if keyed:
+            cur.execute("""
+            CREATE TEMP TABLE user_id_details_staging (
+                ord INTEGER PRIMARY KEY,
+                doc_type VARCHAR(20),
+                doc_number VARCHAR(50),
+                card_type VARCHAR(50),
+                name VARCHAR(255),
+                dob VARCHAR(20),
+                aadhaar_no VARCHAR(50),
+                pan_no VARCHAR(50),
+                license_no VARCHAR(50),
+                voter_id_number VARCHAR(50),
+                expiration_date VARCHAR(20),
+                father_mother_name VARCHAR(255),
+                face_embedding TEXT,
+                face_embedding_strong TEXT,
+                verified_at TIMESTAMPTZ
+            ) ON COMMIT DROP;
+            """)
+            execute_values(
+                cur,
+                f"INSERT INTO user_id_details_staging (ord, doc_type, doc_number, {', '.join(USER_COLUMNS)}) VALUES %s",
+                [(i, row["doc_type"], row["doc_number"], *(row[c] for c in USER_COLUMNS)) for i, row in keyed],
+                page_size=1000,
+            )
+            cur.execute("SAVEPOINT batch_merge")
+            try:
+                cur.execute(_MERGE_STAGED)
+                merged = {(doc_type, doc_number): (row_id, inserted)
+                          for doc_type, doc_number, row_id, inserted in cur.fetchall()}
+                cur.execute("RELEASE SAVEPOINT batch_merge")
+            except psycopg2.Error as merge_err:
+                cur.execute("ROLLBACK TO SAVEPOINT batch_merge")
+                print(f"Batch merge failed ({merge_err}); retrying {len(keyed)} rows individually.")
+                merged = None
+                _store_rows_individually(cur, keyed, outcomes)
+            if merged is not None:
+                # Same winner as the merge: latest verification, then later row
+                winners = {}
+                for i, row in keyed:
+                    key = (row["doc_type"], row["doc_number"])
+                    if key not in winners or row["verified_at"] >= keyed_rows[winners[key]]["verified_at"]:
+                        winners[key] = i
+                for i, row in keyed:
+                    key = (row["doc_type"], row["doc_number"])
+                    if winners[key] != i:
+                        outcomes[i] = (False, "Superseded by a later verification of the same document "
+                                              "in this batch.", True)
+                    elif key not in merged:
+                        outcomes[i] = (False, "Document was registered concurrently; not stored in this batch.",
+                                       False)
+                    elif merged[key][0] is None:
+                        outcomes[i] = (False, SUPERSEDED_MESSAGE, True)
+                    else:
+                        outcomes[i] = (True, _stored_message(row["name"], *merged[key]), False)
+
+        plain = [(i, row) for i, row in rows if not row["doc_type"]]
+        if plain:
+            for _, row in plain:
+                print(f"Warning: No clear unique ID field for {row['card_type']}. This might lead to issues if name is not unique.")
+            cur.execute("SAVEPOINT batch_merge")
+            try:
+                returned = execute_values(
+                    cur,
+                    f"INSERT INTO user_id_details ({_INSERT_COLUMNS}) VALUES %s RETURNING id",
+                    [row for _, row in plain],
+                    template="(" + ", ".join(f"%({c})s" for c in USER_COLUMNS)
+                             + ", votechain_parse_date(%(dob)s), votechain_parse_date(%(expiration_date)s))",
+                    page_size=len(plain),
+                    fetch=True,
+                )
+                cur.execute("RELEASE SAVEPOINT batch_merge")
+                for (i, row), (row_id,) in zip(plain, returned):
+                    outcomes[i] = (True, _stored_message(row["name"], row_id, True), False)
+            except psycopg2.Error as insert_err:
+                cur.execute("ROLLBACK TO SAVEPOINT batch_merge")
+                print(f"Batch insert failed ({insert_err}); retrying {len(plain)} rows individually.")
+                _store_rows_individually(cur, plain, outcomes)
 
+        conn.commit()
+        for _, row in keyed:
+            _stored_embeddings.pop((row["doc_type"], row["doc_number"]))
+        stored = sum(1 for ok, _, _ in outcomes if ok)
+        print(f"Batch storage: {stored}/{len(records)} rows stored/updated in one transaction.")
+    except Exception as e:
+        print(f"Batch storage failed: {e}")
+        traceback.print_exc()
+        if conn: conn.rollback()
+        outcomes = [(False, f"Database error: {e}", False)] * len(records)
+    finally:
+        if cur: cur.close()
+        if conn: conn.close()
+    return outcomes
 
 
+_USER_SELECT = """
+    SELECT u.id, u.card_type, u.name, u.dob, u.dob_date, u.expiration_date, u.expiry_date,
+           u.father_mother_name, u.face_embedding, u.face_embedding_strong, u.registration_timestamp
+    FROM user_id_details u
+    """
 
+def _user_row_to_dict(cur, row):
+    user = dict(zip([col[0] for col in cur.description], row))
+    user["face_embedding"] = json.loads(user["face_embedding"]) if user["face_embedding"] else None
+    user["face_embedding_strong"] = (json.loads(user["face_embedding_strong"])
+                                     if user["face_embedding_strong"] else None)
+    return user
 
+def _clean_doc_number(doc_type, doc_number):
+    """Same cleaning as _prepare_user_row, so lookups are an exact index match."""
+    doc_number = re.sub(r'\s+', '', str(doc_number))
+    return doc_number.upper() if doc_type in ('license', 'voter_id') else doc_number
 
+def get_user_by_document(doc_type, doc_number):
+    """
+    Looks a user up by document (unique index on user_documents).
+    doc_type is one of the DOCUMENT_TYPES codes ('aadhaar', 'voter_id', 'pan', 'license').
+    Returns the user dict (face_embedding decoded) or None.
+    """
+    ensure_schema()
+    doc_number = _clean_doc_number(doc_type, doc_number)
+    conn = _connect("lookup")
+    try:
+        with conn.cursor() as cur:
+            cur.execute(_USER_SELECT + """
+            JOIN user_documents d ON d.user_id = u.id
+            WHERE d.doc_type = %s AND d.doc_number = %s
+            """, (doc_type, doc_number))
+            row = cur.fetchone()
+            return _user_row_to_dict(cur, row) if row else None
+    finally:
+        conn.close()
 
+def find_users_by_name_dob(name, dob):
+    """Users whose name (case-insensitive) and date of birth match; dob as printed on the card."""
+    ensure_schema()
+    conn = _connect("lookup")
+    try:
+        with conn.cursor() as cur:
+            cur.execute(_USER_SELECT + """
+            WHERE lower(u.name) = lower(%s) AND u.dob_date = votechain_parse_date(%s)
+            ORDER BY u.registration_timestamp DESC
+            """, (name, dob))
+            return [_user_row_to_dict(cur, row) for row in cur.fetchall()]
+    finally:
+        conn.close()
 
-
-
-
+def get_stored_embedding(doc_type, doc_number):
+    """
+    {"user_id", "name", "face_embedding", "face_embedding_strong"} for a
+    registered document, served from a per-process hot-row cache
+    (USER_CACHE_TTL_SECONDS). Returns None when the document is not registered
+    or has no embedding; misses are not cached, so a fresh registration is
+    found at once. Stores in this process invalidate their documents; other
+    workers see changes after the TTL.
+    """
+    key = (doc_type, _clean_doc_number(doc_type, doc_number))
+    stored = _stored_embeddings.get(key)
+    if stored is None:
+        user = get_user_by_document(*key)
+        if user is None or not user["face_embedding"]:
+            return None
+        stored = {"user_id": user["id"], "name": user["name"], "face_embedding": user["face_embedding"],
+                  "face_embedding_strong": user["face_embedding_strong"]}
+        _stored_embeddings.put(key, stored)
+    return stored
+
+def embedding_cache_stats():
+    return _stored_embeddings.snapshot()
 
 
 
@@ -0,0 +1,129 @@
+# ml_logic/deadline.py
+"""
+Per-request time budget shared by every pipeline stage.
+
+A request must not hold a pipeline slot indefinitely, and under a sync
+gunicorn worker one running past --timeout (120 s) is killed with no event
+sent and every model call left half done. app.py starts a Deadline for each
+request, REQUEST_DEADLINE_SECONDS ahead and a safety margin short of that
+kill, and the stages consult it:
+
+  - check(stage) before a stage starts work raises DeadlineExceeded once the
+    budget is spent, so a doomed request stops using the CPU;
+  - allows_optional() is False when less than DEADLINE_OPTIONAL_SECONDS is
+    left, and stages skip work the verdict does not need (OCR field re-reads,
+    strong-model escalation, the strong embedding stored for /reverify);
+  - call_timeout() bounds a blocking call (Gemini, Postgres statement_timeout)
+    by the time left.
+
+pipeline.guard_stages turns DeadlineExceeded into a 'failed' event for the
+stage and a failed 'done' event.
+
+The deadline lives in a context variable. Threads and pools do not inherit
+context variables, so work handed to them is wrapped with bind() (or started
+from contextvars.copy_context(), as event_stream.run_in_background does).
+Code running without a deadline (job-queue workers, the CLI tools) is never
+limited. /batch/verify gets BATCH_DEADLINE_SECONDS instead: its NDJSON stream
+legitimately outlives 120 s, which needs the threaded worker the Dockerfile
+runs (gthread's --timeout is a worker heartbeat, not a per-request limit).
+"""
+import contextvars
+import functools
+import os
+import time
+
+# --- Configuration ---
+# Keep this below gunicorn's --timeout so the failed event goes out before the kill.
+REQUEST_DEADLINE_SECONDS  = float(os.getenv("REQUEST_DEADLINE_SECONDS", "110"))
+# Whole-batch budget for /batch/verify (0 = none); only chunks not yet started are cut off.
+BATCH_DEADLINE_SECONDS    = float(os.getenv("BATCH_DEADLINE_SECONDS", "1800"))
+# Optional work is skipped when less than this is left.
+DEADLINE_OPTIONAL_SECONDS = float(os.getenv("DEADLINE_OPTIONAL_SECONDS", "15"))
+
+
+class DeadlineExceeded(Exception):
+    """
+    The request's time budget ran out before `stage` could finish. unfinished
+    is the thread still running the interrupted call, if any (see
+    pipeline._with_progress); it is waited for once the failure is reported.
+    """
+
+    def __init__(self, stage, budget, unfinished=None):
+        super().__init__(f"Request deadline exceeded during {stage} ({budget:.0f}s budget).")
+        self.stage = stage
+        self.unfinished = unfinished
+
+
+class Deadline:
+    def __init__(self, seconds):
+        self.budget = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return time.monotonic() >= self.expires_at
+
+    def check(self, stage):
+        if self.expired():
+            raise DeadlineExceeded(stage, self.budget)
+
+
+_current = contextvars.ContextVar("votechain_deadline", default=None)
+
+
+def start(seconds=REQUEST_DEADLINE_SECONDS):
+    """Starts a deadline for the current context (0 or less: none) and returns it."""
+    deadline = Deadline(seconds) if seconds > 0 else None
+    _current.set(deadline)
+    return deadline
+
+
+def clear():
+    _current.set(None)
+
+
+def current():
+    return _current.get()
+
+
+def remaining():
+    """Seconds left, or None without a deadline."""
+    deadline = _current.get()
+    return None if deadline is None else deadline.remaining()
+
+
+def check(stage):
+    """Raises DeadlineExceeded(stage) if the current deadline has passed."""
+    deadline = _current.get()
+    if deadline is not None:
+        deadline.check(stage)
+
+
+def allows_optional(seconds=DEADLINE_OPTIONAL_SECONDS):
+    """False when optional work should be skipped to leave time for the rest."""
+    deadline = _current.get()
+    return deadline is None or deadline.remaining() >= seconds
+
+
+def call_timeout(cap=None):
+    """Timeout (seconds) for a blocking call: the time left, at most `cap`; None if unlimited."""
+    left = remaining()
+    if left is None:
+        return cap
+    return max(1.0, left if cap is None else min(cap, left))
+
+
+def bind(fn):
+    """
+    fn wrapped to run in a copy of the caller's context, so a helper thread
+    or pool worker sees the caller's deadline. Each call gets its own copy,
+    so the wrapper may run on several threads at once.
+    """
+    context = contextvars.copy_context()
+
+    @functools.wraps(fn)
+    def run(*args, **kwargs):
+        return context.copy().run(fn, *args, **kwargs)
+    return run
@@ -0,0 +1,165 @@
+# ml_logic/event_stream.py
+"""
+Per-request event buffers that decouple a running pipeline from the HTTP
+connection watching it.
+
+The pipeline runs in a background thread and appends every stage event to an
+EventStream. SSE responses only read from the buffer, so a client that drops
+and reconnects with Last-Event-ID gets the events it missed replayed and then
+follows the same still-running pipeline instead of starting a new one.
+
+Buffers are bounded (STREAM_BUFFER_MAX_EVENTS per stream, STREAM_MAX_STREAMS
+per process) and finished streams expire after STREAM_TTL_SECONDS. They live
+in process memory: a reconnect has to reach the same gunicorn worker.
+"""
+import collections
+import contextvars
+import json
+import os
+import threading
+import time
+import traceback
+import uuid
+
+# --- Configuration ---
+STREAM_BUFFER_MAX_EVENTS = int(os.getenv("STREAM_BUFFER_MAX_EVENTS", "64"))
+STREAM_MAX_STREAMS       = int(os.getenv("STREAM_MAX_STREAMS", "256"))
+STREAM_TTL_SECONDS       = float(os.getenv("STREAM_TTL_SECONDS", "300"))
+# An SSE comment is sent whenever nothing else was written for this long, so
+# proxies and load balancers don't treat a long Gemini / RetinaFace pass as idle.
+SSE_HEARTBEAT_SECONDS    = float(os.getenv("SSE_HEARTBEAT_SECONDS", "10"))
+# Reconnect delay suggested to EventSource clients.
+SSE_RETRY_MS             = int(os.getenv("SSE_RETRY_MS", "2000"))
+
+HEARTBEAT_FRAME = ": heartbeat\n\n"
+
+
+def format_event_id(stream_id, seq):
+    return f"{stream_id}:{seq}"
+
+
+def parse_event_id(event_id):
+    """'<stream_id>:<seq>' → (stream_id, seq); (None, 0) if malformed."""
+    if not event_id or ":" not in event_id:
+        return None, 0
+    stream_id, _, seq = event_id.rpartition(":")
+    return (stream_id, int(seq)) if seq.isdigit() else (None, 0)
+
+
+class EventStream:
+    def __init__(self, stream_id):
+        self.stream_id = stream_id
+        self.created_at = time.time()
+        self.finished_at = None
+        self._events = collections.deque(maxlen=STREAM_BUFFER_MAX_EVENTS)
+        self._next_seq = 1
+        self._cond = threading.Condition()
+
+    @property
+    def done(self):
+        return self.finished_at is not None
+
+    def append(self, payload):
+        with self._cond:
+            seq = self._next_seq
+            self._next_seq += 1
+            self._events.append((seq, payload))
+            self._cond.notify_all()
+            return seq
+
+    def finish(self):
+        with self._cond:
+            if self.finished_at is None:
+                self.finished_at = time.time()
+            self._cond.notify_all()
+
+    def events_after(self, after_seq, timeout=None):
+        """
+        Returns (events, done) with every buffered (seq, payload) whose seq is
+        greater than after_seq, waiting up to `timeout` seconds for new ones.
+        """
+        with self._cond:
+            if timeout and not self.done and (not self._events or self._events[-1][0] <= after_seq):
+                self._cond.wait(timeout)
+            return [e for e in self._events if e[0] > after_seq], self.done
+
+
+class StreamRegistry:
+    def __init__(self):
+        self._streams = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _evict(self):
+        now = time.time()
+        for stream_id in [sid for sid, s in self._streams.items()
+                          if s.done and now - s.finished_at > STREAM_TTL_SECONDS]:
+            del self._streams[stream_id]
+        # Over capacity: drop the oldest finished streams first, then the oldest overall.
+        while len(self._streams) >= STREAM_MAX_STREAMS:
+            victim = next((sid for sid, s in self._streams.items() if s.done), None)
+            victim = victim or next(iter(self._streams))
+            del self._streams[victim]
+
+    def create(self):
+        with self._lock:
+            self._evict()
+            stream = EventStream(uuid.uuid4().hex)
+            self._streams[stream.stream_id] = stream
+            return stream
+
+    def get(self, stream_id):
+        with self._lock:
+            self._evict()
+            return self._streams.get(stream_id)
+
+
+registry = StreamRegistry()
+
+
+def run_in_background(stream, events, on_finish=None):
+    """
+    Drains the `events` iterable into `stream` on a daemon thread. on_finish
+    runs afterwards whatever happens (file cleanup, releasing slots). The
+    thread runs in a copy of the caller's context, so the request deadline
+    (ml_logic/deadline.py) follows the pipeline into it.
+    """
+    def _run():
+        try:
+            for payload in events:
+                stream.append(payload)
+        except Exception as e:
+            traceback.print_exc()
+            stream.append({"stage": "done", "status": "failed", "overall": "failed",
+                           "detail": f"Unexpected server error: {str(e)}"})
+        finally:
+            stream.finish()
+            if on_finish:
+                try:
+                    on_finish()
+                except Exception as e_finish:
+                    print(f"Stream cleanup error: {e_finish}")
+
+    context = contextvars.copy_context()
+    threading.Thread(target=context.run, args=(_run,),
+                     name=f"stream-{stream.stream_id[:8]}", daemon=True).start()
+
+
+def iter_sse(stream, after_seq=0, poll_seconds=1.0):
+    """
+    Yields SSE frames (with `id:` fields) for the stream from after_seq on,
+    until it is done, plus a heartbeat comment after SSE_HEARTBEAT_SECONDS of
+    silence. Each frame is its own chunk so the server writes it out at once.
+    """
+    seq = after_seq
+    yield f"retry: {SSE_RETRY_MS}\n\n"
+    last_write = time.monotonic()
+    while True:
+        events, done = stream.events_after(seq, timeout=poll_seconds)
+        for seq, payload in events:
+            yield f"id: {format_event_id(stream.stream_id, seq)}\ndata: {json.dumps(payload)}\n\n"
+            last_write = time.monotonic()
+        if done and not stream.events_after(seq)[0]:
+            return
+        if time.monotonic() - last_write >= SSE_HEARTBEAT_SECONDS:
+            yield HEARTBEAT_FRAME
+            last_write = time.monotonic()
@@ -0,0 +1,358 @@
+# ml_logic/face_detector.py
+"""
+Cascaded face detection shared by the ID-card and live-face stages.
+
+A fast detector (YuNet by default) runs first. Its result is accepted only when
+the detection confidence and the eye-landmark geometry both look sane; anything
+ambiguous escalates to RetinaFace, which is what the pipeline used everywhere
+before. Every call reports which backend produced the accepted face so the
+choice can be surfaced in the API response.
+
+Detectors only ever see a copy of the image downscaled to DETECTION_MAX_SIDE.
+Boxes and eye landmarks are mapped back to the original resolution, and the
+crop, eye alignment and anti-spoofing all run on the full-quality pixels.
+"""
+import numpy as np
+import os
+import time
+import traceback
+
+from ml_logic import deadline
+from ml_logic import inference_backend
+
+# cv2 is imported where it is used so that importing this module stays cheap.
+
+# --- Configuration ---
+FAST_DETECTOR_BACKEND     = os.getenv("FAST_DETECTOR_BACKEND", "yunet")
+FALLBACK_DETECTOR_BACKEND = os.getenv("FALLBACK_DETECTOR_BACKEND", "retinaface")
+DETECTOR_CASCADE_ENABLED  = os.getenv("DETECTOR_CASCADE_ENABLED", "true").lower() in ("1", "true", "yes")
+
+# A fast-detector face is accepted only if it clears all of these.
+CASCADE_MIN_CONFIDENCE    = float(os.getenv("CASCADE_MIN_CONFIDENCE", "0.90"))
+CASCADE_MIN_FACE_SIDE_PX  = int(os.getenv("CASCADE_MIN_FACE_SIDE_PX", "48"))
+# Inter-eye distance as a fraction of face-box width; frontal faces sit around 0.35-0.45.
+CASCADE_MIN_EYE_RATIO     = float(os.getenv("CASCADE_MIN_EYE_RATIO", "0.25"))
+CASCADE_MAX_EYE_RATIO     = float(os.getenv("CASCADE_MAX_EYE_RATIO", "0.65"))
+# Eye line tilt in degrees beyond which alignment from a fast detector is not trusted.
+CASCADE_MAX_EYE_TILT_DEG  = float(os.getenv("CASCADE_MAX_EYE_TILT_DEG", "25"))
+
+# Longest image side (px) the detectors run on. 0 disables downscaling.
+DETECTION_MAX_SIDE        = int(os.getenv("DETECTION_MAX_SIDE", "1024"))
+
+
+def _fast_result_is_confident(face_obj):
+    """
+    Returns (accepted, reason) for a single face returned by the fast detector.
+    """
+    confidence = face_obj.get("confidence") or 0.0
+    area       = face_obj.get("facial_area") or {}
+    w, h       = area.get("w", 0), area.get("h", 0)
+    left_eye   = area.get("left_eye")
+    right_eye  = area.get("right_eye")
+
+    if confidence < CASCADE_MIN_CONFIDENCE:
+        return False, f"low confidence {confidence:.2f}"
+    if min(w, h) < CASCADE_MIN_FACE_SIDE_PX:
+        return False, f"face too small ({w}x{h})"
+    if left_eye is None or right_eye is None:
+        return False, "eye landmarks missing"
+
+    dx = float(left_eye[0]) - float(right_eye[0])
+    dy = float(left_eye[1]) - float(right_eye[1])
+    eye_ratio = np.hypot(dx, dy) / float(w)
+    if not (CASCADE_MIN_EYE_RATIO <= eye_ratio <= CASCADE_MAX_EYE_RATIO):
+        return False, f"implausible eye spacing ({eye_ratio:.2f})"
+    tilt = abs(np.degrees(np.arctan2(dy, dx)))
+    tilt = min(tilt, 180.0 - tilt)
+    if tilt > CASCADE_MAX_EYE_TILT_DEG:
+        return False, f"eye line tilted {tilt:.0f} deg"
+    return True, "ok"
+
+
+def _pick_primary(faces):
+    """Largest face first — the subject of an ID photo or selfie is the biggest one."""
+    return sorted(
+        faces,
+        key=lambda f: f["facial_area"].get("w", 0) * f["facial_area"].get("h", 0),
+        reverse=True,
+    )
+
+
+# ── Detection front-end ───────────────────────────────────────────────────────
+def _load_bgr(img_path):
+    import cv2
+    if isinstance(img_path, np.ndarray):
+        return img_path
+    img = cv2.imread(img_path)
+    if img is None:
+        raise ValueError(f"Could not read image at '{img_path}'")
+    return img
+
+
+def _downscale_for_detection(img):
+    """Returns (detector_image, scale) where scale = detector px / original px."""
+    import cv2
+    h, w = img.shape[:2]
+    longest = max(h, w)
+    if DETECTION_MAX_SIDE <= 0 or longest <= DETECTION_MAX_SIDE:
+        return img, 1.0
+    scale = DETECTION_MAX_SIDE / float(longest)
+    small = cv2.resize(img, (max(1, round(w * scale)), max(1, round(h * scale))),
+                       interpolation=cv2.INTER_AREA)
+    return small, scale
+
+
+def _map_to_full_resolution(facial_area, scale, full_shape):
+    """Scales a detector-space facial_area (box + eye landmarks) back to the original image."""
+    if scale == 1.0:
+        return dict(facial_area)
+    inv = 1.0 / scale
+    full_h, full_w = full_shape[:2]
+    x = int(round(facial_area["x"] * inv))
+    y = int(round(facial_area["y"] * inv))
+    mapped = {
+        "x": max(0, x),
+        "y": max(0, y),
+        "w": min(full_w - max(0, x), int(round(facial_area["w"] * inv))),
+        "h": min(full_h - max(0, y), int(round(facial_area["h"] * inv))),
+    }
+    for key in ("left_eye", "right_eye"):
+        point = facial_area.get(key)
+        mapped[key] = None if point is None else (int(round(point[0] * inv)), int(round(point[1] * inv)))
+    return mapped
+
+
+def _crop_and_align(img, facial_area, align):
+    """
+    Crops the face from the full-resolution image, rotating it so the eyes are
+    level first when landmarks are available. Returns the crop as BGR uint8.
+    """
+    import cv2
+    x, y, w, h = facial_area["x"], facial_area["y"], facial_area["w"], facial_area["h"]
+    left_eye, right_eye = facial_area.get("left_eye"), facial_area.get("right_eye")
+    if not align or left_eye is None or right_eye is None:
+        return img[y:y + h, x:x + w]
+
+    # Rotate a padded neighbourhood around the face rather than the whole frame.
+    img_h, img_w = img.shape[:2]
+    x1, y1 = max(0, x - w // 2), max(0, y - h // 2)
+    x2, y2 = min(img_w, x + w + w // 2), min(img_h, y + h + h // 2)
+    sub = img[y1:y2, x1:x2]
+
+    angle = float(np.degrees(np.arctan2(left_eye[1] - right_eye[1], left_eye[0] - right_eye[0])))
+    sub_h, sub_w = sub.shape[:2]
+    centre = (sub_w / 2.0, sub_h / 2.0)
+    rotation = cv2.getRotationMatrix2D(centre, angle, 1.0)
+    rotated = cv2.warpAffine(sub, rotation, (sub_w, sub_h), flags=cv2.INTER_CUBIC, borderValue=(0, 0, 0))
+
+    face_cx, face_cy = x - x1 + w / 2.0, y - y1 + h / 2.0
+    new_cx, new_cy = rotation @ np.array([face_cx, face_cy, 1.0])
+    fx1, fy1 = int(max(0, round(new_cx - w / 2.0))), int(max(0, round(new_cy - h / 2.0)))
+    return rotated[fy1:fy1 + h, fx1:fx1 + w]
+
+
+def _box(facial_area):
+    return facial_area["x"], facial_area["y"], facial_area["w"], facial_area["h"]
+
+
+def _antispoof(img, facial_area):
+    """Runs the anti-spoofing model on the full-resolution face region."""
+    return inference_backend.get_backend().antispoof(img, _box(facial_area))
+
+
+def _sharpness(face_rgb):
+    """Variance of the Laplacian of a face crop; higher is sharper."""
+    import cv2
+    gray = cv2.cvtColor((face_rgb * 255).astype(np.uint8), cv2.COLOR_RGB2GRAY)
+    return float(cv2.Laplacian(gray, cv2.CV_64F).var())
+
+
+def _run_detector(backend, det_img, enforce_detection):
+    faces = inference_backend.get_backend().detect(backend, det_img, enforce_detection=enforce_detection)
+    return _pick_primary(faces or [])
+
+
+def _finalise(full_img, det_faces, scale, align, anti_spoofing, progress=None):
+    """Maps detector output to full resolution and builds DeepFace-style face dicts."""
+    results = []
+    for det_face in det_faces:
+        area = _map_to_full_resolution(det_face["facial_area"], scale, full_img.shape)
+        if area["w"] <= 0 or area["h"] <= 0:
+            continue
+        crop = _crop_and_align(full_img, area, align)
+        face_obj = {
+            # Same convention as DeepFace.extract_faces: RGB, float in [0, 1]
+            "face": crop[:, :, ::-1].astype(np.float64) / 255.0,
+            "facial_area": area,
+            "confidence": det_face.get("confidence") or 0.0,
+        }
+        if anti_spoofing:
+            face_obj["is_real"], face_obj["antispoof_score"] = _antispoof(full_img, area)
+        results.append(face_obj)
+    if anti_spoofing and progress and results:
+        progress(f"Anti-spoofing done (score {results[0]['antispoof_score']:.2f}).")
+    return results
+
+
+def detect_faces(img_path, align=True, anti_spoofing=False, progress=None):
+    """
+    Runs the detector cascade on an image path or numpy array (BGR).
+    progress, if given, is called with a short message after each model pass.
+
+    Returns:
+        (faces, detector_used) — faces is a list in DeepFace.extract_faces format,
+        largest face first. Raises ValueError("Face could not be detected ...")
+        when the fallback detector finds nothing, same as DeepFace does.
+    """
+    full_img = _load_bgr(img_path)
+    det_img, scale = _downscale_for_detection(full_img)
+    if scale != 1.0:
+        print(f"  [Detector] Downscaled {full_img.shape[1]}x{full_img.shape[0]} → "
+              f"{det_img.shape[1]}x{det_img.shape[0]} for detection")
+
+    if DETECTOR_CASCADE_ENABLED and FAST_DETECTOR_BACKEND != FALLBACK_DETECTOR_BACKEND:
+        try:
+            # With enforce_detection=False the backends return the whole image with
+            # confidence 0 when nothing is found; the confidence gate rejects it.
+            fast_faces = _run_detector(FAST_DETECTOR_BACKEND, det_img, enforce_detection=False)
+            if fast_faces:
+                accepted, reason = _fast_result_is_confident(fast_faces[0])
+                if accepted:
+                    print(f"  [Detector] {FAST_DETECTOR_BACKEND} accepted "
+                          f"(confidence {fast_faces[0]['confidence']:.2f})")
+                    if progress:
+                        progress(f"Face detected by {FAST_DETECTOR_BACKEND} "
+                                 f"(confidence {fast_faces[0]['confidence']:.2f}).")
+                    return (_finalise(full_img, fast_faces, scale, align, anti_spoofing, progress),
+                            FAST_DETECTOR_BACKEND)
+                print(f"  [Detector] {FAST_DETECTOR_BACKEND} ambiguous ({reason}) "
+                      f"— escalating to {FALLBACK_DETECTOR_BACKEND}")
+                if progress:
+                    progress(f"{FAST_DETECTOR_BACKEND} result ambiguous ({reason}), "
+                             f"running {FALLBACK_DETECTOR_BACKEND}...")
+        except deadline.DeadlineExceeded:
+            raise   # from progress(): no fallback pass once the deadline is gone
+        except Exception as e_fast:
+            print(f"  [Detector] {FAST_DETECTOR_BACKEND} errored ({e_fast}) "
+                  f"— escalating to {FALLBACK_DETECTOR_BACKEND}")
+
+    faces = _run_detector(FALLBACK_DETECTOR_BACKEND, det_img, enforce_detection=True)
+    if progress:
+        progress(f"Face detected by {FALLBACK_DETECTOR_BACKEND}.")
+    return _finalise(full_img, faces, scale, align, anti_spoofing, progress), FALLBACK_DETECTOR_BACKEND
+
+
+def detect_burst_faces(img_paths, progress=None):
+    """
+    Primary face of each frame in a burst, with every face anti-spoofed in
+    one batched pass instead of one model call per frame.
+
+    Returns [(img_path, face_obj, detector_used)] for the frames where a face
+    was found; face_obj carries 'is_real' / 'antispoof_score' as with
+    detect_faces(anti_spoofing=True), plus 'sharpness'.
+    """
+    detected = []
+    for img_path in img_paths:
+        try:
+            full_img = _load_bgr(img_path)
+            faces, detector_used = detect_faces(full_img)
+        except ValueError as e_frame:
+            print(f"  [Detector] Burst frame skipped ({img_path}): {e_frame}")
+            continue
+        detected.append((img_path, full_img, faces[0], detector_used))
+    if not detected:
+        return []
+
+    verdicts = inference_backend.get_backend().antispoof_batch(
+        [(full_img, _box(face["facial_area"])) for _, full_img, face, _ in detected]
+    )
+    results = []
+    for (img_path, _, face, detector_used), (is_real, score) in zip(detected, verdicts):
+        face["is_real"], face["antispoof_score"] = is_real, score
+        face["sharpness"] = _sharpness(face["face"])
+        results.append((img_path, face, detector_used))
+    if progress:
+        progress(f"Anti-spoofing done on {len(results)} frame(s) in one batch.")
+    return results
+
+
+# ── Benchmark ─────────────────────────────────────────────────────────────────
+def _iou(a, b):
+    ax2, ay2 = a["x"] + a["w"], a["y"] + a["h"]
+    bx2, by2 = b["x"] + b["w"], b["y"] + b["h"]
+    iw = max(0, min(ax2, bx2) - max(a["x"], b["x"]))
+    ih = max(0, min(ay2, by2) - max(a["y"], b["y"]))
+    inter = iw * ih
+    union = a["w"] * a["h"] + b["w"] * b["h"] - inter
+    return inter / union if union else 0.0
+
+
+def benchmark(image_paths, iou_threshold=0.5):
+    """
+    Compares RetinaFace-only detection with the cascade on a set of images.
+
+    Accuracy is agreement with RetinaFace: a cascade result counts as correct
+    when its primary box overlaps RetinaFace's primary box with IoU >= iou_threshold.
+    """
+    reference_ms, cascade_ms = [], []
+    agreed, escalated, evaluated = 0, 0, 0
+
+    for path in image_paths:
+        try:
+            t0 = time.perf_counter()
+            ref_faces = inference_backend.get_backend().detect(
+                FALLBACK_DETECTOR_BACKEND, _load_bgr(path), enforce_detection=True
+            )
+            reference_ms.append((time.perf_counter() - t0) * 1000)
+
+            t0 = time.perf_counter()
+            cas_faces, used = detect_faces(path)
+            cascade_ms.append((time.perf_counter() - t0) * 1000)
+        except Exception as e:
+            print(f"  skip {path}: {e}")
+            continue
+
+        evaluated += 1
+        if used == FALLBACK_DETECTOR_BACKEND:
+            escalated += 1
+        ref_box = _pick_primary(ref_faces)[0]["facial_area"]
+        if _iou(ref_box, cas_faces[0]["facial_area"]) >= iou_threshold:
+            agreed += 1
+
+    if not evaluated:
+        return {"evaluated": 0}
+    ref_mean, cas_mean = float(np.mean(reference_ms)), float(np.mean(cascade_ms))
+    return {
+        "evaluated": evaluated,
+        "reference_backend": FALLBACK_DETECTOR_BACKEND,
+        "fast_backend": FAST_DETECTOR_BACKEND,
+        "reference_mean_ms": round(ref_mean, 1),
+        "cascade_mean_ms": round(cas_mean, 1),
+        "speedup": round(ref_mean / cas_mean, 2) if cas_mean else None,
+        "escalation_rate": round(escalated / evaluated, 3),
+        "accuracy_vs_reference": round(agreed / evaluated, 3),
+    }
+
+
+if __name__ == "__main__":
+    # python -m ml_logic.face_detector <image_or_dir> [...]
+    import json
+    import sys
+
+    paths = []
+    for arg in sys.argv[1:]:
+        if os.path.isdir(arg):
+            paths.extend(
+                os.path.join(arg, f) for f in sorted(os.listdir(arg))
+                if f.lower().endswith((".jpg", ".jpeg", ".png"))
+            )
+        else:
+            paths.append(arg)
+    if not paths:
+        print("Usage: python -m ml_logic.face_detector <image_or_dir> [...]")
+        sys.exit(1)
+    try:
+        print(json.dumps(benchmark(paths), indent=2))
+    except Exception:
+        traceback.print_exc()
+        sys.exit(1)
@@ -1,55 +1,310 @@
-from deepface import DeepFace
 import numpy as np
+import collections
+import hashlib
+import threading
+import time
 import traceback
 import os
 import json # For printing results if needed
 # cv2 import is not needed here unless you uncomment the __main__ block and use cv2.imwrite
 
+from ml_logic import deadline
+from ml_logic import face_detector
+from ml_logic import inference_backend
+
 # --- Configuration ---
 VERIFICATION_MODEL_NAME = 'Facenet'
 DISTANCE_METRIC = 'cosine'
-DETECTOR_BACKEND_LIVE = 'retinaface'
+# RetinaFace is now the fallback stage of the detector cascade (see face_detector.py)
+DETECTOR_BACKEND_LIVE = face_detector.FALLBACK_DETECTOR_BACKEND
 
 # --- Threshold Configuration ---
-CUSTOM_SYSTEM_THRESHOLD = 0.5  # YOUR DESIRED THRESHOLD FOR THE SYSTEM'S DECISION
+# Cosine distance at or below which faces match. Re-tune with `python -m ml_logic.calibrate`.
+CUSTOM_SYSTEM_THRESHOLD = float(os.getenv("FACE_MATCH_THRESHOLD", "0.5"))
 
-try:
-    STANDARD_DEEPFACE_THRESHOLD = DeepFace.verification.find_threshold(VERIFICATION_MODEL_NAME, DISTANCE_METRIC)
-    print(f"Standard DeepFace threshold for {VERIFICATION_MODEL_NAME}/{DISTANCE_METRIC}: {STANDARD_DEEPFACE_THRESHOLD}")
-except Exception:
-    STANDARD_DEEPFACE_THRESHOLD = 0.40 
-    print(f"Warning: Using fallback standard DeepFace threshold {STANDARD_DEEPFACE_THRESHOLD} for {VERIFICATION_MODEL_NAME}/{DISTANCE_METRIC}")
+# --- Tiered matching (see _escalate) ---
+# Facenet decides on its own unless its distance lies within ESCALATION_MARGIN
+# of CUSTOM_SYSTEM_THRESHOLD; those borderline pairs are re-decided by
+# STRONG_MODEL_NAME against its own threshold. 0 disables escalation.
+STRONG_MODEL_NAME      = os.getenv("STRONG_MODEL_NAME", "ArcFace")   # 'ArcFace' | 'Facenet512'
+# DeepFace's cosine thresholds: ArcFace 0.68, Facenet512 0.30
+STRONG_MODEL_THRESHOLD = float(os.getenv("STRONG_MODEL_THRESHOLD", "0.68"))
+ESCALATION_MARGIN      = float(os.getenv("ESCALATION_MARGIN", "0.08"))
 
+# --- Burst liveness (several camera frames per selfie, see perform_burst_liveness_check) ---
+LIVENESS_BURST_MAX_FRAMES = int(os.getenv("LIVENESS_BURST_MAX_FRAMES", "5"))
+# Frames that must agree (all real or all spoof) before the rest are skipped.
+LIVENESS_BURST_AGREE      = int(os.getenv("LIVENESS_BURST_AGREE", "2"))
 
-def perform_liveness_check(live_image_path, dummy_reference_image_path):
-    print(f"\n--- Performing Liveness Check on: {live_image_path} ---")
-    liveness_passed = False
-    liveness_outcome_message = "Not Performed"
+# --- Replay index (recently seen live images, see ReplayIndex) ---
+REPLAY_INDEX_ENABLED     = os.getenv("REPLAY_INDEX_ENABLED", "true").lower() in ("1", "true", "yes")
+REPLAY_INDEX_MAX_ENTRIES = int(os.getenv("REPLAY_INDEX_MAX_ENTRIES", "4096"))
+REPLAY_INDEX_TTL_SECONDS = float(os.getenv("REPLAY_INDEX_TTL_SECONDS", "900"))
+# Max differing bits (of 64) on both dHash and pHash for two images to count as
+# copies of one selfie (replay flag only; cached results need identical bytes).
+REPLAY_MAX_HAMMING       = int(os.getenv("REPLAY_MAX_HAMMING", "6"))
 
-    if not os.path.exists(live_image_path):
-        print(f"Liveness FAILED: Live image not found at '{live_image_path}'")
-        return False, "Liveness FAILED: Live image file missing."
-    if not os.path.exists(dummy_reference_image_path):
-        print(f"CRITICAL ERROR: Dummy liveness reference image not found at '{dummy_reference_image_path}'")
-        return False, "Liveness FAILED: System configuration error (missing reference image)."
+_standard_deepface_threshold = None
+
+
+def get_standard_deepface_threshold():
+    """
+    DeepFace's own threshold for the model/metric pair, looked up on first use
+    (it imports DeepFace and therefore TensorFlow).
+    """
+    global _standard_deepface_threshold
+    if _standard_deepface_threshold is None:
+        try:
+            from deepface import DeepFace
+            _standard_deepface_threshold = DeepFace.verification.find_threshold(VERIFICATION_MODEL_NAME, DISTANCE_METRIC)
+            print(f"Standard DeepFace threshold for {VERIFICATION_MODEL_NAME}/{DISTANCE_METRIC}: {_standard_deepface_threshold}")
+        except Exception:
+            _standard_deepface_threshold = 0.40
+            print(f"Warning: Using fallback standard DeepFace threshold {_standard_deepface_threshold} for {VERIFICATION_MODEL_NAME}/{DISTANCE_METRIC}")
+    return _standard_deepface_threshold
+
+
+def __getattr__(name):
+    # Keeps `face_verifier.STANDARD_DEEPFACE_THRESHOLD` working without the import-time lookup.
+    if name == "STANDARD_DEEPFACE_THRESHOLD":
+        return get_standard_deepface_threshold()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _face_to_bgr_uint8(face_rgb):
+    """Detected faces are RGB floats in [0, 1]; the embedding backends take a BGR image."""
+    face = face_rgb
+    if face.dtype in (np.float32, np.float64):
+        face = (face * 255).astype(np.uint8)
+    return face[:, :, ::-1].copy()
 
+
+def _cosine_distance(a, b):
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    return float(1.0 - np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b)))
+
+
+def _bits_to_int(bits):
+    value = 0
+    for bit in bits.flatten():
+        value = (value << 1) | int(bit)
+    return value
+
+
+def image_hashes(image_path):
+    """
+    (dHash, pHash) of an image as 64-bit ints, or None if it cannot be read.
+    The image is decoded at 1/4 scale; both hashes survive re-encoding and
+    mild resizing, so trivially re-saved copies hash (nearly) the same.
+    """
+    import cv2
+    gray = cv2.imread(image_path, cv2.IMREAD_REDUCED_GRAYSCALE_4)
+    if gray is None:
+        return None
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA).astype(np.int16)
+    dhash = _bits_to_int(small[:, 1:] > small[:, :-1])
+    dct = cv2.dct(cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32))[:8, :8]
+    phash = _bits_to_int(dct > np.median(dct.flatten()[1:]))
+    return dhash, phash
+
+
+def content_digest(image_path):
+    """SHA-256 hex digest of the file's bytes, or None if it cannot be read."""
+    digest = hashlib.sha256()
     try:
-        liveness_result_dict = DeepFace.verify(
-            img1_path=live_image_path,
-            img2_path=dummy_reference_image_path,
-            model_name=VERIFICATION_MODEL_NAME,
-            detector_backend=DETECTOR_BACKEND_LIVE,
-            distance_metric=DISTANCE_METRIC,
-            anti_spoofing=True,
-            enforce_detection=True
-        )
-        print(f"Liveness check (DeepFace.verify) raw result: {json.dumps(liveness_result_dict, default=str)}")
-        is_spoof_flag = liveness_result_dict.get("is_spoof", False)
-        if is_spoof_flag:
-            liveness_outcome_message = "FAILED (Spoof Detected via 'is_spoof' flag)"
-        else:
-            liveness_outcome_message = "PASSED"
-            liveness_passed = True
+        with open(image_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+class ReplayIndex:
+    """
+    Recently seen live images, with the liveness verdict and live embedding
+    computed for them, and the ID-card faces they were matched against.
+
+    Cached results are reused only for the exact same file (SHA-256 of the
+    bytes): a re-submitted selfie skips the detector, anti-spoofing and
+    Facenet. A merely similar image (dHash and pHash within max_hamming bits,
+    e.g. a re-encoded or resized copy) never gets another submission's
+    verdict or embedding — it shares only the replay record, so a selfie
+    (or a near copy of it) matched against more than one ID-card face is
+    flagged as a suspicious replay.
+
+    Entries expire REPLAY_INDEX_TTL_SECONDS after they were first seen; the
+    oldest are dropped beyond REPLAY_INDEX_MAX_ENTRIES. Near-copy lookups are
+    a linear Hamming scan (a few milliseconds at the default size). Per process.
+    """
+
+    def __init__(self, max_entries, ttl_seconds, max_hamming):
+        self.max_entries = max(1, max_entries)
+        self.ttl_seconds = ttl_seconds
+        self.max_hamming = max_hamming
+        self._entries = collections.OrderedDict()    # content digest -> entry, oldest first
+        self._digest_hashes = collections.OrderedDict()  # content digest -> perceptual hashes (small memo)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.suspicious = 0
+
+    def _key(self, image_path):
+        """(digest, (dhash, phash)) for an image, or None if it cannot be read."""
+        digest = content_digest(image_path)
+        if digest is None:
+            return None
+        with self._lock:
+            if digest in self._digest_hashes:
+                return digest, self._digest_hashes[digest]
+        hashes = image_hashes(image_path)
+        if hashes is None:
+            return None
+        with self._lock:
+            self._digest_hashes[digest] = hashes
+            while len(self._digest_hashes) > 64:
+                self._digest_hashes.popitem(last=False)
+        return digest, hashes
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl_seconds
+        while self._entries and next(iter(self._entries.values()))["created_at"] < cutoff:
+            self._entries.popitem(last=False)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _find_similar(self, hashes):
+        dhash, phash = hashes
+        for entry in reversed(self._entries.values()):
+            if ((entry["dhash"] ^ dhash).bit_count() <= self.max_hamming
+                    and (entry["phash"] ^ phash).bit_count() <= self.max_hamming):
+                return entry
+        return None
+
+    def _entry(self, key):
+        """The entry for this exact content, created (sharing a near copy's replay record) if new."""
+        digest, hashes = key
+        self._expire()
+        entry = self._entries.get(digest)
+        if entry is None:
+            similar = self._find_similar(hashes)
+            entry = {"dhash": hashes[0], "phash": hashes[1], "created_at": time.time(),
+                     "results": {},
+                     "replay": similar["replay"] if similar else {"matches": 0, "identities": []}}
+            self._entries[digest] = entry
+            self._expire()
+        return entry
+
+    def lookup(self, image_path):
+        """Cached results for this exact image content: a dict copy, or None."""
+        key = self._key(image_path)
+        if key is None:
+            return None
+        with self._lock:
+            self._expire()
+            entry = self._entries.get(key[0])
+            if entry is None or not entry["results"]:
+                return None
+            self.hits += 1
+            return dict(entry["results"])
+
+    def record(self, image_path, **results):
+        """Stores results (liveness=(passed, message, detector), embedding=..., detector=...) for an image."""
+        key = self._key(image_path)
+        if key is None:
+            return
+        with self._lock:
+            self._entry(key)["results"].update(results)
+
+    def note_identity(self, image_path, id_embedding):
+        """
+        Records the ID-card embedding this image (or a near copy of it) was
+        matched against. Returns (times_matched, other_identities): how often
+        the image has been matched against an ID face and how many clearly
+        different ID faces it was used with before.
+        """
+        key = self._key(image_path)
+        if key is None:
+            return 0, 0
+        with self._lock:
+            replay = self._entry(key)["replay"]
+            replay["matches"] += 1
+            others = [known for known in replay["identities"]
+                      if _cosine_distance(known, id_embedding) > CUSTOM_SYSTEM_THRESHOLD]
+            if len(others) == len(replay["identities"]) and len(replay["identities"]) < 8:
+                replay["identities"].append(list(id_embedding))
+            if others:
+                self.suspicious += 1
+            return replay["matches"], len(others)
+
+    def snapshot(self):
+        with self._lock:
+            self._expire()
+            return {"entries": len(self._entries), "hits": self.hits, "suspicious": self.suspicious}
+
+
+_replay_index = ReplayIndex(REPLAY_INDEX_MAX_ENTRIES, REPLAY_INDEX_TTL_SECONDS, REPLAY_MAX_HAMMING)
+
+
+def replay_index_stats():
+    return _replay_index.snapshot()
+
+
+def _replay_lookup(image_path):
+    if not REPLAY_INDEX_ENABLED:
+        return None
+    try:
+        return _replay_index.lookup(image_path)
+    except Exception as e_hash:
+        print(f"Replay index lookup failed: {e_hash}")
+        return None
+
+
+def _replay_record(image_path, **results):
+    if REPLAY_INDEX_ENABLED:
+        try:
+            _replay_index.record(image_path, **results)
+        except Exception as e_hash:
+            print(f"Replay index update failed: {e_hash}")
+
+
+def _flag_replay(match_details, live_image_path, id_card_embedding_list):
+    """Adds match_details["replay"] when this live image was submitted before."""
+    if not REPLAY_INDEX_ENABLED:
+        return
+    try:
+        matched, other_identities = _replay_index.note_identity(live_image_path, id_card_embedding_list)
+    except Exception as e_hash:
+        print(f"Replay index update failed: {e_hash}")
+        return
+    if matched > 1:
+        match_details["replay"] = {"times_matched": matched, "other_identities": other_identities,
+                                   "suspicious": other_identities > 0}
+        if other_identities:
+            print(f"WARNING: Suspicious replay — live image matched {matched} times, "
+                  f"matched against {other_identities} other ID face(s).")
+
+
+def _liveness_verdict(live_image_path, progress=None):
+    """
+    Runs the detector cascade with anti-spoofing once.
+    Returns (passed, message, primary_face_or_None, detector_used_or_None).
+    """
+    try:
+        # Only the anti-spoofing verdict is needed here, so run the detector cascade
+        # with anti_spoofing instead of a full verify() against the reference image.
+        faces, detector_used = face_detector.detect_faces(live_image_path, anti_spoofing=True,
+                                                          progress=progress)
+        primary = faces[0]
+        print(f"Liveness check raw result: detector={detector_used}, "
+              f"is_real={primary.get('is_real')}, antispoof_score={primary.get('antispoof_score')}")
+        if not primary.get("is_real", False):
+            message = f"FAILED (Spoof Detected via 'is_real' flag, detector: {detector_used})"
+            _replay_record(live_image_path, liveness=(False, message, detector_used))
+            return False, message, primary, detector_used
+        message = f"PASSED (detector: {detector_used})"
+        _replay_record(live_image_path, liveness=(True, message, detector_used))
+        return True, message, primary, detector_used
     except ValueError as ve:
         error_str = str(ve)
         original_cause_error_str = str(ve.__cause__) if ve.__cause__ else ""
@@ -62,21 +317,113 @@ def perform_liveness_check(live_image_path, dummy_reference_image_path):
             liveness_outcome_message = "FAILED (Face Detection Error during Liveness)"
         else:
             liveness_outcome_message = f"ERROR (Other ValueError: {error_str[:100]})"
-        liveness_passed = False
     except Exception as e_live:
         print(f"Unexpected error during liveness check: {e_live}")
         traceback.print_exc()
         liveness_outcome_message = f"ERROR (Unexpected: {str(e_live)[:100]})"
-        liveness_passed = False
+    return False, liveness_outcome_message, None, None
+
+
+def perform_liveness_check(live_image_path, dummy_reference_image_path, progress=None):
+    print(f"\n--- Performing Liveness Check on: {live_image_path} ---")
+    deadline.check("liveness")
+
+    if not os.path.exists(live_image_path):
+        print(f"Liveness FAILED: Live image not found at '{live_image_path}'")
+        return False, "Liveness FAILED: Live image file missing."
+    if not os.path.exists(dummy_reference_image_path):
+        print(f"CRITICAL ERROR: Dummy liveness reference image not found at '{dummy_reference_image_path}'")
+        return False, "Liveness FAILED: System configuration error (missing reference image)."
+
+    cached = _replay_lookup(live_image_path)
+    if cached and "liveness" in cached:
+        liveness_passed, liveness_outcome_message, _ = cached["liveness"]
+        liveness_outcome_message += " [replayed image: cached verdict]"
+        if progress:
+            progress("Identical image seen recently; cached liveness verdict reused.")
+    else:
+        liveness_passed, liveness_outcome_message, _, _ = _liveness_verdict(live_image_path, progress)
     print(f"Liveness Outcome: {liveness_outcome_message}")
     return liveness_passed, liveness_outcome_message
 
 
-def verify_faces(live_image_path, id_card_embedding_list):
-    print(f"\n--- Performing Face Verification: Live vs ID Card (System Threshold: {CUSTOM_SYSTEM_THRESHOLD}) ---")
-    system_verification_passed = False 
+def perform_burst_liveness_check(frame_paths, dummy_reference_image_path, progress=None):
+    """
+    Liveness over a burst of camera frames of the same selfie. Frames are
+    detected and anti-spoofed a batch at a time, only as many as could still
+    settle the outcome, and the check stops as soon as LIVENESS_BURST_AGREE
+    frames agree (real or spoof). If the frames run out first, a strict
+    majority of real frames passes.
+
+    Returns (passed, message, best_frame) — best_frame is
+    (frame_path, face_bgr, detector_used) for the sharpest real frame, to be
+    handed to verify_faces(live_face=...), or None.
+    """
+    print(f"\n--- Performing Burst Liveness Check on {len(frame_paths)} frame(s) ---")
+    deadline.check("liveness")
+    frames = [path for path in frame_paths[:LIVENESS_BURST_MAX_FRAMES] if os.path.exists(path)]
+    if not frames:
+        print("Liveness FAILED: No live frames found.")
+        return False, "Liveness FAILED: Live image file missing.", None
+    if not os.path.exists(dummy_reference_image_path):
+        print(f"CRITICAL ERROR: Dummy liveness reference image not found at '{dummy_reference_image_path}'")
+        return False, "Liveness FAILED: System configuration error (missing reference image).", None
+
+    agree = max(1, min(LIVENESS_BURST_AGREE, len(frames)))
+    real, spoof, pending = [], 0, frames
+    try:
+        while pending and len(real) < agree and spoof < agree:
+            deadline.check("liveness")
+            batch_size = agree - max(len(real), spoof)
+            batch, pending = pending[:batch_size], pending[batch_size:]
+            for frame in face_detector.detect_burst_faces(batch, progress=progress):
+                if frame[1]["is_real"]:
+                    real.append(frame)
+                else:
+                    spoof += 1
+            print(f"Burst liveness so far: {len(real)} real, {spoof} spoof, {len(pending)} frame(s) left")
+    except deadline.DeadlineExceeded:
+        raise
+    except Exception as e_live:
+        print(f"Unexpected error during burst liveness check: {e_live}")
+        traceback.print_exc()
+        return False, f"ERROR (Unexpected: {str(e_live)[:100]})", None
+
+    scored = len(real) + spoof
+    if scored == 0:
+        message = "FAILED (Face Detection Error during Liveness)"
+    elif len(real) >= agree or (spoof < agree and len(real) > spoof):
+        frame_path, face, detector_used = max(real, key=lambda frame: frame[1]["sharpness"])
+        message = f"PASSED ({len(real)}/{scored} frames real, detector: {detector_used})"
+        print(f"Liveness Outcome: {message}; sharpest real frame: {frame_path}")
+        return True, message, (frame_path, _face_to_bgr_uint8(face["face"]), detector_used)
+    else:
+        message = f"FAILED (Spoof Detected in {spoof}/{scored} frames)"
+    print(f"Liveness Outcome: {message}")
+    return False, message, None
+
+
+def liveness_and_live_face(live_image_path):
+    """
+    Liveness verdict plus the aligned live face (BGR uint8) from the same
+    detector pass, for callers that embed faces themselves in batches.
+    Returns (passed, message, face_bgr_or_None, detector_used).
+    """
+    if not os.path.exists(live_image_path):
+        return False, "Liveness FAILED: Live image file missing.", None, None
+    passed, message, primary, detector_used = _liveness_verdict(live_image_path)
+    face_bgr = _face_to_bgr_uint8(primary["face"]) if passed else None
+    return passed, message, face_bgr, detector_used
+
+
+def _detect_live_face(live_image_path):
+    faces, _ = face_detector.detect_faces(live_image_path)
+    return _face_to_bgr_uint8(faces[0]["face"])
+
+
+def _new_match_details():
     # Initialize with a structure that matches the TS interface, using default/error values
-    match_details = {
+    return {
         "verified": False, # Will be updated based on CUSTOM_SYSTEM_THRESHOLD
         "distance": "N/A",
         "threshold": f"{CUSTOM_SYSTEM_THRESHOLD:.4f}", # System's threshold
@@ -89,6 +436,191 @@ def verify_faces(live_image_path, id_card_embedding_list):
         # "deepface_verified_flag": False,
     }
 
+
+def _apply_threshold(match_details, distance_val):
+    """Fills match_details from a distance using CUSTOM_SYSTEM_THRESHOLD and returns the verdict."""
+    match_details["tier"] = "fast"
+    # YOUR SYSTEM'S VERIFICATION LOGIC using CUSTOM_SYSTEM_THRESHOLD
+    if distance_val <= CUSTOM_SYSTEM_THRESHOLD:
+        system_verification_passed = True
+        current_message = f"Face Verification PASSED (System Threshold: {CUSTOM_SYSTEM_THRESHOLD:.4f}, Distance: {distance_val:.4f})."
+    else:
+        system_verification_passed = False
+        current_message = f"Face Verification FAILED (System Threshold: {CUSTOM_SYSTEM_THRESHOLD:.4f}, Distance: {distance_val:.4f})."
+
+    # Update match_details with actual results, aligning with TS interface
+    match_details["verified"] = system_verification_passed
+    match_details["distance"] = f"{distance_val:.4f}"
+    match_details["threshold"] = f"{CUSTOM_SYSTEM_THRESHOLD:.4f}" # Show the threshold used by system
+    match_details["message"] = current_message
+    return system_verification_passed
+
+
+def strong_embedding(face_bgr):
+    """{"model", "embedding"} of a cropped BGR face from STRONG_MODEL_NAME, or None."""
+    embedding = inference_backend.get_backend().represent(face_bgr, STRONG_MODEL_NAME)
+    return {"model": STRONG_MODEL_NAME, "embedding": embedding} if embedding else None
+
+
+def ensure_strong_embedding(id_strong):
+    """
+    The ID face's strong-model embedding from an id_strong dict (see
+    _escalate), computing it from the stored crop if no match needed it.
+    Stored with the user so /reverify can escalate later. None when
+    escalation is disabled or there is no crop.
+    """
+    if ESCALATION_MARGIN <= 0 or not id_strong:
+        return None
+    current = id_strong.get("embedding")
+    if current and current.get("model") == STRONG_MODEL_NAME:
+        return current
+    if id_strong.get("face") is None:
+        return None
+    try:
+        id_strong["embedding"] = strong_embedding(id_strong["face"])
+    except Exception as e_strong:
+        print(f"Could not compute {STRONG_MODEL_NAME} embedding for the ID face: {e_strong}")
+        traceback.print_exc()
+        return None
+    return id_strong["embedding"]
+
+
+def _escalate(match_details, passed, live_face, id_strong, progress=None):
+    """
+    Second tier of the matcher. A Facenet distance within ESCALATION_MARGIN
+    of the threshold is re-decided by STRONG_MODEL_NAME; anything else keeps
+    the Facenet verdict. match_details records the deciding tier ("fast" or
+    "strong") and, after an escalation, the Facenet result under "first_tier".
+
+    live_face is the live crop (BGR) or a zero-argument callable producing it.
+    id_strong is {"face": ID crop or None, "embedding": {"model", "embedding"}
+    or None}; a strong ID embedding computed here is put back into it so the
+    caller can store it. Returns the final verdict.
+    """
+    if match_details.get("tier") != "fast":
+        return passed    # no Facenet distance to judge
+    distance_val = float(match_details["distance"])
+    if ESCALATION_MARGIN <= 0 or abs(distance_val - CUSTOM_SYSTEM_THRESHOLD) > ESCALATION_MARGIN:
+        return passed
+    if not deadline.allows_optional():
+        match_details["escalation"] = "skipped: request deadline is near"
+        print(f"Escalation skipped: {match_details['escalation']}")
+        return passed
+    if progress:
+        progress(f"Borderline {VERIFICATION_MODEL_NAME} distance {distance_val:.4f}; "
+                 f"escalating to {STRONG_MODEL_NAME}...")
+    try:
+        id_embedding = ensure_strong_embedding(id_strong)
+        if id_embedding is None:
+            match_details["escalation"] = f"unavailable: no {STRONG_MODEL_NAME} embedding for the ID face"
+            print(f"Escalation skipped: {match_details['escalation']}")
+            return passed
+        live_embedding = strong_embedding(live_face() if callable(live_face) else live_face)
+        if live_embedding is None:
+            raise ValueError(f"{STRONG_MODEL_NAME} embedding for the live face could not be generated.")
+    except Exception as e_strong:
+        print(f"Escalation to {STRONG_MODEL_NAME} failed: {e_strong}")
+        traceback.print_exc()
+        match_details["escalation"] = f"failed: {str(e_strong)[:100]}"
+        return passed
+
+    strong_distance = _cosine_distance(live_embedding["embedding"], id_embedding["embedding"])
+    strong_passed = strong_distance <= STRONG_MODEL_THRESHOLD
+    match_details["first_tier"] = {
+        "model": match_details["model"], "distance": match_details["distance"],
+        "threshold": match_details["threshold"], "verified": passed,
+    }
+    match_details.update(
+        tier="strong",
+        model=STRONG_MODEL_NAME,
+        verified=strong_passed,
+        distance=f"{strong_distance:.4f}",
+        threshold=f"{STRONG_MODEL_THRESHOLD:.4f}",
+        message=(f"Face Verification {'PASSED' if strong_passed else 'FAILED'} "
+                 f"({STRONG_MODEL_NAME} escalation, {VERIFICATION_MODEL_NAME} distance {distance_val:.4f} "
+                 f"was borderline; Threshold: {STRONG_MODEL_THRESHOLD:.4f}, Distance: {strong_distance:.4f})."),
+    )
+    print(f"Escalated to {STRONG_MODEL_NAME}: distance {strong_distance:.4f} → "
+          f"{'match' if strong_passed else 'no match'}")
+    if progress:
+        progress(f"{STRONG_MODEL_NAME} distance {strong_distance:.4f} decided the match.")
+    return strong_passed
+
+
+def match_embeddings(live_embedding, id_card_embedding_list, detector_used=None, live_face=None, id_strong=None):
+    """
+    Same decision as verify_faces for an already computed live embedding.
+    With the live crop (BGR) and id_strong (see _escalate), borderline
+    distances are escalated to the strong model as verify_faces does.
+    """
+    match_details = _new_match_details()
+    if detector_used:
+        match_details["detector"] = detector_used
+    if not live_embedding or not id_card_embedding_list:
+        match_details["message"] = "Cannot verify: Missing live or ID card embedding."
+        return False, match_details
+    passed = _apply_threshold(match_details, _cosine_distance(live_embedding, id_card_embedding_list))
+    if live_face is not None:
+        passed = _escalate(match_details, passed, live_face, id_strong)
+    return passed, match_details
+
+
+def reverify_against_embedding(live_image_path, stored_embedding_list, stored_strong_embedding=None):
+    """
+    Re-verification of a registered voter: liveness plus a 1:1 match of the
+    selfie against their stored embedding, with the same threshold (and the
+    same escalation to the strong model, when the voter has a stored strong
+    embedding) as verify_faces. The face from the anti-spoofing pass is
+    embedded directly, so the live image goes through the detector once.
+    Returns (liveness_passed, liveness_message, verified, match_details).
+    """
+    deadline.check("liveness")
+    cached = _replay_lookup(live_image_path)
+    face_bgr = None
+    if cached and "liveness" in cached and cached.get("embedding"):
+        liveness_passed, liveness_message, detector_used = cached["liveness"]
+        live_embedding = cached["embedding"]
+    else:
+        liveness_passed, liveness_message, face_bgr, detector_used = liveness_and_live_face(live_image_path)
+        live_embedding = None
+    if not liveness_passed:
+        match_details = _new_match_details()
+        match_details["message"] = "Face Verification not performed: liveness check failed."
+        return False, liveness_message, False, match_details
+    if live_embedding is None:
+        deadline.check("face_match")
+        try:
+            live_embedding = inference_backend.get_backend().represent(face_bgr, VERIFICATION_MODEL_NAME)
+            _replay_record(live_image_path, embedding=live_embedding, detector=detector_used)
+        except Exception as e_embed:
+            print(f"Unexpected error embedding live face for re-verification: {e_embed}")
+            traceback.print_exc()
+    verified, match_details = match_embeddings(live_embedding, stored_embedding_list, detector_used)
+    if live_embedding:
+        verified = _escalate(match_details, verified,
+                             face_bgr if face_bgr is not None else lambda: _detect_live_face(live_image_path),
+                             {"face": None, "embedding": stored_strong_embedding})
+    _flag_replay(match_details, live_image_path, stored_embedding_list)
+    if not live_embedding:
+        match_details["message"] = "Face Verification FAILED: Could not generate embedding for live face."
+    print(f"Re-verification Outcome: {match_details['message']}")
+    return True, liveness_message, verified, match_details
+
+
+def verify_faces(live_image_path, id_card_embedding_list, progress=None, live_face=None, id_strong=None):
+    """
+    Matches the live image against the ID-card embedding. live_face, if
+    given, is (face_bgr, detector_used) already detected in live_image_path
+    (e.g. the sharpest burst frame), so detection is not run again.
+    id_strong ({"face", "embedding"}, see _escalate) enables the strong-model
+    tier for borderline distances.
+    Returns (system_verification_passed, match_details).
+    """
+    print(f"\n--- Performing Face Verification: Live vs ID Card (System Threshold: {CUSTOM_SYSTEM_THRESHOLD}) ---")
+    deadline.check("face_match")
+    system_verification_passed = False 
+    match_details = _new_match_details()
+
     if not os.path.exists(live_image_path):
         match_details["message"] = "Face Verification FAILED: Live image file missing."
         print(match_details["message"])
@@ -100,37 +632,38 @@ def verify_faces(live_image_path, id_card_embedding_list):
         return False, match_details # system_verification_passed is already False
 
     try:
-        result = DeepFace.verify(
-            img1_path=live_image_path,
-            img2_path=id_card_embedding_list,
-            model_name=VERIFICATION_MODEL_NAME,
-            detector_backend=DETECTOR_BACKEND_LIVE,
-            distance_metric=DISTANCE_METRIC,
-            anti_spoofing=False,
-            enforce_detection=True
-        )
-        print(f"Face verification (DeepFace.verify) raw result: {json.dumps(result, default=str)}")
+        face_bgr = None
+        cached = _replay_lookup(live_image_path) if live_face is None else None
+        if cached and cached.get("embedding") and cached.get("detector"):
+            detector_used, live_embedding = cached["detector"], cached["embedding"]
+            match_details["detector"] = detector_used
+            if progress:
+                progress("Identical image seen recently; cached live embedding reused.")
+        else:
+            if live_face is None:
+                faces, detector_used = face_detector.detect_faces(live_image_path, progress=progress)
+                face_bgr = _face_to_bgr_uint8(faces[0]["face"])
+            else:
+                face_bgr, detector_used = live_face
+            match_details["detector"] = detector_used
+            live_embedding = inference_backend.get_backend().represent(face_bgr, VERIFICATION_MODEL_NAME)
+            if not live_embedding:
+                raise ValueError("Embedding for face could not be generated.")
+            _replay_record(live_image_path, embedding=live_embedding, detector=detector_used)
+            if progress:
+                progress(f"Live face {VERIFICATION_MODEL_NAME} embedding computed.")
+        result = {"distance": _cosine_distance(live_embedding, id_card_embedding_list),
+                  "detector": detector_used}
+        print(f"Face verification raw result: {json.dumps(result, default=str)}")
 
         distance_val = result.get("distance", float('inf'))
-        # deepface_internal_threshold_val = result.get("threshold", STANDARD_DEEPFACE_THRESHOLD)
-        # deepface_verified_flag_val = result.get("verified", False)
-
-        # YOUR SYSTEM'S VERIFICATION LOGIC using CUSTOM_SYSTEM_THRESHOLD
-        if distance_val <= CUSTOM_SYSTEM_THRESHOLD:
-            system_verification_passed = True
-            current_message = f"Face Verification PASSED (System Threshold: {CUSTOM_SYSTEM_THRESHOLD:.4f}, Distance: {distance_val:.4f})."
-        else:
-            system_verification_passed = False
-            current_message = f"Face Verification FAILED (System Threshold: {CUSTOM_SYSTEM_THRESHOLD:.4f}, Distance: {distance_val:.4f})."
-
-        # Update match_details with actual results, aligning with TS interface
-        match_details["verified"] = system_verification_passed
-        match_details["distance"] = f"{distance_val:.4f}"
-        match_details["threshold"] = f"{CUSTOM_SYSTEM_THRESHOLD:.4f}" # Show the threshold used by system
-        match_details["message"] = current_message
-        # Optional: include DeepFace's own assessment for debugging if needed elsewhere
-        # match_details["deepface_standard_threshold"] = f"{deepface_internal_threshold_val:.4f}"
-        # match_details["deepface_verified_flag"] = deepface_verified_flag_val
+        system_verification_passed = _apply_threshold(match_details, distance_val)
+        system_verification_passed = _escalate(
+            match_details, system_verification_passed,
+            face_bgr if face_bgr is not None else lambda: _detect_live_face(live_image_path),
+            id_strong, progress,
+        )
+        _flag_replay(match_details, live_image_path, id_card_embedding_list)
         
     except ValueError as ve:
         error_str = str(ve).lower()
@@ -1,21 +1,32 @@
 # ml_logic/id_card_processor.py
-from google.generativeai import GenerativeModel
-from PIL import Image as PIL_Image
+# cv2 and PIL are imported inside the functions that use them so importing this
+# module does not pull in image libraries before a request needs them.
 import io
 import json
 import os
 import re
 import numpy as np
-from deepface import DeepFace
-import cv2
 import traceback
+from typing import TypedDict
+
+from ml_logic import card_layout
+from ml_logic import deadline
+from ml_logic import face_detector
+from ml_logic import id_fields
+from ml_logic import inference_backend
 
 EXTRACTION_MODEL_NAME  = 'Facenet'
-DETECTOR_BACKEND_ID    = 'retinaface'
+# RetinaFace is now the fallback stage of the detector cascade (see face_detector.py)
+DETECTOR_BACKEND_ID    = face_detector.FALLBACK_DETECTOR_BACKEND
+# Rounds of re-reading OCR fields that fail id_fields checks (0 disables).
+OCR_FIELD_RETRIES      = int(os.getenv("OCR_FIELD_RETRIES", "1"))
+# Longest side (px) of the rectified card sent for a field re-read.
+OCR_RETRY_MAX_SIDE     = int(os.getenv("OCR_RETRY_MAX_SIDE", "1024"))
 
 
 def preprocess_face_image_for_id(face_image_np):
     """Preprocessing specific for ID card faces — CLAHE contrast enhancement."""
+    import cv2
     print("Preprocessing ID card face...")
     processed_face = face_image_np.copy()
     if len(processed_face.shape) == 2 or processed_face.shape[2] == 1:
@@ -34,134 +45,270 @@ def preprocess_face_image_for_id(face_image_np):
 
 
 # ── Step 1 ────────────────────────────────────────────────────────────────────
+OCR_PROMPT = """
+    You are an expert OCR and document understanding assistant specialising in Indian ID cards.
+    Identify the card type and extract these fields:
+
+      card_type:          One of: 'Voter ID', 'Aadhaar card', 'PAN card', 'Driving License'
+      name:               Full name as printed.
+      dob:                Date of birth in DD-MM-YYYY format.
+      aadhaar_no:         12-digit primary Aadhaar number ONLY (not the 16-digit VID).
+      pan_no:             PAN number, if present.
+      license_no:         Driving licence number, if present.
+      expiration_date:    Validity/expiry date, if present.
+      father_mother_name: Father's or Mother's name, if present.
+      voter_id_number:    EPIC/Voter ID number, ONLY for Voter ID cards.
+
+    Rules:
+    - Omit keys not applicable to this card type (do NOT use 'N/A').
+    - Extract the 12-digit Aadhaar number without spaces (e.g. '751490185308').
+    - Never confuse the 16-digit VID on Aadhaar cards with a Voter ID number.
+    """
+
+
+def _jpeg_part(img_bgr_or_pil):
+    """Gemini inline image part for a PIL image or a BGR numpy array."""
+    if isinstance(img_bgr_or_pil, np.ndarray):
+        import cv2
+        ok, encoded = cv2.imencode(".jpg", img_bgr_or_pil, [cv2.IMWRITE_JPEG_QUALITY, 90])
+        if not ok:
+            raise ValueError("Could not encode image for OCR.")
+        return {"mime_type": "image/jpeg", "data": encoded.tobytes()}
+    buf = io.BytesIO()
+    img_bgr_or_pil.save(buf, format="JPEG")
+    return {"mime_type": "image/jpeg", "data": buf.getvalue()}
+
+
+def _generate_json(gemini_model, contents, schema):
+    """
+    Schema-constrained Gemini call, bounded by the request deadline; returns
+    (parsed_dict_or_None, raw_text).
+    """
+    deadline.check("document")
+    timeout = deadline.call_timeout()
+    response = gemini_model.generate_content(
+        contents,
+        generation_config={"response_mime_type": "application/json", "response_schema": schema},
+        request_options={"timeout": timeout} if timeout else None,
+    )
+    # Structured output has no markdown fences; stripping them is harmless if a model adds some.
+    raw = re.sub(r"```json|```", "", response.text).strip()
+    try:
+        parsed = json.loads(raw)
+    except json.JSONDecodeError as e:
+        print(f"  JSON parse error: {e}\n  Raw: {raw}")
+        return None, raw
+    return (parsed if isinstance(parsed, dict) else None), raw
+
+
+def _field_retry_image(image_path):
+    """The rectified card (fewer image tokens, no background) for re-reads, or None to reuse the upload."""
+    import cv2
+    try:
+        img = face_detector._load_bgr(image_path)
+        quad = card_layout.find_card_quad(img)
+        if quad is None:
+            return None
+        card = card_layout.rectify(img, quad)
+    except Exception as e:
+        print(f"  Card crop for field re-read failed ({e}); reusing the full image.")
+        return None
+    h, w = card.shape[:2]
+    if OCR_RETRY_MAX_SIDE > 0 and max(h, w) > OCR_RETRY_MAX_SIDE:
+        scale = OCR_RETRY_MAX_SIDE / float(max(h, w))
+        card = cv2.resize(card, (round(w * scale), round(h * scale)), interpolation=cv2.INTER_AREA)
+    return card
+
+
+def _reread_fields(image_path, image_part, gemini_model, details, problems):
+    """
+    Asks Gemini again for only the fields in `problems`, on the rectified card
+    when one is found. Re-read values replace the old ones when they pass
+    their check (or the old value was missing). Returns the updated details.
+    """
+    fields = list(problems)
+    print(f"  Re-reading {len(fields)} field(s) that failed validation: {problems}")
+    card = _field_retry_image(image_path)
+    part = _jpeg_part(card) if card is not None else image_part
+    wanted = "\n".join(f"      {f}: {id_fields.FIELD_HINTS[f]} (previous reading rejected: {problems[f]})"
+                       for f in fields)
+    card_type = details.get("card_type")
+    prompt = (
+        f"This is an Indian ID card{f' ({card_type})' if card_type in id_fields.CARD_TYPES else ''}. "
+        f"Read ONLY these fields exactly as printed:\n{wanted}\n"
+        "Omit a field if it is not printed on the card."
+    )
+    schema = TypedDict("IdCardFieldReread", {f: str for f in fields}, total=False)
+    reread, _raw = _generate_json(gemini_model, [prompt, part], schema)
+    if not reread:
+        return details
+
+    merged = dict(details)
+    candidate = id_fields.normalise({f: reread[f] for f in fields if f in reread})
+    for field, value in candidate.items():
+        trial = dict(merged, **{field: value})
+        if field not in merged or field not in id_fields.invalid_fields(trial):
+            merged[field] = value
+    return merged
+
+
 def extract_text_from_id(image_path: str, gemini_model) -> dict:
     """
     Sends the ID card image to Gemini and returns a dict of extracted text fields.
-    Raises on hard failure so the caller can emit the correct SSE event.
+    The reply is schema-constrained JSON (id_fields.IdCardDetails); fields that
+    fail the local checks are re-requested on their own, up to
+    OCR_FIELD_RETRIES times while the request deadline leaves room, and any
+    still failing are listed under "field_warnings". Raises on hard failure
+    (DeadlineExceeded once the deadline has passed) so the caller can emit
+    the correct SSE event.
     """
+    from PIL import Image as PIL_Image
     print(f"\n--- [OCR] Sending ID card to Gemini: {image_path} ---")
 
     pil_img = PIL_Image.open(image_path)
     if pil_img.mode != "RGB":
         pil_img = pil_img.convert("RGB")
-    buf = io.BytesIO()
-    pil_img.save(buf, format="JPEG")
-    buf.seek(0)
-    image_part = {"mime_type": "image/jpeg", "data": buf.read()}
+    image_part = _jpeg_part(pil_img)
 
-    prompt = """
-    You are an expert OCR and document understanding assistant specialising in Indian ID cards.
-    Identify the card type and extract details into a JSON object with ONLY these exact keys:
-
-    {
-      "card_type":         "One of: 'Voter ID', 'Aadhaar card', 'PAN card', 'Driving License'",
-      "name":              "Full name as printed.",
-      "dob":               "Date of birth in DD-MM-YYYY format.",
-      "aadhaar_no":        "12-digit primary Aadhaar number ONLY (not the 16-digit VID).",
-      "pan_no":            "PAN number, if present.",
-      "license_no":        "Driving licence number, if present.",
-      "expiration_date":   "Validity/expiry date, if present.",
-      "father_mother_name":"Father's or Mother's name, if present.",
-      "voter_id_number":   "EPIC/Voter ID number, ONLY for Voter ID cards."
-    }
+    details, raw = _generate_json(gemini_model, [OCR_PROMPT, image_part], id_fields.IdCardDetails)
+    if details is None:
+        return {"error": "Failed to parse OCR details", "raw_ocr": raw}
+    details = id_fields.normalise(details)
+    print(f"  Gemini extracted: {details}")
 
-    Rules:
-    - Omit keys not applicable to this card type (do NOT use 'N/A').
-    - Extract the 12-digit Aadhaar number without spaces (e.g. '751490185308').
-    - Never confuse the 16-digit VID on Aadhaar cards with a Voter ID number.
-    - Return ONLY the JSON object — no markdown, no extra text.
-    """
+    problems = id_fields.invalid_fields(details)
+    for _ in range(OCR_FIELD_RETRIES):
+        if not problems:
+            break
+        if not deadline.allows_optional():
+            print("  Skipping field re-read: request deadline is near.")
+            break
+        details = _reread_fields(image_path, image_part, gemini_model, details, problems)
+        problems = id_fields.invalid_fields(details)
+
+    if problems:
+        print(f"  Fields still failing validation: {problems}")
+        details["field_warnings"] = problems
+    return details
 
-    response     = gemini_model.generate_content([prompt, image_part])
-    cleaned_text = re.sub(r"```json|```", "", response.text).strip()
 
+# ── Step 2 ────────────────────────────────────────────────────────────────────
+def _detect_id_face(image_path, card_type, progress):
+    """
+    Detector cascade on the card's photo region first (upright, then the card
+    turned by 180°), then on the whole image.
+    """
+    img = face_detector._load_bgr(image_path)
     try:
-        details = json.loads(cleaned_text)
-        print(f"  Gemini extracted: {details}")
-        return details
-    except json.JSONDecodeError as e:
-        print(f"  JSON parse error: {e}\n  Raw: {cleaned_text}")
-        return {"error": "Failed to parse OCR details", "raw_ocr": cleaned_text}
+        candidates, where = card_layout.face_search_images(img, card_type)
+    except Exception as e:
+        candidates, where = [], f"card layout error: {e}"
 
+    candidates = [(crop, desc) for crop, desc in candidates if crop is not None and crop.size]
+    for search_img, desc in candidates:
+        print(f"  Running face detector cascade on {desc}...")
+        try:
+            faces, detector_used = face_detector.detect_faces(search_img, align=True, progress=progress)
+            if faces:
+                return faces, detector_used
+        except ValueError as e:
+            print(f"  No face in {desc} ({e})")
+        deadline.check("document")
+    if candidates:
+        print("  Falling back to the full ID card image...")
+        if progress:
+            progress(f"No face in {where} either way up, searching the full image...")
+    else:
+        print(f"  Card layout not used ({where})")
 
-# ── Step 2 ────────────────────────────────────────────────────────────────────
-def extract_face_from_id(image_path: str):
+    print(f"  Running face detector cascade ({face_detector.FAST_DETECTOR_BACKEND} → {DETECTOR_BACKEND_ID})...")
+    return face_detector.detect_faces(img, align=True, progress=progress)
+
+
+def prepare_id_face(image_path: str, progress=None, card_type=None):
     """
-    Detects the face on an ID card, preprocesses it, and returns a Facenet embedding.
+    Detects the face on an ID card and returns it ready for embedding.
+    card_type (from OCR), if given, narrows the search to that card's photo
+    region (see card_layout); the full image is searched when that misses.
 
     Returns:
-        (embedding_list, info_str)  — embedding is None on failure, info_str explains outcome.
+        (preprocessed_face, detector_used, confidence) — raises ValueError when
+        no face is found.
     """
-    print(f"\n--- [Face] Detecting face on ID card: {image_path} ---")
-    temp_path = None
+    # ── 1. Detect & align face (fast detector, RetinaFace fallback) ──────
+    extracted_faces, detector_used = _detect_id_face(image_path, card_type, progress)
 
-    try:
-        # ── 1. Detect & align face ────────────────────────────────────────────
-        print(f"  Running {DETECTOR_BACKEND_ID} face detector...")
-        extracted_faces = DeepFace.extract_faces(
-            img_path=image_path,
-            detector_backend=DETECTOR_BACKEND_ID,
-            enforce_detection=True,
-            align=True,
-        )
+    if not extracted_faces:
+        raise ValueError("No face detected on the ID card. Ensure the photo is clearly visible.")
 
-        if not extracted_faces:
-            return None, "No face detected on the ID card. Ensure the photo is clearly visible."
+    face_np = extracted_faces[0]['face']
+    confidence = extracted_faces[0]['confidence']
+    print(f"  Face detected by {detector_used} — confidence: {confidence:.2f}")
 
-        face_np = extracted_faces[0]['face']
-        confidence = extracted_faces[0]['confidence']
-        print(f"  Face detected — confidence: {confidence:.2f}")
+    if face_np.dtype in (np.float32, np.float64):
+        face_np = (face_np * 255).astype(np.uint8)
 
-        if face_np.dtype in (np.float32, np.float64):
-            face_np = (face_np * 255).astype(np.uint8)
+    # ── 2. Preprocess (CLAHE) ─────────────────────────────────────────────
+    print("  Applying CLAHE contrast enhancement...")
+    return preprocess_face_image_for_id(face_np), detector_used, confidence
 
-        # ── 2. Preprocess (CLAHE) ─────────────────────────────────────────────
-        print("  Applying CLAHE contrast enhancement...")
-        preprocessed = preprocess_face_image_for_id(face_np)
 
-        temp_path = "temp_preprocessed_id_face.jpg"
-        cv2.imwrite(temp_path, preprocessed)
+def extract_face_from_id(image_path: str, progress=None, face_out=None, card_type=None):
+    """
+    Detects the face on an ID card, preprocesses it, and returns a Facenet embedding.
+    progress, if given, is called with a short message after each model pass.
+    card_type, if given, is the OCR'd card type used to pick the photo region.
+    face_out, if given, is a dict that receives the preprocessed crop under
+    "face" (for a later strong-model embedding, see face_verifier).
+
+    Returns:
+        (embedding_list, info_str)  — embedding is None on failure, info_str explains outcome.
+    """
+    print(f"\n--- [Face] Detecting face on ID card: {image_path} ---")
+    deadline.check("document")
+
+    try:
+        preprocessed, detector_used, confidence = prepare_id_face(image_path, progress, card_type)
+        if face_out is not None:
+            face_out["face"] = preprocessed
 
         # ── 3. Generate Facenet embedding ─────────────────────────────────────
+        # The crop is already detected and aligned, so skip a second detector pass.
         print(f"  Generating {EXTRACTION_MODEL_NAME} embedding...")
-        embedding_objs = DeepFace.represent(
-            img_path=temp_path,
-            model_name=EXTRACTION_MODEL_NAME,
-            enforce_detection=True,
-            detector_backend=DETECTOR_BACKEND_ID,
-        )
-
-        if embedding_objs:
-            embedding = embedding_objs[0]['embedding']
+        embedding = inference_backend.get_backend().represent(preprocessed, EXTRACTION_MODEL_NAME)
+
+        if embedding:
             print(f"  Generated {len(embedding)}-d embedding.")
-            return embedding, f"Face detected (confidence {confidence:.2f}). {len(embedding)}-d {EXTRACTION_MODEL_NAME} embedding generated."
+            if progress:
+                progress(f"ID card {EXTRACTION_MODEL_NAME} embedding computed.")
+            return embedding, f"Face detected by {detector_used} (confidence {confidence:.2f}). {len(embedding)}-d {EXTRACTION_MODEL_NAME} embedding generated."
         else:
             return None, "Face detected but embedding generation failed."
 
+    except deadline.DeadlineExceeded:
+        raise
+
     except ValueError as ve:
         msg = str(ve)
         if "Face could not be detected" in msg:
             return None, f"Face detection failed: {msg}"
+        if msg.startswith("No face detected on the ID card"):
+            return None, msg
         return None, f"ValueError during face extraction: {msg}"
 
     except Exception as e:
         traceback.print_exc()
         return None, f"Error during face extraction: {str(e)}"
 
-    finally:
-        if temp_path and os.path.exists(temp_path):
-            try:
-                os.remove(temp_path)
-            except Exception as e_clean:
-                print(f"  Warning: could not remove temp face file: {e_clean}")
-
 
 # ── Legacy wrapper (keeps existing /process_and_verify route working) ─────────
-def extract_text_and_face_from_id(image_path: str, gemini_model):
+def extract_text_and_face_from_id(image_path: str, gemini_model, face_out=None):
     """
     Original combined function — kept so the existing non-streaming route
-    (/process_and_verify) continues to work without any changes.
+    (/process_and_verify) continues to work without any changes. face_out is
+    passed on to extract_face_from_id.
     """
     details_dict         = extract_text_from_id(image_path, gemini_model)
-    embedding, _info_str = extract_face_from_id(image_path)
+    embedding, _info_str = extract_face_from_id(image_path, face_out=face_out,
+                                                card_type=details_dict.get("card_type"))
     return details_dict, embedding
@@ -0,0 +1,166 @@
+# ml_logic/id_fields.py
+"""
+OCR field schema and local checks for Indian ID card details.
+
+IdCardDetails is the response schema Gemini fills in (structured JSON output,
+so there is no markdown to strip). invalid_fields() then checks what came
+back without another model call:
+
+  - aadhaar_no       12 digits, not starting 0/1, Verhoeff check digit
+  - pan_no           AAAAA9999A with a valid holder-type letter
+  - voter_id_number  EPIC: 3 letters + 7 digits
+  - license_no       state code + RTO code + year/serial (spaces and '-' ignored)
+  - dob / expiration_date  real calendar dates, same formats as
+                     votechain_parse_date() in the database
+  - card_type        one of CARD_TYPES, with its document number present
+
+id_card_processor re-asks Gemini for just the fields that fail.
+"""
+import datetime
+import re
+from typing import TypedDict
+
+
+class IdCardDetails(TypedDict, total=False):
+    card_type: str
+    name: str
+    dob: str
+    aadhaar_no: str
+    pan_no: str
+    license_no: str
+    expiration_date: str
+    father_mother_name: str
+    voter_id_number: str
+
+
+FIELDS = tuple(IdCardDetails.__annotations__)
+
+# card_type → field that must be present for that card
+CARD_TYPES = {
+    'Aadhaar card':    'aadhaar_no',
+    'PAN card':        'pan_no',
+    'Voter ID':        'voter_id_number',
+    'Driving License': 'license_no',
+}
+
+# What each field should look like, for the narrow re-request prompt.
+FIELD_HINTS = {
+    "card_type":          "one of: " + ", ".join(f"'{c}'" for c in CARD_TYPES),
+    "name":               "full name as printed",
+    "dob":                "date of birth, DD-MM-YYYY",
+    "aadhaar_no":         "12-digit Aadhaar number without spaces (not the 16-digit VID)",
+    "pan_no":             "10-character PAN, e.g. ABCDE1234F",
+    "license_no":         "driving licence number, e.g. MH12 20110012345",
+    "expiration_date":    "validity/expiry date, DD-MM-YYYY",
+    "father_mother_name": "father's or mother's name",
+    "voter_id_number":    "EPIC number: 3 letters then 7 digits",
+}
+
+_PAN_RE     = re.compile(r"^[A-Z]{3}[ABCFGHJLPT][A-Z][0-9]{4}[A-Z]$")
+_EPIC_RE    = re.compile(r"^[A-Z]{3}[0-9]{7}$")
+_LICENSE_RE = re.compile(r"^[A-Z]{2}[0-9]{2}[0-9A-Z]{9,13}$")
+_EMPTY      = ("", "n/a", "na", "none", "null", "-")
+
+# Verhoeff dihedral-group tables
+_VERHOEFF_D = (
+    (0, 1, 2, 3, 4, 5, 6, 7, 8, 9), (1, 2, 3, 4, 0, 6, 7, 8, 9, 5),
+    (2, 3, 4, 0, 1, 7, 8, 9, 5, 6), (3, 4, 0, 1, 2, 8, 9, 5, 6, 7),
+    (4, 0, 1, 2, 3, 9, 5, 6, 7, 8), (5, 9, 8, 7, 6, 0, 4, 3, 2, 1),
+    (6, 5, 9, 8, 7, 1, 0, 4, 3, 2), (7, 6, 5, 9, 8, 2, 1, 0, 4, 3),
+    (8, 7, 6, 5, 9, 3, 2, 1, 0, 4), (9, 8, 7, 6, 5, 4, 3, 2, 1, 0),
+)
+_VERHOEFF_P = (
+    (0, 1, 2, 3, 4, 5, 6, 7, 8, 9), (1, 5, 7, 6, 2, 8, 3, 0, 9, 4),
+    (5, 8, 0, 3, 7, 9, 6, 1, 4, 2), (8, 9, 1, 6, 0, 4, 3, 5, 2, 7),
+    (9, 4, 5, 3, 1, 2, 6, 8, 7, 0), (4, 2, 8, 6, 5, 7, 3, 9, 0, 1),
+    (2, 7, 9, 3, 8, 0, 6, 4, 1, 5), (7, 0, 4, 6, 9, 1, 3, 2, 5, 8),
+)
+
+
+def verhoeff_valid(number):
+    """True when the trailing digit of `number` is its Verhoeff check digit."""
+    check = 0
+    for i, digit in enumerate(reversed(number)):
+        check = _VERHOEFF_D[check][_VERHOEFF_P[i % 8][int(digit)]]
+    return check == 0
+
+
+def parse_card_date(text):
+    """date for DD-MM-YYYY (also '/' or '.') or YYYY-MM-DD, else None."""
+    text = (text or "").strip()
+    m = re.match(r"^(\d{1,2})[-/.](\d{1,2})[-/.](\d{4})$", text)
+    if m:
+        day, month, year = int(m.group(1)), int(m.group(2)), int(m.group(3))
+    else:
+        m = re.match(r"^(\d{4})-(\d{1,2})-(\d{1,2})$", text)
+        if not m:
+            return None
+        year, month, day = int(m.group(1)), int(m.group(2)), int(m.group(3))
+    try:
+        return datetime.date(year, month, day)
+    except ValueError:
+        return None
+
+
+def normalise(details):
+    """
+    Copy of the OCR details with values stripped, placeholder values ('N/A'
+    and the like) dropped, spaces removed from Aadhaar numbers and document
+    numbers upper-cased. Keys outside FIELDS are kept as they are.
+    """
+    out = {}
+    for key, value in details.items():
+        if key in FIELDS:
+            value = str(value).strip() if value is not None else ""
+            if value.lower() in _EMPTY:
+                continue
+            if key == "aadhaar_no":
+                value = re.sub(r"\s+", "", value)
+            elif key in ("pan_no", "voter_id_number", "license_no"):
+                value = value.upper()
+        out[key] = value
+    return out
+
+
+def _field_problem(key, value, today):
+    if key == "card_type":
+        return None if value in CARD_TYPES else f"unknown card type '{value}'"
+    if key == "aadhaar_no":
+        if not re.fullmatch(r"[2-9][0-9]{11}", value):
+            return "not a 12-digit Aadhaar number"
+        return None if verhoeff_valid(value) else "Aadhaar checksum does not match"
+    if key == "pan_no":
+        return None if _PAN_RE.match(value) else "not a valid PAN format"
+    if key == "voter_id_number":
+        return None if _EPIC_RE.match(value) else "not a valid EPIC format"
+    if key == "license_no":
+        return None if _LICENSE_RE.match(re.sub(r"[\s-]", "", value)) else "not a valid licence number format"
+    if key == "dob":
+        dob = parse_card_date(value)
+        if dob is None:
+            return "not a valid date"
+        return None if datetime.date(1900, 1, 1) <= dob <= today else "date of birth out of range"
+    if key == "expiration_date":
+        # Some cards print words ("Lifetime"); only digit strings are checked.
+        if re.search(r"\d", value) and parse_card_date(value) is None:
+            return "not a valid date"
+    return None
+
+
+def invalid_fields(details):
+    """{field: reason} for every field of normalised OCR details that fails its check."""
+    today = datetime.date.today()
+    problems = {}
+    for key in FIELDS:
+        if key in details:
+            reason = _field_problem(key, details[key], today)
+            if reason:
+                problems[key] = reason
+    if not details.get("name"):
+        problems["name"] = "missing"
+    if "card_type" not in details:
+        problems["card_type"] = "missing"
+    required = CARD_TYPES.get(details.get("card_type"))
+    if required and required not in details:
+        problems[required] = "missing"
+    return problems
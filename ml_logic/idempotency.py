@@ -0,0 +1,153 @@
+# ml_logic/idempotency.py
+"""
+Idempotency-Key support for verification requests.
+
+A client that retries with the same Idempotency-Key header gets the original
+outcome instead of a second run of Gemini, the detectors and the upsert:
+
+  - first request with a key        → claimed, runs normally, response stored
+  - repeat while the first runs     → waits for the first one's response
+  - repeat after it finished        → stored response replayed
+  - same key, different payload     → rejected (KeyMismatch)
+
+Keys are scoped per endpoint and kept for IDEMPOTENCY_TTL_SECONDS in a SQLite
+database (WAL mode) shared by every worker process on the host, like the job
+queue. Server errors (5xx) are not stored: the claim is dropped so a retry
+runs again.
+"""
+import os
+import sqlite3
+import threading
+import time
+
+# --- Configuration ---
+IDEMPOTENCY_DB               = os.getenv("IDEMPOTENCY_DB", os.path.join("uploads", "idempotency.sqlite3"))
+IDEMPOTENCY_TTL_SECONDS      = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+# How long a repeat waits for the original request before answering 409.
+IDEMPOTENCY_WAIT_SECONDS     = float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", "60"))
+# A 'running' claim whose process died is taken over after this long.
+IDEMPOTENCY_STALE_SECONDS    = float(os.getenv("IDEMPOTENCY_STALE_SECONDS", "300"))
+IDEMPOTENCY_POLL_SECONDS     = 0.25
+IDEMPOTENCY_MAX_KEY_LENGTH   = 255
+
+
+class KeyMismatch(Exception):
+    """The key was already used for a request with a different payload."""
+
+
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+
+def _connect():
+    conn = sqlite3.connect(IDEMPOTENCY_DB, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    _ensure_schema(conn)
+    return conn
+
+
+def _ensure_schema(conn):
+    global _schema_ready
+    if _schema_ready:
+        return
+    with _schema_lock:
+        if _schema_ready:
+            return
+        conn.executescript("""
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            endpoint      TEXT NOT NULL,
+            key           TEXT NOT NULL,
+            request_hash  TEXT NOT NULL,
+            status        TEXT NOT NULL,          -- running | done
+            created_at    REAL NOT NULL,
+            expires_at    REAL NOT NULL,
+            status_code   INTEGER,
+            response      TEXT,                   -- stored response body
+            PRIMARY KEY (endpoint, key)
+        );
+        CREATE INDEX IF NOT EXISTS idx_idempotency_expires ON idempotency_keys (expires_at);
+        """)
+        _schema_ready = True
+
+
+def valid_key(key):
+    return bool(key) and len(key) <= IDEMPOTENCY_MAX_KEY_LENGTH
+
+
+def begin(endpoint, key, request_hash):
+    """
+    Claims `key` for this request. Returns None when the caller should run the
+    request (then call complete() or abandon()), or the stored
+    (status_code, body) of a finished original. Waits up to
+    IDEMPOTENCY_WAIT_SECONDS for a running original and raises TimeoutError
+    if it is still running. Raises KeyMismatch for a different payload.
+    """
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+    conn = _connect()
+    try:
+        while True:
+            now = time.time()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("DELETE FROM idempotency_keys WHERE expires_at < ?", (now,))
+                conn.execute(
+                    "DELETE FROM idempotency_keys WHERE endpoint = ? AND key = ? "
+                    "AND status = 'running' AND created_at < ?",
+                    (endpoint, key, now - IDEMPOTENCY_STALE_SECONDS),
+                )
+                row = conn.execute(
+                    "SELECT request_hash, status, status_code, response FROM idempotency_keys "
+                    "WHERE endpoint = ? AND key = ?",
+                    (endpoint, key),
+                ).fetchone()
+                if row is None:
+                    conn.execute(
+                        "INSERT INTO idempotency_keys (endpoint, key, request_hash, status, created_at, expires_at) "
+                        "VALUES (?, ?, ?, 'running', ?, ?)",
+                        (endpoint, key, request_hash, now, now + IDEMPOTENCY_TTL_SECONDS),
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+            if row is None:
+                return None
+            if row["request_hash"] != request_hash:
+                raise KeyMismatch(f"Idempotency-Key '{key}' was used with a different request.")
+            if row["status"] == "done":
+                return row["status_code"], row["response"]
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"Request with Idempotency-Key '{key}' is still running.")
+            time.sleep(IDEMPOTENCY_POLL_SECONDS)
+    finally:
+        conn.close()
+
+
+def complete(endpoint, key, status_code, body):
+    """Stores the response of a claimed request; 5xx responses drop the claim instead."""
+    if status_code >= 500:
+        abandon(endpoint, key)
+        return
+    conn = _connect()
+    try:
+        conn.execute(
+            "UPDATE idempotency_keys SET status = 'done', status_code = ?, response = ? "
+            "WHERE endpoint = ? AND key = ?",
+            (status_code, body, endpoint, key),
+        )
+    finally:
+        conn.close()
+
+
+def abandon(endpoint, key):
+    """Drops a claim without a stored response, so the next retry runs the request."""
+    conn = _connect()
+    try:
+        conn.execute("DELETE FROM idempotency_keys WHERE endpoint = ? AND key = ? AND status = 'running'",
+                     (endpoint, key))
+    finally:
+        conn.close()
+
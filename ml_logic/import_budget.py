@@ -0,0 +1,80 @@
+# ml_logic/import_budget.py
+"""
+Cold-start guard: imports app.py in a fresh interpreter under
+`python -X importtime` and fails if
+
+  - the total import time exceeds IMPORT_TIME_BUDGET_MS, or
+  - any heavy framework that must stay lazy shows up in the import list.
+
+    python -m ml_logic.import_budget            # exit 1 on regression
+    python -m ml_logic.import_budget --top 15   # also print the slowest imports
+
+Run it from the repository root (where app.py lives) in CI or before a deploy.
+"""
+import os
+import subprocess
+import sys
+
+IMPORT_TIME_BUDGET_MS = float(os.getenv("IMPORT_TIME_BUDGET_MS", "1500"))
+
+# Top-level packages that only the request path (or a specific worker type) may load.
+LAZY_ONLY_MODULES = (
+    "deepface",
+    "tensorflow",
+    "keras",
+    "torch",
+    "google.generativeai",
+    "cv2",
+    "psycopg2",
+    "onnxruntime",
+    "retinaface",
+)
+
+
+def measure(module="app"):
+    """Returns [(cumulative_us, module_name), ...] for `import <module>`."""
+    env = dict(os.environ)
+    env.pop("PYTHONSTARTUP", None)
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, env=env,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"`import {module}` failed:\n{proc.stderr[-2000:]}")
+
+    entries = []
+    for line in proc.stderr.splitlines():
+        # "import time:   self [us] | cumulative | imported package"
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3:
+            continue
+        entries.append((int(parts[1].strip()), parts[2].strip()))
+    return entries
+
+
+def check(module="app", top=0):
+    entries = measure(module)
+    names = {name.strip() for _, name in entries}
+    total_ms = next((us for us, name in reversed(entries) if name.strip() == module), 0) / 1000.0
+
+    problems = []
+    leaked = sorted(m for m in LAZY_ONLY_MODULES if m in names)
+    if leaked:
+        problems.append(f"heavy modules imported eagerly: {', '.join(leaked)}")
+    if total_ms > IMPORT_TIME_BUDGET_MS:
+        problems.append(f"import {module} took {total_ms:.0f} ms (budget {IMPORT_TIME_BUDGET_MS:.0f} ms)")
+
+    print(f"import {module}: {total_ms:.0f} ms (budget {IMPORT_TIME_BUDGET_MS:.0f} ms)")
+    if top:
+        for us, name in sorted(entries, reverse=True)[:top]:
+            print(f"  {us / 1000.0:8.1f} ms  {name.strip()}")
+    for problem in problems:
+        print(f"FAIL: {problem}")
+    return not problems
+
+
+if __name__ == "__main__":
+    top = int(sys.argv[sys.argv.index("--top") + 1]) if "--top" in sys.argv else 0
+    sys.exit(0 if check(top=top) else 1)
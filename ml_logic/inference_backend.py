@@ -0,0 +1,611 @@
+# ml_logic/inference_backend.py
+"""
+Inference backends for the three models the pipeline runs: face detection,
+face embedding (Facenet, plus the stronger ArcFace / Facenet512 used for
+borderline matches) and anti-spoofing (Fasnet).
+
+  deepface — the original path: DeepFace's TensorFlow/Keras models plus its
+             PyTorch Fasnet.
+  onnx     — exported ONNX versions of the same models run with onnxruntime
+             on CPU. Neither TensorFlow nor PyTorch is imported.
+
+Select with INFERENCE_BACKEND. All callers go through get_backend(), so the
+rest of ml_logic does not care which one is active.
+
+INFERENCE_PRECISION (fp32 | fp16 | int8) picks which variant of the Facenet
+and detector models the onnx backend loads. The reduced-precision files are
+produced by `python -m ml_logic.quantize_models`. The deepface backend only
+runs fp32.
+
+Nothing heavy is imported at module level: cv2, onnxruntime, DeepFace
+(TensorFlow) and PyTorch are loaded by the first call that needs them.
+
+Tools:
+  python -m ml_logic.inference_backend export            # write ONNX files from the DeepFace weights
+  python -m ml_logic.inference_backend parity <img> ...  # compare detection, anti-spoofing and embeddings across backends
+"""
+import os
+import threading
+
+import numpy as np
+
+# --- Configuration ---
+INFERENCE_BACKEND     = os.getenv("INFERENCE_BACKEND", "deepface").lower()  # 'deepface' | 'onnx'
+ONNX_MODEL_DIR        = os.getenv(
+    "ONNX_MODEL_DIR", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "models", "onnx")
+)
+# 0 lets onnxruntime pick (one thread per physical core). Set explicitly when
+# running several gunicorn workers per pod so they don't oversubscribe the CPU.
+ONNX_INTRA_OP_THREADS = int(os.getenv("ONNX_INTRA_OP_THREADS", "0"))
+ONNX_INTER_OP_THREADS = int(os.getenv("ONNX_INTER_OP_THREADS", "1"))
+INFERENCE_PRECISION   = os.getenv("INFERENCE_PRECISION", "fp32").lower()  # 'fp32' | 'fp16' | 'int8'
+PRECISIONS            = ("fp32", "fp16", "int8")
+
+ONNX_MODEL_FILES = {
+    "Facenet":        "facenet.onnx",
+    "Facenet512":     "facenet512.onnx",
+    "ArcFace":        "arcface.onnx",
+    "retinaface":     "retinaface.onnx",
+    "yunet":          "face_detection_yunet_2023mar.onnx",
+    "fasnet_v2":      "minifasnet_v2.onnx",      # crop scale 2.7
+    "fasnet_v1se":    "minifasnet_v1se.onnx",    # crop scale 4.0
+}
+# Models covered by INFERENCE_PRECISION; anything else always loads the fp32 file.
+QUANTISABLE_MODELS = ("Facenet", "retinaface", "yunet")
+# The OpenCV model zoo ships its own int8 YuNet; there is no fp16 build.
+YUNET_PRECISION_FILES = {"int8": "face_detection_yunet_2023mar_int8.onnx"}
+
+FACENET_INPUT_SIZE = (160, 160)
+# Input size of every embedding model the onnx backend can run
+EMBEDDING_INPUT_SIZES = {
+    "Facenet":    FACENET_INPUT_SIZE,
+    "Facenet512": (160, 160),
+    "ArcFace":    (112, 112),
+}
+FASNET_INPUT_SIZE  = (80, 80)
+
+RETINAFACE_CONFIDENCE = 0.9
+RETINAFACE_NMS        = 0.4
+
+
+def model_filename(key, precision="fp32"):
+    """File name for a model at a given precision, e.g. facenet.int8.onnx."""
+    base = ONNX_MODEL_FILES[key]
+    if precision == "fp32" or key not in QUANTISABLE_MODELS:
+        return base
+    if key == "yunet":
+        return YUNET_PRECISION_FILES.get(precision, base)
+    stem, ext = os.path.splitext(base)
+    return f"{stem}.{precision}{ext}"
+
+
+def _resize_with_padding(img, target_size):
+    """Same letterboxing as deepface.modules.preprocessing.resize_image, returns float32 in [0, 1]."""
+    import cv2
+    factor = min(target_size[0] / img.shape[0], target_size[1] / img.shape[1])
+    dsize = (int(img.shape[1] * factor), int(img.shape[0] * factor))
+    img = cv2.resize(img, dsize)
+    diff_0 = target_size[0] - img.shape[0]
+    diff_1 = target_size[1] - img.shape[1]
+    img = np.pad(
+        img,
+        ((diff_0 // 2, diff_0 - diff_0 // 2), (diff_1 // 2, diff_1 - diff_1 // 2), (0, 0)),
+        "constant",
+    )
+    if img.shape[0:2] != target_size:
+        img = cv2.resize(img, (target_size[1], target_size[0]))
+    img = img.astype(np.float32)
+    if img.max() > 1:
+        img /= 255.0
+    return img
+
+
+def _fasnet_crop(img, facial_area, scale, out_size):
+    """Square crop around the face as used by Silent-Face / DeepFace Fasnet."""
+    import cv2
+    src_h, src_w = img.shape[:2]
+    x, y, box_w, box_h = facial_area
+    scale = min((src_h - 1) / box_h, min((src_w - 1) / box_w, scale))
+    new_w, new_h = box_w * scale, box_h * scale
+    cx, cy = box_w / 2 + x, box_h / 2 + y
+    x1, y1 = cx - new_w / 2, cy - new_h / 2
+    x2, y2 = cx + new_w / 2, cy + new_h / 2
+    if x1 < 0:
+        x2 -= x1
+        x1 = 0
+    if y1 < 0:
+        y2 -= y1
+        y1 = 0
+    if x2 > src_w - 1:
+        x1 -= x2 - src_w + 1
+        x2 = src_w - 1
+    if y2 > src_h - 1:
+        y1 -= y2 - src_h + 1
+        y2 = src_h - 1
+    crop = img[int(y1):int(y2) + 1, int(x1):int(x2) + 1]
+    return cv2.resize(crop, out_size)
+
+
+def retinaface_input(img):
+    """BGR image → NCHW float32 blob, mean-subtracted as in Pytorch_Retinaface."""
+    return (img.astype(np.float32) - np.array([104, 117, 123], dtype=np.float32)).transpose(2, 0, 1)[None]
+
+
+def facenet_input(face_bgr):
+    """Cropped BGR face → NHWC float32 RGB blob in [0, 1]."""
+    return embedding_input(face_bgr, "Facenet")
+
+
+def embedding_input(face_bgr, model_name):
+    """Same as facenet_input at the model's own input size (DeepFace 'base' normalisation)."""
+    return _resize_with_padding(face_bgr[:, :, ::-1], EMBEDDING_INPUT_SIZES[model_name])[None]
+
+
+def _softmax(x):
+    e = np.exp(x - np.max(x, axis=-1, keepdims=True))
+    return e / np.sum(e, axis=-1, keepdims=True)
+
+
+# ── DeepFace (TensorFlow / PyTorch) ───────────────────────────────────────────
+class DeepFaceBackend:
+    name = "deepface"
+
+    def detect(self, detector_backend, img, enforce_detection=True):
+        """Returns DeepFace-style face dicts ('facial_area', 'confidence') for a BGR image."""
+        from deepface import DeepFace
+        return DeepFace.extract_faces(
+            img_path=img,
+            detector_backend=detector_backend,
+            enforce_detection=enforce_detection,
+            align=False,
+        )
+
+    def represent(self, face_bgr, model_name):
+        """Embedding for an already cropped and aligned BGR face."""
+        from deepface import DeepFace
+        embedding_objs = DeepFace.represent(
+            img_path=face_bgr,
+            model_name=model_name,
+            enforce_detection=False,
+            detector_backend="skip",
+        )
+        return embedding_objs[0]["embedding"] if embedding_objs else None
+
+    def represent_batch(self, faces_bgr, model_name):
+        """
+        Embeddings for several cropped BGR faces in one forward pass. Same
+        preprocessing as DeepFace.represent(detector_backend="skip"), which
+        only ever feeds the model one image at a time.
+        """
+        if not faces_bgr:
+            return []
+        from deepface.modules import modeling, preprocessing
+        model = modeling.build_model(task="facial_recognition", model_name=model_name)
+        height, width = model.input_shape[1], model.input_shape[0]
+        batch = np.concatenate([
+            preprocessing.normalize_input(
+                img=preprocessing.resize_image(img=face[:, :, ::-1], target_size=(height, width)),
+                normalization="base",
+            )
+            for face in faces_bgr
+        ])
+        return model.model(batch, training=False).numpy().tolist()
+
+    def antispoof(self, img, facial_area):
+        """(is_real, score) for the (x, y, w, h) region of a full BGR image."""
+        from deepface.modules import modeling
+        try:
+            model = modeling.build_model(task="spoofing", model_name="Fasnet")
+        except TypeError:
+            model = modeling.build_model(model_name="Fasnet")
+        is_real, score = model.analyze(img=img, facial_area=facial_area)
+        return bool(is_real), float(score)
+
+    def antispoof_batch(self, items):
+        """[(is_real, score)] for several (img, facial_area) pairs; Fasnet here scores one face per call."""
+        return [self.antispoof(img, facial_area) for img, facial_area in items]
+
+
+# ── ONNX Runtime ──────────────────────────────────────────────────────────────
+class OnnxBackend:
+    name = "onnx"
+
+    def __init__(self, model_dir=ONNX_MODEL_DIR, precision=INFERENCE_PRECISION):
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown INFERENCE_PRECISION '{precision}' (expected one of {PRECISIONS})")
+        self.model_dir = model_dir
+        self.precision = precision
+        self._sessions = {}
+        self._lock = threading.Lock()
+        # cv2.FaceDetectorYN keeps per-image state (input size), so one per thread
+        self._local = threading.local()
+
+    def _model_path(self, key):
+        return os.path.join(self.model_dir, model_filename(key, self.precision))
+
+    def _require_model(self, key):
+        path = self._model_path(key)
+        if not os.path.exists(path):
+            raise FileNotFoundError(
+                f"ONNX model for '{key}' not found at {path}. "
+                "Run `python -m ml_logic.inference_backend export` "
+                "(and `python -m ml_logic.quantize_models calibrate` for fp16/int8) first."
+            )
+        return path
+
+    def _session(self, key):
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                import onnxruntime as ort
+                path = self._require_model(key)
+                options = ort.SessionOptions()
+                options.intra_op_num_threads = ONNX_INTRA_OP_THREADS
+                options.inter_op_num_threads = ONNX_INTER_OP_THREADS
+                options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+                options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+                session = ort.InferenceSession(path, sess_options=options, providers=["CPUExecutionProvider"])
+                self._sessions[key] = session
+                print(f"[ONNX] Loaded {path}")
+            return session
+
+    # ── Detection ──
+    def detect(self, detector_backend, img, enforce_detection=True):
+        if detector_backend == "retinaface":
+            faces = self._detect_retinaface(img)
+        elif detector_backend == "yunet":
+            faces = self._detect_yunet(img)
+        else:
+            raise ValueError(f"Detector '{detector_backend}' is not available with INFERENCE_BACKEND=onnx")
+        if not faces:
+            if enforce_detection:
+                raise ValueError(
+                    "Face could not be detected. Please confirm that the picture is a face photo "
+                    "or consider to set enforce_detection param to False."
+                )
+            h, w = img.shape[:2]
+            faces = [{"facial_area": {"x": 0, "y": 0, "w": w, "h": h, "left_eye": None, "right_eye": None},
+                      "confidence": 0}]
+        return faces
+
+    def _yunet(self):
+        """This thread's YuNet detector, loaded on first use."""
+        detector = getattr(self._local, "yunet", None)
+        if detector is None:
+            import cv2
+            path = self._require_model("yunet")
+            detector = cv2.FaceDetectorYN.create(path, "", (320, 320), 0.6, 0.3, 50)
+            self._local.yunet = detector
+            print(f"[ONNX] Loaded {path} (thread {threading.current_thread().name})")
+        return detector
+
+    def _detect_yunet(self, img):
+        h, w = img.shape[:2]
+        detector = self._yunet()
+        detector.setInputSize((w, h))
+        _, faces = detector.detect(img)
+        results = []
+        for face in (faces if faces is not None else []):
+            x, y, fw, fh = (int(v) for v in face[:4])
+            results.append({
+                "facial_area": {
+                    "x": max(0, x), "y": max(0, y), "w": fw, "h": fh,
+                    # YuNet emits the subject's right eye first
+                    "right_eye": (int(face[4]), int(face[5])),
+                    "left_eye":  (int(face[6]), int(face[7])),
+                },
+                "confidence": float(face[-1]),
+            })
+        return results
+
+    def _detect_retinaface(self, img):
+        """
+        RetinaFace in the Pytorch_Retinaface export layout: BGR minus mean,
+        outputs (loc, conf, landms) over SSD-style priors.
+        """
+        import cv2
+        session = self._session("retinaface")
+        h, w = img.shape[:2]
+        blob = retinaface_input(img)
+        loc, conf, landms = session.run(None, {session.get_inputs()[0].name: blob})
+        loc, conf, landms = loc[0], conf[0], landms[0]
+
+        priors = self._retinaface_priors(h, w)
+        variance = (0.1, 0.2)
+        boxes = np.concatenate((
+            priors[:, :2] + loc[:, :2] * variance[0] * priors[:, 2:],
+            priors[:, 2:] * np.exp(loc[:, 2:] * variance[1]),
+        ), axis=1)
+        boxes[:, :2] -= boxes[:, 2:] / 2
+        boxes[:, 2:] += boxes[:, :2]
+        boxes *= np.array([w, h, w, h], dtype=np.float32)
+        points = np.concatenate(
+            [priors[:, :2] + landms[:, 2 * i:2 * i + 2] * variance[0] * priors[:, 2:] for i in range(5)], axis=1
+        ) * np.tile(np.array([w, h], dtype=np.float32), 5)
+        scores = conf[:, 1]
+
+        keep = np.where(scores >= RETINAFACE_CONFIDENCE)[0]
+        if keep.size == 0:
+            return []
+        boxes, points, scores = boxes[keep], points[keep], scores[keep]
+        xywh = [[float(b[0]), float(b[1]), float(b[2] - b[0]), float(b[3] - b[1])] for b in boxes]
+        nms = cv2.dnn.NMSBoxes(xywh, scores.tolist(), RETINAFACE_CONFIDENCE, RETINAFACE_NMS)
+        results = []
+        for i in np.array(nms).flatten():
+            x1, y1, x2, y2 = boxes[i]
+            pts = points[i]
+            results.append({
+                "facial_area": {
+                    "x": int(max(0, x1)), "y": int(max(0, y1)),
+                    "w": int(x2 - max(0, x1)), "h": int(y2 - max(0, y1)),
+                    # Landmark 0 is the eye on the image's left, i.e. the subject's right eye
+                    "right_eye": (int(pts[0]), int(pts[1])),
+                    "left_eye":  (int(pts[2]), int(pts[3])),
+                },
+                "confidence": float(scores[i]),
+            })
+        return results
+
+    @staticmethod
+    def _retinaface_priors(h, w):
+        min_sizes = ((16, 32), (64, 128), (256, 512))
+        steps = (8, 16, 32)
+        anchors = []
+        for sizes, step in zip(min_sizes, steps):
+            fh, fw = int(np.ceil(h / step)), int(np.ceil(w / step))
+            for i in range(fh):
+                for j in range(fw):
+                    for size in sizes:
+                        anchors.append(((j + 0.5) * step / w, (i + 0.5) * step / h, size / w, size / h))
+        return np.array(anchors, dtype=np.float32)
+
+    # ── Embedding ──
+    def represent(self, face_bgr, model_name):
+        if model_name not in EMBEDDING_INPUT_SIZES:
+            raise ValueError(f"Model '{model_name}' is not available with INFERENCE_BACKEND=onnx")
+        session = self._session(model_name)
+        blob = embedding_input(face_bgr, model_name)
+        embedding = session.run(None, {session.get_inputs()[0].name: blob})[0][0]
+        return embedding.astype(np.float64).tolist()
+
+    def represent_batch(self, faces_bgr, model_name):
+        """Embeddings for several cropped BGR faces in one session.run."""
+        if not faces_bgr:
+            return []
+        if model_name not in EMBEDDING_INPUT_SIZES:
+            raise ValueError(f"Model '{model_name}' is not available with INFERENCE_BACKEND=onnx")
+        session = self._session(model_name)
+        model_input = session.get_inputs()[0]
+        if model_input.shape[0] == 1:  # exported with a fixed batch size
+            return [self.represent(face, model_name) for face in faces_bgr]
+        blob = np.concatenate([embedding_input(face, model_name) for face in faces_bgr])
+        embeddings = session.run(None, {model_input.name: blob})[0]
+        return embeddings.astype(np.float64).tolist()
+
+    # ── Anti-spoofing ──
+    def antispoof(self, img, facial_area):
+        prediction = np.zeros(3, dtype=np.float64)
+        for key, scale in (("fasnet_v2", 2.7), ("fasnet_v1se", 4.0)):
+            session = self._session(key)
+            crop = _fasnet_crop(img, facial_area, scale, FASNET_INPUT_SIZE)
+            blob = crop.astype(np.float32).transpose(2, 0, 1)[None]  # BGR, 0-255, no normalisation
+            logits = session.run(None, {session.get_inputs()[0].name: blob})[0][0]
+            prediction += _softmax(logits)
+        label = int(np.argmax(prediction))
+        return label == 1, float(prediction[label] / 2)
+
+    def antispoof_batch(self, items):
+        """[(is_real, score)] for several (img, facial_area) pairs, one session.run per Fasnet model."""
+        if not items:
+            return []
+        prediction = np.zeros((len(items), 3), dtype=np.float64)
+        for key, scale in (("fasnet_v2", 2.7), ("fasnet_v1se", 4.0)):
+            session = self._session(key)
+            model_input = session.get_inputs()[0]
+            if model_input.shape[0] == 1:  # exported with a fixed batch size
+                return [self.antispoof(img, facial_area) for img, facial_area in items]
+            blob = np.stack([
+                _fasnet_crop(img, facial_area, scale, FASNET_INPUT_SIZE).astype(np.float32).transpose(2, 0, 1)
+                for img, facial_area in items
+            ])
+            prediction += _softmax(session.run(None, {model_input.name: blob})[0])
+        labels = np.argmax(prediction, axis=1)
+        return [(int(label) == 1, float(row[label] / 2)) for row, label in zip(prediction, labels)]
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """Process-wide backend instance selected by INFERENCE_BACKEND."""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            if INFERENCE_BACKEND == "onnx":
+                _backend = OnnxBackend()
+            elif INFERENCE_BACKEND == "deepface":
+                if INFERENCE_PRECISION != "fp32":
+                    print(f"Warning: INFERENCE_PRECISION={INFERENCE_PRECISION} needs INFERENCE_BACKEND=onnx; "
+                          "running DeepFace models in fp32.")
+                _backend = DeepFaceBackend()
+            else:
+                raise ValueError(f"Unknown INFERENCE_BACKEND '{INFERENCE_BACKEND}' (expected 'deepface' or 'onnx')")
+            print(f"Inference backend: {_backend.name} ({getattr(_backend, 'precision', 'fp32')})")
+        return _backend
+
+
+# ── Export / parity tools ─────────────────────────────────────────────────────
+def export_models(model_dir=ONNX_MODEL_DIR):
+    """
+    Writes the embedding models (Facenet, Facenet512, ArcFace) and both
+    Fasnet models from the DeepFace weights.
+    RetinaFace and YuNet are distributed as ONNX already (Pytorch_Retinaface
+    export and the OpenCV model zoo) and only need to be copied into model_dir.
+    """
+    import tensorflow as tf
+    import tf2onnx
+    import torch
+    from deepface import DeepFace
+    from deepface.modules import modeling
+
+    os.makedirs(model_dir, exist_ok=True)
+
+    for model_name, input_size in EMBEDDING_INPUT_SIZES.items():
+        keras_model = DeepFace.build_model(model_name).model
+        spec = (tf.TensorSpec((None, *input_size, 3), tf.float32, name="input"),)
+        tf2onnx.convert.from_keras(keras_model, input_signature=spec, opset=13,
+                                   output_path=os.path.join(model_dir, ONNX_MODEL_FILES[model_name]))
+        print(f"Exported {model_name}")
+
+    try:
+        fasnet = modeling.build_model(task="spoofing", model_name="Fasnet")
+    except TypeError:
+        fasnet = modeling.build_model(model_name="Fasnet")
+    dummy = torch.zeros(1, 3, *FASNET_INPUT_SIZE)
+    for key, module in (("fasnet_v2", fasnet.first_model), ("fasnet_v1se", fasnet.second_model)):
+        module.eval()
+        torch.onnx.export(module, dummy, os.path.join(model_dir, ONNX_MODEL_FILES[key]),
+                          input_names=["input"], output_names=["logits"],
+                          dynamic_axes={"input": {0: "batch"}, "logits": {0: "batch"}}, opset_version=13)
+        print(f"Exported {key}")
+
+    for key in ("retinaface", "yunet"):
+        if not os.path.exists(os.path.join(model_dir, ONNX_MODEL_FILES[key])):
+            print(f"NOTE: copy {ONNX_MODEL_FILES[key]} into {model_dir} to enable '{key}' detection on ONNX.")
+
+
+def _primary_face(faces):
+    """Largest real detection (the placeholder for 'no face' has confidence 0), or None."""
+    found = [f for f in faces if f.get("confidence")]
+    if not found:
+        return None
+    return max(found, key=lambda f: f["facial_area"]["w"] * f["facial_area"]["h"])
+
+
+def _landmark_error(reference, candidate):
+    """Largest eye-landmark offset between two facial areas, as a fraction of the reference box width."""
+    errors = []
+    for eye in ("left_eye", "right_eye"):
+        a, b = reference.get(eye), candidate.get(eye)
+        if a is None or b is None:
+            continue
+        errors.append(float(np.hypot(a[0] - b[0], a[1] - b[1])) / max(1, reference["w"]))
+    return max(errors) if errors else None
+
+
+def parity_report(image_paths, tolerance=0.02, min_box_iou=0.9, max_landmark_error=0.05,
+                  max_antispoof_delta=0.05):
+    """
+    Runs each image through both backends and compares:
+
+      - detection (RetinaFace and YuNet): the primary face must be found by
+        both, with box IoU >= min_box_iou and eye landmarks within
+        max_landmark_error of the box width;
+      - anti-spoofing (Fasnet) on the reference RetinaFace box: the same
+        is_real verdict and a score within max_antispoof_delta;
+      - Facenet embeddings of the same crop: distance between backends and
+        the change in pairwise distances within `tolerance`.
+
+    A detector whose ONNX file is missing is reported as skipped.
+    """
+    import cv2
+    from deepface import DeepFace
+    from ml_logic.face_detector import _iou
+
+    reference, candidate = DeepFaceBackend(), OnnxBackend(precision="fp32")
+    ref_embs, onnx_embs = [], []
+    detection = {name: {"compared": 0, "missed": 0, "min_box_iou": None, "max_landmark_error": None}
+                 for name in ("retinaface", "yunet")}
+    antispoof = {"compared": 0, "verdict_mismatches": 0, "max_score_delta": None}
+
+    def worst(current, value, pick):
+        return value if current is None else pick(current, value)
+
+    for path in image_paths:
+        img = cv2.imread(path)
+        for name, stats in detection.items():
+            if stats.get("skipped"):
+                continue
+            try:
+                cand = _primary_face(candidate.detect(name, img, enforce_detection=False))
+            except FileNotFoundError as e:
+                stats["skipped"] = str(e)
+                continue
+            ref = _primary_face(reference.detect(name, img, enforce_detection=False))
+            stats["compared"] += 1
+            if (ref is None) != (cand is None):
+                stats["missed"] += 1
+            if ref is None or cand is None:
+                continue
+            iou = _iou(ref["facial_area"], cand["facial_area"])
+            stats["min_box_iou"] = round(worst(stats["min_box_iou"], iou, min), 4)
+            error = _landmark_error(ref["facial_area"], cand["facial_area"])
+            if error is not None:
+                stats["max_landmark_error"] = round(worst(stats["max_landmark_error"], error, max), 4)
+
+        ref_face = _primary_face(reference.detect("retinaface", img, enforce_detection=False))
+        if ref_face is not None:
+            area = ref_face["facial_area"]
+            box = (area["x"], area["y"], area["w"], area["h"])
+            ref_real, ref_score = reference.antispoof(img, box)
+            cand_real, cand_score = candidate.antispoof(img, box)
+            antispoof["compared"] += 1
+            antispoof["verdict_mismatches"] += int(ref_real != cand_real)
+            antispoof["max_score_delta"] = round(
+                worst(antispoof["max_score_delta"], abs(ref_score - cand_score), max), 6)
+
+        faces = DeepFace.extract_faces(img_path=path, detector_backend="retinaface", align=True)
+        face_bgr = (faces[0]["face"][:, :, ::-1] * 255).astype(np.uint8)
+        ref_embs.append(np.asarray(reference.represent(face_bgr, "Facenet")))
+        onnx_embs.append(np.asarray(candidate.represent(face_bgr, "Facenet")))
+
+    def cos(a, b):
+        return float(1.0 - np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b)))
+
+    self_dist = [cos(a, b) for a, b in zip(ref_embs, onnx_embs)]
+    pair_diff = []
+    for i in range(len(image_paths)):
+        for j in range(i + 1, len(image_paths)):
+            pair_diff.append(abs(cos(ref_embs[i], ref_embs[j]) - cos(onnx_embs[i], onnx_embs[j])))
+
+    report = {
+        "images": len(image_paths),
+        "detection": detection,
+        "antispoof": antispoof,
+        "max_embedding_distance": round(max(self_dist), 6) if self_dist else None,
+        "max_pair_distance_delta": round(max(pair_diff), 6) if pair_diff else None,
+        "tolerance": tolerance,
+        "min_box_iou": min_box_iou,
+        "max_landmark_error": max_landmark_error,
+        "max_antispoof_delta": max_antispoof_delta,
+    }
+    detection_ok = all(
+        stats.get("skipped") or (
+            stats["missed"] == 0
+            and (stats["min_box_iou"] is None or stats["min_box_iou"] >= min_box_iou)
+            and (stats["max_landmark_error"] is None or stats["max_landmark_error"] <= max_landmark_error)
+        )
+        for stats in detection.values()
+    )
+    antispoof_ok = antispoof["verdict_mismatches"] == 0 and (
+        antispoof["max_score_delta"] is None or antispoof["max_score_delta"] <= max_antispoof_delta)
+    report["passed"] = detection_ok and antispoof_ok and all(
+        v is None or v <= tolerance
+        for v in (report["max_embedding_distance"], report["max_pair_distance_delta"]))
+    return report
+
+
+if __name__ == "__main__":
+    import json
+    import sys
+
+    if len(sys.argv) >= 2 and sys.argv[1] == "export":
+        export_models()
+    elif len(sys.argv) >= 3 and sys.argv[1] == "parity":
+        result = parity_report(sys.argv[2:])
+        print(json.dumps(result, indent=2))
+        sys.exit(0 if result["passed"] else 1)
+    else:
+        print("Usage: python -m ml_logic.inference_backend export | parity <img> <img> [...]")
+        sys.exit(1)
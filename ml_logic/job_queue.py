@@ -0,0 +1,423 @@
+# ml_logic/job_queue.py
+"""
+Local durable job queue for asynchronous verification (POST /jobs).
+
+Jobs and their stage events live in a SQLite database (WAL mode) so every
+gunicorn worker on the host shares one queue and jobs survive a restart.
+Each process runs JOB_WORKERS threads that claim jobs atomically with
+BEGIN IMMEDIATE, run the same stages as /process_and_verify_stream and append
+each event.
+
+A claimed job is leased to its run: a heartbeat thread renews the lease every
+JOB_HEARTBEAT_SECONDS while the job waits for a pipeline slot or runs, and
+only a job whose lease is JOB_STALE_SECONDS old (its worker died) is
+requeued. Every event, the final result and the upload cleanup are written
+only while the run still holds the claim, so a run that lost its lease stops
+instead of clashing with the one that took the job over. Submission is refused with QueueFull once JOB_QUEUE_MAX_PENDING
+jobs are waiting, which is what gives callers backpressure.
+
+Webhooks are off unless JOB_WEBHOOK_ALLOWED_HOSTS names the receivers. The
+host must also resolve only to public addresses (checked on submit and again
+before each delivery, redirects are not followed), and the body carries just
+job_id and status — the receiver fetches the result from GET /jobs/<id>.
+"""
+import ipaddress
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+import urllib.request
+import uuid
+from urllib.parse import urlparse
+
+# --- Configuration ---
+JOB_QUEUE_DB              = os.getenv("JOB_QUEUE_DB", os.path.join("uploads", "jobs.sqlite3"))
+JOB_WORKERS               = int(os.getenv("JOB_WORKERS", "1"))            # per process; 0 = submit-only
+JOB_QUEUE_MAX_PENDING     = int(os.getenv("JOB_QUEUE_MAX_PENDING", "200"))
+JOB_POLL_INTERVAL_SECONDS = float(os.getenv("JOB_POLL_INTERVAL_SECONDS", "0.5"))
+# A 'running' job whose lease has not been renewed for this long (its worker died) is requeued.
+JOB_STALE_SECONDS         = float(os.getenv("JOB_STALE_SECONDS", "120"))
+JOB_HEARTBEAT_SECONDS     = float(os.getenv("JOB_HEARTBEAT_SECONDS", "15"))
+JOB_RETENTION_SECONDS     = float(os.getenv("JOB_RETENTION_SECONDS", "86400"))
+JOB_WEBHOOK_TIMEOUT       = float(os.getenv("JOB_WEBHOOK_TIMEOUT", "5"))
+JOB_WEBHOOK_RETRIES       = int(os.getenv("JOB_WEBHOOK_RETRIES", "3"))
+# Comma-separated host allow-list for webhooks; empty disables webhooks.
+JOB_WEBHOOK_ALLOWED_HOSTS = {h.strip().lower() for h in os.getenv("JOB_WEBHOOK_ALLOWED_HOSTS", "").split(",") if h.strip()}
+
+
+class LeaseLost(Exception):
+    """The running job was requeued and claimed by another run."""
+
+
+class QueueFull(Exception):
+    """Raised by submit() when the pending backlog is at JOB_QUEUE_MAX_PENDING."""
+
+    def __init__(self, pending, retry_after):
+        super().__init__(f"Job queue full ({pending} pending)")
+        self.pending = pending
+        self.retry_after = retry_after
+
+
+_schema_ready = False
+_schema_lock = threading.Lock()
+_workers_started = False
+_workers_lock = threading.Lock()
+
+
+def _connect():
+    conn = sqlite3.connect(JOB_QUEUE_DB, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    _ensure_schema(conn)
+    return conn
+
+
+def _ensure_schema(conn):
+    global _schema_ready
+    if _schema_ready:
+        return
+    with _schema_lock:
+        if _schema_ready:
+            return
+        conn.executescript("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id              TEXT PRIMARY KEY,
+            status          TEXT NOT NULL,          -- queued | running | done | failed
+            created_at      REAL NOT NULL,
+            started_at      REAL,
+            finished_at     REAL,
+            id_card_path    TEXT NOT NULL,
+            live_face_path  TEXT NOT NULL,
+            webhook_url     TEXT,
+            result          TEXT,                   -- JSON of the final 'done' event
+            claim_id        TEXT,                   -- run currently holding the job
+            heartbeat_at    REAL                    -- last lease renewal of that run
+        );
+        CREATE INDEX IF NOT EXISTS idx_jobs_status_created ON jobs (status, created_at);
+        CREATE TABLE IF NOT EXISTS job_events (
+            job_id   TEXT NOT NULL,
+            seq      INTEGER NOT NULL,
+            payload  TEXT NOT NULL,
+            PRIMARY KEY (job_id, seq)
+        );
+        """)
+        columns = {r["name"] for r in conn.execute("PRAGMA table_info(jobs)")}
+        for column, column_type in (("claim_id", "TEXT"), ("heartbeat_at", "REAL")):
+            if column not in columns:
+                try:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+                except sqlite3.OperationalError:
+                    pass    # another process added it first
+        _schema_ready = True
+
+
+def _non_public_address(host, port):
+    """First address `host` resolves to that is not a public unicast address, or None."""
+    for info in socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP):
+        address = ipaddress.ip_address(info[4][0].split("%", 1)[0])
+        if getattr(address, "ipv4_mapped", None):
+            address = address.ipv4_mapped
+        if (address.is_private or address.is_loopback or address.is_link_local or address.is_reserved
+                or address.is_multicast or address.is_unspecified or not address.is_global):
+            return str(address)
+    return None
+
+
+def validate_webhook_url(url):
+    """Returns an error string for an unacceptable webhook URL, None if it is fine."""
+    if not JOB_WEBHOOK_ALLOWED_HOSTS:
+        return "webhooks are not enabled on this server."
+    parsed = urlparse(url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        return "webhook_url must be an absolute http(s) URL."
+    if parsed.hostname.lower() not in JOB_WEBHOOK_ALLOWED_HOSTS:
+        return f"webhook host '{parsed.hostname}' is not allowed."
+    try:
+        port = parsed.port or (443 if parsed.scheme == "https" else 80)
+    except ValueError:
+        return "webhook_url has an invalid port."
+    try:
+        blocked = _non_public_address(parsed.hostname, port)
+    except OSError:
+        return f"webhook host '{parsed.hostname}' does not resolve."
+    if blocked:
+        return f"webhook host '{parsed.hostname}' does not resolve to a public address ({blocked})."
+    return None
+
+
+def pending_count(conn=None):
+    own = conn is None
+    conn = conn or _connect()
+    try:
+        return conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+    finally:
+        if own: conn.close()
+
+
+def _estimated_wait_seconds(conn, pending):
+    """Rough Retry-After from recent job durations and the configured worker count."""
+    row = conn.execute("""
+        SELECT AVG(finished_at - started_at) FROM (
+            SELECT finished_at, started_at FROM jobs
+            WHERE finished_at IS NOT NULL AND started_at IS NOT NULL
+            ORDER BY finished_at DESC LIMIT 50)
+    """).fetchone()
+    avg = row[0] or 30.0
+    return max(1, int(avg * pending / max(1, JOB_WORKERS)))
+
+
+def submit(id_card_path, live_face_path, webhook_url=None):
+    """Queues a job for the given saved uploads. Returns the job id or raises QueueFull."""
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        pending = pending_count(conn)
+        if pending >= JOB_QUEUE_MAX_PENDING:
+            retry_after = _estimated_wait_seconds(conn, pending)
+            conn.execute("ROLLBACK")
+            raise QueueFull(pending, retry_after)
+        job_id = uuid.uuid4().hex
+        conn.execute(
+            "INSERT INTO jobs (id, status, created_at, id_card_path, live_face_path, webhook_url) "
+            "VALUES (?, 'queued', ?, ?, ?, ?)",
+            (job_id, time.time(), id_card_path, live_face_path, webhook_url),
+        )
+        conn.execute("COMMIT")
+        print(f"[Jobs] Queued job {job_id} ({pending + 1} pending)")
+        return job_id
+    finally:
+        conn.close()
+
+
+def get_job(job_id, after_seq=0):
+    """Job status plus every event with seq > after_seq, or None for an unknown id."""
+    conn = _connect()
+    try:
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        events = [
+            {"id": r["seq"], **json.loads(r["payload"])}
+            for r in conn.execute(
+                "SELECT seq, payload FROM job_events WHERE job_id = ? AND seq > ? ORDER BY seq",
+                (job_id, after_seq),
+            )
+        ]
+        job = {
+            "job_id": row["id"],
+            "status": row["status"],
+            "created_at": row["created_at"],
+            "started_at": row["started_at"],
+            "finished_at": row["finished_at"],
+            "events": events,
+        }
+        if row["status"] == "queued":
+            job["queue_position"] = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND created_at <= ?", (row["created_at"],)
+            ).fetchone()[0]
+        if row["result"]:
+            job["result"] = json.loads(row["result"])
+        return job
+    finally:
+        conn.close()
+
+
+def _claim_next(conn):
+    """Claims the oldest queued job. Returns (row, claim_id), or (None, None) when there is none."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # Requeue jobs whose worker vanished mid-run (lease not renewed).
+        conn.execute(
+            "UPDATE jobs SET status = 'queued', started_at = NULL, claim_id = NULL, heartbeat_at = NULL "
+            "WHERE status = 'running' AND COALESCE(heartbeat_at, started_at) < ?",
+            (time.time() - JOB_STALE_SECONDS,),
+        )
+        row = conn.execute(
+            "SELECT * FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1"
+        ).fetchone()
+        claim_id = None
+        if row is not None:
+            claim_id = uuid.uuid4().hex
+            now = time.time()
+            conn.execute("UPDATE jobs SET status = 'running', started_at = ?, claim_id = ?, heartbeat_at = ? "
+                         "WHERE id = ?", (now, claim_id, now, row["id"]))
+            conn.execute("DELETE FROM job_events WHERE job_id = ?", (row["id"],))
+        conn.execute("COMMIT")
+        return row, claim_id
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def _renew_lease(conn, job_id, claim_id):
+    """Extends the run's lease; False when the job is no longer claimed by it."""
+    cur = conn.execute(
+        "UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND claim_id = ? AND status = 'running'",
+        (time.time(), job_id, claim_id),
+    )
+    return cur.rowcount == 1
+
+
+def _heartbeat(job_id, claim_id, stop):
+    """Renews the lease every JOB_HEARTBEAT_SECONDS until stop is set or the lease is lost."""
+    conn = _connect()
+    try:
+        while not stop.wait(JOB_HEARTBEAT_SECONDS):
+            if not _renew_lease(conn, job_id, claim_id):
+                print(f"[Jobs] Job {job_id} lost its lease")
+                return
+    except Exception as e:
+        print(f"[Jobs] Heartbeat for job {job_id} failed: {e}")
+    finally:
+        conn.close()
+
+
+def _append_event(conn, job_id, claim_id, seq, event):
+    """Appends an event (and renews the lease) if the run still holds the job; raises LeaseLost otherwise."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if not _renew_lease(conn, job_id, claim_id):
+            raise LeaseLost(job_id)
+        conn.execute(
+            "INSERT INTO job_events (job_id, seq, payload) VALUES (?, ?, ?)",
+            (job_id, seq, json.dumps(event, default=str)),
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    # A redirect could point the POST at an address validate_webhook_url never saw.
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+_webhook_opener = urllib.request.build_opener(_NoRedirect)
+
+
+def _fire_webhook(url, body):
+    data = json.dumps(body, default=str).encode("utf-8")
+    for attempt in range(1, JOB_WEBHOOK_RETRIES + 1):
+        # Re-checked per attempt: the allow-list may have changed and DNS may now point elsewhere.
+        error = validate_webhook_url(url)
+        if error:
+            print(f"[Jobs] Webhook {url} not sent: {error}")
+            return False
+        try:
+            req = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"}, method="POST")
+            with _webhook_opener.open(req, timeout=JOB_WEBHOOK_TIMEOUT) as resp:
+                if 200 <= resp.status < 300:
+                    return True
+                print(f"[Jobs] Webhook {url} answered {resp.status} (attempt {attempt})")
+        except Exception as e:
+            print(f"[Jobs] Webhook {url} failed (attempt {attempt}): {e}")
+        time.sleep(min(2 ** attempt, 10))
+    return False
+
+
+def _remove_files(*paths):
+    for path in paths:
+        if path and os.path.exists(path):
+            try:
+                os.remove(path)
+            except Exception as e_clean:
+                print(f"[Jobs] Cleanup error: {e_clean}")
+
+
+def _purge_old(conn):
+    cutoff = time.time() - JOB_RETENTION_SECONDS
+    conn.execute("DELETE FROM job_events WHERE job_id IN "
+                 "(SELECT id FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?)", (cutoff,))
+    conn.execute("DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?", (cutoff,))
+
+
+def _run_one(conn, row, claim_id, handler):
+    job_id = row["id"]
+    print(f"[Jobs] Running job {job_id}")
+    stop_heartbeat = threading.Event()
+    threading.Thread(target=_heartbeat, args=(job_id, claim_id, stop_heartbeat),
+                     name=f"job-heartbeat-{job_id[:8]}", daemon=True).start()
+    final_event = None
+    seq = 0
+    events = handler(row["id_card_path"], row["live_face_path"])
+    try:
+        for event in events:
+            seq += 1
+            _append_event(conn, job_id, claim_id, seq, event)
+            if event.get("stage") == "done":
+                final_event = event
+    except LeaseLost:
+        # Another run owns the job (and its uploads) now; leave everything to it.
+        print(f"[Jobs] Job {job_id} was taken over; abandoning this run")
+        return
+    except Exception as e:
+        traceback.print_exc()
+        final_event = {"stage": "done", "status": "failed", "overall": "failed",
+                       "detail": f"Unexpected server error: {str(e)}"}
+        seq += 1
+        try:
+            _append_event(conn, job_id, claim_id, seq, final_event)
+        except LeaseLost:
+            print(f"[Jobs] Job {job_id} was taken over; abandoning this run")
+            return
+    finally:
+        events.close()
+        stop_heartbeat.set()
+
+    if final_event is None:
+        final_event = {"stage": "done", "status": "failed", "overall": "failed",
+                       "detail": "Pipeline ended without a result."}
+    status = "done" if final_event.get("overall") == "success" else "failed"
+    finished = conn.execute(
+        "UPDATE jobs SET status = ?, finished_at = ?, result = ? WHERE id = ? AND claim_id = ?",
+        (status, time.time(), json.dumps(final_event, default=str), job_id, claim_id),
+    ).rowcount == 1
+    if not finished:
+        print(f"[Jobs] Job {job_id} was taken over; result of this run discarded")
+        return
+    _remove_files(row["id_card_path"], row["live_face_path"])
+    print(f"[Jobs] Job {job_id} finished: {status}")
+
+    if row["webhook_url"]:
+        # No result in the body: it holds the card details. The receiver reads GET /jobs/<id>.
+        _fire_webhook(row["webhook_url"], {"job_id": job_id, "status": status})
+
+
+def _worker_loop(handler):
+    conn = _connect()
+    last_purge = 0.0
+    while True:
+        try:
+            if time.time() - last_purge > 3600:
+                _purge_old(conn)
+                last_purge = time.time()
+            row, claim_id = _claim_next(conn)
+            if row is None:
+                time.sleep(JOB_POLL_INTERVAL_SECONDS)
+                continue
+            _run_one(conn, row, claim_id, handler)
+        except Exception as e:
+            print(f"[Jobs] Worker error: {e}")
+            traceback.print_exc()
+            time.sleep(JOB_POLL_INTERVAL_SECONDS)
+
+
+def start_workers(handler):
+    """
+    Starts JOB_WORKERS daemon threads in this process (once). handler is called
+    as handler(id_card_path, live_face_path) and must yield pipeline events.
+    """
+    global _workers_started
+    with _workers_lock:
+        if _workers_started or JOB_WORKERS <= 0:
+            return
+        for i in range(JOB_WORKERS):
+            threading.Thread(target=_worker_loop, args=(handler,), name=f"job-worker-{i}", daemon=True).start()
+        _workers_started = True
+        print(f"[Jobs] Started {JOB_WORKERS} job worker thread(s)")
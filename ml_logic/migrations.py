@@ -0,0 +1,253 @@
+# ml_logic/migrations.py
+"""
+Versioned schema migrations for the Postgres user tables.
+
+Run once per deploy, before the new workers start:
+
+  python -m ml_logic.migrations            apply every pending migration
+  python -m ml_logic.migrations contract   also apply contract migrations
+  python -m ml_logic.migrations status     show applied / pending versions
+
+Contract migrations (CONTRACT_VERSIONS) drop things the previous release
+still uses, so they run in a later step, once no worker of that release is
+left serving.
+
+Applied versions are recorded in schema_migrations. The runner holds a
+Postgres advisory lock, so concurrent invocations (several pods running the
+deploy hook at once) apply each migration exactly once; each migration runs
+in its own transaction. Serving workers never run DDL: db_storer only checks
+schema_version() once per process (see db_storer.ensure_schema).
+
+Migrations are append-only. Never edit one that has shipped; add a new
+version instead. Statements stay idempotent (IF NOT EXISTS ...) so databases
+created before the runner existed are adopted as-is.
+"""
+import os
+import sys
+import time
+
+from ml_logic import db_storer
+from ml_logic import deadline
+
+# Arbitrary constant identifying the migration lock (ASCII 'vote').
+MIGRATION_LOCK_ID = 0x766F7465
+# Connect and statement timeout (s) for schema_version() in serving workers;
+# a request deadline shortens it to the time left.
+SCHEMA_CHECK_TIMEOUT_SECONDS = float(os.getenv("SCHEMA_CHECK_TIMEOUT_SECONDS", "10"))
+
+# (version, description, statements)
+MIGRATIONS = (
+    (1, "Create user_id_details", (
+        """
+        CREATE TABLE IF NOT EXISTS user_id_details (
+            id SERIAL PRIMARY KEY,
+            card_type VARCHAR(50),
+            name VARCHAR(255),
+            dob VARCHAR(20),
+            aadhaar_no VARCHAR(50) UNIQUE,      -- For Aadhaar
+            pan_no VARCHAR(50) UNIQUE,          -- For PAN
+            license_no VARCHAR(50) UNIQUE,      -- For Driving License
+            voter_id_number VARCHAR(50) UNIQUE, -- For Voter ID
+            expiration_date VARCHAR(20),        -- For Driving License
+            father_mother_name VARCHAR(255),
+            face_embedding TEXT,                -- Storing as JSON string
+            registration_timestamp TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+    )),
+    # user_documents holds one row per (doc_type, doc_number) and is the single
+    # identity key for upserts; the four per-card columns on user_id_details are
+    # still written for existing readers but are no longer UNIQUE. dob_date and
+    # expiry_date are DATE copies of the OCR strings, filled by
+    # votechain_parse_date() (NULL when the text is not a valid date).
+    (2, "Normalised user_documents, DATE columns, lookup indexes", (
+        """
+        ALTER TABLE user_id_details
+            ADD COLUMN IF NOT EXISTS dob_date DATE,
+            ADD COLUMN IF NOT EXISTS expiry_date DATE;
+        """,
+        r"""
+        CREATE OR REPLACE FUNCTION votechain_parse_date(txt TEXT) RETURNS DATE
+        LANGUAGE plpgsql IMMUTABLE AS $$
+        BEGIN
+            txt := btrim(txt);
+            IF txt IS NULL OR txt = '' THEN
+                RETURN NULL;
+            ELSIF txt ~ '^\d{1,2}[-/.]\d{1,2}[-/.]\d{4}$' THEN
+                RETURN to_date(regexp_replace(txt, '[/.]', '-', 'g'), 'DD-MM-YYYY');
+            ELSIF txt ~ '^\d{4}-\d{1,2}-\d{1,2}$' THEN
+                RETURN to_date(txt, 'YYYY-MM-DD');
+            END IF;
+            RETURN NULL;
+        EXCEPTION WHEN others THEN
+            RETURN NULL;   -- e.g. 31-02-1990
+        END
+        $$;
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS user_documents (
+            id BIGSERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL REFERENCES user_id_details (id)
+                ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED,
+            doc_type VARCHAR(20) NOT NULL,      -- aadhaar | pan | license | voter_id
+            doc_number VARCHAR(50) NOT NULL,
+            created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+            CONSTRAINT user_documents_doc_key UNIQUE (doc_type, doc_number)
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_user_documents_user_id ON user_documents (user_id);",
+        # Move existing identities over. The per-column UNIQUE constraints stay
+        # until contract migration 4: workers still on the old ON CONFLICT
+        # (aadhaar_no) upsert need them during a rolling deploy.
+        """
+        INSERT INTO user_documents (user_id, doc_type, doc_number)
+        SELECT id, 'aadhaar', aadhaar_no FROM user_id_details WHERE aadhaar_no IS NOT NULL
+        UNION ALL SELECT id, 'pan', pan_no FROM user_id_details WHERE pan_no IS NOT NULL
+        UNION ALL SELECT id, 'license', license_no FROM user_id_details WHERE license_no IS NOT NULL
+        UNION ALL SELECT id, 'voter_id', voter_id_number FROM user_id_details WHERE voter_id_number IS NOT NULL
+        ON CONFLICT (doc_type, doc_number) DO NOTHING;
+        """,
+        """
+        UPDATE user_id_details
+        SET dob_date = votechain_parse_date(dob), expiry_date = votechain_parse_date(expiration_date)
+        WHERE (dob_date IS NULL AND dob IS NOT NULL)
+           OR (expiry_date IS NULL AND expiration_date IS NOT NULL);
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_user_id_details_name_dob ON user_id_details (lower(name), dob_date);",
+        "CREATE INDEX IF NOT EXISTS idx_user_id_details_registered ON user_id_details (registration_timestamp);",
+    )),
+    # Embedding of the ID face from the escalation model used for borderline
+    # matches (face_verifier.STRONG_MODEL_NAME), as JSON {"model", "embedding"}.
+    # NULL for rows stored before tiered matching or without an ID face crop.
+    (3, "Strong-model face embedding", (
+        "ALTER TABLE user_id_details ADD COLUMN IF NOT EXISTS face_embedding_strong TEXT;",
+    )),
+    # Contract step for version 2: the per-column UNIQUE constraints are no
+    # longer used by any upsert. Only safe once every worker runs code that
+    # upserts through user_documents, so it is not part of a normal migrate.
+    (4, "Drop the per-column UNIQUE constraints (contract)", (
+        """
+        ALTER TABLE user_id_details
+            DROP CONSTRAINT IF EXISTS user_id_details_aadhaar_no_key,
+            DROP CONSTRAINT IF EXISTS user_id_details_pan_no_key,
+            DROP CONSTRAINT IF EXISTS user_id_details_license_no_key,
+            DROP CONSTRAINT IF EXISTS user_id_details_voter_id_number_key;
+        """,
+    )),
+    # When each row's verification ran. Write-behind records are written later
+    # and may be retried; an upsert never replaces a row with an older one.
+    (5, "Verification time on user rows", (
+        "ALTER TABLE user_id_details ADD COLUMN IF NOT EXISTS verified_at TIMESTAMPTZ;",
+    )),
+)
+
+# Versions that remove something old code still relies on. `migrate` skips
+# them; `migrate contract` applies them after the rollout has finished.
+CONTRACT_VERSIONS = frozenset({4})
+
+# What serving workers need; contract versions never gate start-up.
+LATEST_VERSION = max(version for version, _, _ in MIGRATIONS if version not in CONTRACT_VERSIONS)
+
+_SCHEMA_MIGRATIONS_DDL = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version INTEGER PRIMARY KEY,
+    description TEXT NOT NULL,
+    applied_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+
+def _connect(timeout=None):
+    """psycopg2 connection; with a timeout (seconds), the connect and every statement are capped at it."""
+    import psycopg2
+    params = db_storer.get_db_connection_params()
+    if timeout is not None:
+        params["connect_timeout"] = max(1, int(timeout))
+        params["options"] = f"-c statement_timeout={int(timeout * 1000)}"
+    return psycopg2.connect(**params)
+
+
+def _applied_versions(cur):
+    cur.execute("SELECT to_regclass('schema_migrations')")
+    if cur.fetchone()[0] is None:
+        return set()
+    cur.execute("SELECT version FROM schema_migrations")
+    return {version for (version,) in cur.fetchall()}
+
+
+def schema_version():
+    """Highest applied migration version; 0 for a database the runner has never touched."""
+    deadline.check("storage")
+    conn = _connect(timeout=deadline.call_timeout(SCHEMA_CHECK_TIMEOUT_SECONDS))
+    try:
+        with conn.cursor() as cur:
+            return max(_applied_versions(cur), default=0)
+    finally:
+        conn.close()
+
+
+def migrate(contract=False):
+    """
+    Applies every pending migration in order, and the pending contract
+    migrations too when `contract` is set. Returns the versions applied.
+    """
+    conn = _connect()
+    applied = []
+    try:
+        with conn.cursor() as cur:
+            # Session-level lock: held across the per-migration commits below.
+            cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+            conn.commit()
+            try:
+                cur.execute(_SCHEMA_MIGRATIONS_DDL)
+                conn.commit()
+                done = _applied_versions(cur)
+                for version, description, statements in MIGRATIONS:
+                    if version in done or (version in CONTRACT_VERSIONS and not contract):
+                        continue
+                    started = time.perf_counter()
+                    try:
+                        for statement in statements:
+                            cur.execute(statement)
+                        cur.execute(
+                            "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                            (version, description),
+                        )
+                        conn.commit()
+                    except Exception:
+                        conn.rollback()
+                        print(f"[Migrations] Version {version} ({description}) failed; rolled back.")
+                        raise
+                    applied.append(version)
+                    print(f"[Migrations] Applied {version}: {description} "
+                          f"({time.perf_counter() - started:.1f}s)")
+            finally:
+                cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+                conn.commit()
+    finally:
+        conn.close()
+    return applied
+
+
+def status():
+    conn = _connect()
+    try:
+        with conn.cursor() as cur:
+            done = _applied_versions(cur)
+    finally:
+        conn.close()
+    for version, description, _ in MIGRATIONS:
+        state = "applied" if version in done else "contract" if version in CONTRACT_VERSIONS else "pending"
+        print(f"{state:8} {version:4}  {description}")
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "migrate"
+    if command in ("migrate", "contract"):
+        applied = migrate(contract=command == "contract")
+        print(f"[Migrations] Schema at version {LATEST_VERSION}; applied {applied or 'nothing'}.")
+    elif command == "status":
+        status()
+    else:
+        print("Usage: python -m ml_logic.migrations [migrate|contract|status]")
+        sys.exit(1)
@@ -0,0 +1,412 @@
+# ml_logic/pipeline.py
+"""
+The verification pipeline as a generator of stage events, shared by the SSE
+route, the job-queue workers and anything else that needs to run the stages.
+
+Event shapes:
+  Stage event:
+    { "stage": "document"|"liveness"|"face_match"|"storage",
+      "status": "running"|"passed"|"failed"|"skipped",
+      "detail": "..." }
+
+  Sub-step event (document stage only):
+    { "stage": "document",
+      "substage": "ocr"|"face",
+      "status": "running"|"passed"|"failed",
+      "detail": "..." }
+
+  Progress event (inside a running stage, after each model pass —
+  detector done, anti-spoofing done, embedding done):
+    { "stage": "document"|"liveness"|"face_match",
+      "substage": "face",              # document stage only
+      "status": "progress",
+      "detail": "..." }
+
+  With STORAGE_MODE=write_behind the storage stage passes as soon as the
+  record is queued; data.database_storage then carries "accepted": true and
+  the "write_id" to look up at /storage/<write_id>.
+
+  Done event (always the last one):
+    { "stage": "done", "status": "passed"|"failed",
+      "overall": "success"|"failed",
+      "data": { ...full BackendResponse... } }
+"""
+import functools
+import queue
+import threading
+import traceback
+
+from ml_logic import deadline
+from ml_logic import id_card_processor
+from ml_logic import face_verifier
+from ml_logic import db_storer
+from ml_logic import storage_queue
+
+
+def evt(stage, status, detail=None, substage=None, overall=None, data=None):
+    payload = {"stage": stage, "status": status}
+    if substage: payload["substage"] = substage
+    if detail:   payload["detail"]   = detail
+    if overall:  payload["overall"]  = overall
+    if data:     payload["data"]     = data
+    return payload
+
+
+_CALL_FINISHED = object()
+
+
+def _with_progress(stage, fn, *args, substage=None):
+    """
+    Calls fn(*args, progress=callback) on a helper thread and yields a
+    'progress' event for every callback as it happens, so consumers see model
+    passes complete while fn is still running. Use as
+    `result = yield from _with_progress(...)`; exceptions from fn propagate.
+
+    The helper thread sees the caller's deadline, and the progress callback
+    raises DeadlineExceeded once it has passed, so multi-pass work stops
+    between model passes. If the deadline passes while fn is still running,
+    DeadlineExceeded(stage) is raised at once with the helper thread as its
+    `unfinished`; guard_stages waits for it after reporting the failure, so
+    the caller's admission slot stays held until the model call really ends.
+    Closing the generator early waits for the helper the same way.
+    """
+    updates = queue.Queue()
+    outcome = {}
+
+    def progress(detail):
+        updates.put(evt(stage, "progress", detail, substage=substage))
+        deadline.check(stage)
+
+    def call():
+        try:
+            outcome["value"] = fn(*args, progress=progress)
+        except BaseException as e:
+            outcome["error"] = e
+        finally:
+            updates.put(_CALL_FINISHED)
+
+    helper = threading.Thread(target=deadline.bind(call), name=f"pipeline-{stage}", daemon=True)
+    helper.start()
+    try:
+        while True:
+            try:
+                update = updates.get(timeout=deadline.remaining())
+            except queue.Empty:
+                raise deadline.DeadlineExceeded(stage, deadline.current().budget, unfinished=helper) from None
+            if update is _CALL_FINISHED:
+                break
+            yield update
+    except GeneratorExit:
+        helper.join()
+        raise
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome["value"]
+
+
+def new_pipeline_state():
+    """Mutable state handed from the document stage to the selfie stages."""
+    return {
+        "response_data": {
+            "text_details": None,
+            "id_card_processing_status": "Not Processed",
+            "liveness_check":    {"passed": False, "status": "Not Performed"},
+            "face_verification": {"verified": False, "status": "Not Performed"},
+            "database_storage":  {"stored": False, "message": "Not Attempted"},
+            "overall_status": "Failed",
+        },
+        "extracted_details": {},
+        "id_embedding": None,
+        # ID face crop and its strong-model embedding, for borderline matches
+        "id_strong": {"face": None, "embedding": None},
+        "document_passed": False,
+    }
+
+
+def guard_stages(state, events):
+    """
+    Passes stage events through. A spent deadline fails the running stage; an
+    unexpected error ends the events with a failed 'done' event too.
+    """
+    try:
+        yield from events
+    except deadline.DeadlineExceeded as e:
+        print(f"[Deadline] {e}")
+        state["response_data"]["overall_status"] = "Failed: Request deadline exceeded."
+        yield evt(e.stage, "failed", str(e))
+        yield evt("done", "failed",
+                  detail=str(e),
+                  overall="failed",
+                  data=state["response_data"])
+        if e.unfinished is not None:
+            # The failure is out; hold on (and so to the caller's slot) until the model call ends.
+            e.unfinished.join()
+    except Exception as e:
+        traceback.print_exc()
+        yield evt("done", "failed",
+                  detail=f"Unexpected server error: {str(e)}",
+                  overall="failed",
+                  data=state["response_data"])
+
+
+def run_verification_pipeline(id_card_path, live_face_path, gemini_model, liveness_ref):
+    """
+    Runs document → liveness → face match → storage and yields an event dict
+    for every stage transition. Never raises; unexpected errors end with a
+    failed 'done' event. Uploaded files are left for the caller to clean up.
+    """
+    state = new_pipeline_state()
+
+    def stages():
+        if (yield from run_document_stage(id_card_path, gemini_model, state)):
+            yield from run_selfie_stages(state, live_face_path, liveness_ref)
+
+    return guard_stages(state, stages())
+
+
+def run_document_stage(id_card_path, gemini_model, state):
+    """
+    Stage 1 on its own (OCR, then ID face extraction), filling `state` from
+    new_pipeline_state(). On failure it also yields the skipped stages and the
+    failed 'done' event. Returns True when the document passed; unexpected
+    errors propagate (wrap in guard_stages).
+    """
+    response_data = state["response_data"]
+
+    # ════════════════════════════════════════════════════════════════════
+    # STAGE 1 — Document Processing  (2 visible sub-steps)
+    # ════════════════════════════════════════════════════════════════════
+    yield evt("document", "running",
+              "Starting document processing — OCR then face extraction...")
+
+    # ── Sub-step 1a: Gemini OCR ──────────────────────────────────────
+    yield evt("document", "running",
+              substage="ocr",
+              detail="Sending ID card to Gemini Vision for text extraction...")
+
+    try:
+        extracted_details = id_card_processor.extract_text_from_id(
+            id_card_path, gemini_model
+        )
+    except deadline.DeadlineExceeded:
+        raise
+    except Exception as ocr_err:
+        traceback.print_exc()
+        extracted_details = {"error": str(ocr_err)}
+
+    state["extracted_details"] = extracted_details
+    response_data["text_details"] = extracted_details
+
+    if "error" in extracted_details or "id_processing_error" in extracted_details:
+        err = extracted_details.get("error",
+              extracted_details.get("id_processing_error", "Unknown OCR error"))
+        yield evt("document", "failed",
+                  substage="ocr",
+                  detail=f"Gemini OCR failed: {err}")
+        yield evt("document", "failed",
+                  detail=f"OCR could not extract details from the ID card. {err}")
+        for s in ("liveness", "face_match", "storage"):
+            yield evt(s, "skipped", "Skipped — document OCR failed.")
+        response_data["id_card_processing_status"] = f"Failed: {err}"
+        response_data["overall_status"] = "Failed: ID card OCR error."
+        yield evt("done", "failed", overall="failed", data=response_data)
+        return False
+
+    # Build a human-readable OCR summary
+    name    = extracted_details.get("name", "")
+    card    = extracted_details.get("card_type", "ID card")
+    dob     = extracted_details.get("dob", "")
+    doc_num = (extracted_details.get("aadhaar_no")
+               or extracted_details.get("pan_no")
+               or extracted_details.get("voter_id_number")
+               or extracted_details.get("license_no", ""))
+    ocr_summary = (
+        f"{card} — Name: {name}"
+        + (f" | DOB: {dob}" if dob else "")
+        + (f" | Doc No: {doc_num}" if doc_num else "")
+        + (f" | Unverified: {', '.join(extracted_details['field_warnings'])}"
+           if extracted_details.get("field_warnings") else "")
+    )
+
+    yield evt("document", "passed",
+              substage="ocr",
+              detail=ocr_summary)
+
+    # ── Sub-step 1b: Face Extraction ─────────────────────────────────
+    yield evt("document", "running",
+              substage="face",
+              detail="Detecting face on ID card (fast detector, RetinaFace fallback) → CLAHE preprocessing → Facenet embedding...")
+
+    id_embedding, face_info = yield from _with_progress(
+        "document",
+        functools.partial(id_card_processor.extract_face_from_id,
+                          face_out=state["id_strong"], card_type=extracted_details.get("card_type")),
+        id_card_path, substage="face",
+    )
+    state["id_embedding"] = id_embedding
+    response_data["id_card_face_detection"] = face_info
+
+    if id_embedding is None:
+        yield evt("document", "failed",
+                  substage="face",
+                  detail=f"Face extraction failed: {face_info}")
+        yield evt("document", "failed",
+                  detail=f"Could not extract face from ID card. {face_info}")
+        for s in ("liveness", "face_match", "storage"):
+            yield evt(s, "skipped", "Skipped — no face found on ID card.")
+        response_data["id_card_processing_status"] = f"Failed: {face_info}"
+        response_data["overall_status"] = "Failed: No face detected on ID card."
+        yield evt("done", "failed", overall="failed", data=response_data)
+        return False
+
+    yield evt("document", "passed",
+              substage="face",
+              detail=f"{face_info}")
+
+    # Stage 1 fully passed
+    response_data["id_card_processing_status"] = \
+        "Successfully processed ID card text and face."
+    yield evt("document", "passed",
+              detail=f"{card} verified. OCR complete, face embedding ready.")
+    state["document_passed"] = True
+    return True
+
+
+def run_selfie_stages(state, live_face_path, liveness_ref):
+    """
+    Stages 2–4 (liveness, face match, storage) and the 'done' event, for a
+    state whose document stage passed. live_face_path may also be a list of
+    burst frames: liveness then scores them together and the face match uses
+    the sharpest real one. Unexpected errors propagate.
+    """
+    response_data     = state["response_data"]
+    extracted_details = state["extracted_details"]
+    id_embedding      = state["id_embedding"]
+
+    # ════════════════════════════════════════════════════════════════════
+    # STAGE 2 — Liveness Detection
+    # ════════════════════════════════════════════════════════════════════
+    yield evt("liveness", "running",
+              "Checking that the live photo is a real person (anti-spoofing)...")
+
+    verify_faces = face_verifier.verify_faces
+    if isinstance(live_face_path, (list, tuple)) and len(live_face_path) > 1:
+        liveness_passed, liveness_msg, best_frame = yield from _with_progress(
+            "liveness", face_verifier.perform_burst_liveness_check, list(live_face_path), liveness_ref
+        )
+        if best_frame:
+            live_face_path, face_bgr, detector_used = best_frame
+            verify_faces = functools.partial(verify_faces, live_face=(face_bgr, detector_used))
+    else:
+        if isinstance(live_face_path, (list, tuple)):
+            live_face_path = live_face_path[0]
+        liveness_passed, liveness_msg = yield from _with_progress(
+            "liveness", face_verifier.perform_liveness_check, live_face_path, liveness_ref
+        )
+    response_data["liveness_check"]["passed"] = liveness_passed
+    response_data["liveness_check"]["status"]  = liveness_msg
+
+    if not liveness_passed:
+        yield evt("liveness", "failed",
+                  f"Liveness failed: {liveness_msg}. "
+                  "Ensure you're using a real photo in good lighting — "
+                  "not a screen or printout.")
+        yield evt("face_match", "skipped", "Skipped — liveness check did not pass.")
+        yield evt("storage",    "skipped", "Skipped — liveness check did not pass.")
+        response_data["overall_status"] = "Failed: Liveness check failed."
+        yield evt("done", "failed", overall="failed", data=response_data)
+        return
+
+    yield evt("liveness", "passed", f"Real person confirmed. {liveness_msg}")
+
+    # ════════════════════════════════════════════════════════════════════
+    # STAGE 3 — Face Matching
+    # ════════════════════════════════════════════════════════════════════
+    yield evt("face_match", "running",
+              "Comparing live face to ID card embedding using cosine similarity...")
+
+    verification_passed, vd = yield from _with_progress(
+        "face_match", functools.partial(verify_faces, id_strong=state["id_strong"]),
+        live_face_path, id_embedding
+    )
+    response_data["face_verification"] = vd
+    response_data["face_verification"]["status"] = vd.get("message", "Unknown")
+
+    distance  = vd.get("distance",  "N/A")
+    threshold = vd.get("threshold", "N/A")
+    model     = vd.get("model",     "Facenet")
+    tier      = vd.get("tier",      "fast")
+
+    if not verification_passed:
+        yield evt("face_match", "failed",
+                  f"Face did not match. Distance: {distance} "
+                  f"(threshold: {threshold}, model: {model}, {tier} tier). "
+                  "The live photo does not match the face on the ID card.")
+        yield evt("storage", "skipped", "Skipped — face verification failed.")
+        response_data["overall_status"] = "Failed: Face verification failed."
+        yield evt("done", "failed", overall="failed", data=response_data)
+        return
+
+    yield evt("face_match", "passed",
+              f"Face matched. Distance: {distance} "
+              f"(threshold: {threshold}, model: {model}, {tier} tier)")
+
+    # ════════════════════════════════════════════════════════════════════
+    # STAGE 4 — Database Storage
+    # ════════════════════════════════════════════════════════════════════
+    # Stored next to the Facenet embedding so /reverify can escalate too;
+    # computed here only if the match did not already need it, and only if
+    # the deadline leaves room for an optional model pass.
+    if deadline.allows_optional():
+        strong_embedding = face_verifier.ensure_strong_embedding(state["id_strong"])
+    else:
+        strong_embedding = state["id_strong"]["embedding"]
+
+    if storage_queue.write_behind_enabled():
+        write_id = None
+        try:
+            write_id = storage_queue.enqueue(extracted_details, id_embedding, strong_embedding)
+        except Exception:
+            # The local queue is unusable; store inline rather than lose the record.
+            traceback.print_exc()
+        if write_id:
+            message = ("Accepted for storage; the database write completes in the background. "
+                       f"Check /storage/{write_id} for its status.")
+            response_data["database_storage"] = {
+                "stored": False, "accepted": True, "write_id": write_id, "message": message,
+            }
+            yield evt("storage", "passed", message)
+            response_data["overall_status"] = \
+                "Success: Liveness and Face Verification Passed; record accepted for storage."
+            yield evt("done", "passed", overall="success", data=response_data)
+            return
+
+    yield evt("storage", "running",
+              "Storing verified identity securely in the database...")
+
+    try:
+        db_success, db_message = db_storer.store_verified_user_details(
+            extracted_details, id_embedding, strong_embedding
+        )
+        response_data["database_storage"]["stored"]  = db_success
+        response_data["database_storage"]["message"] = db_message
+
+        if db_success:
+            yield evt("storage", "passed", f"Stored successfully. {db_message}")
+            response_data["overall_status"] = \
+                "Success: Liveness, Face Verification, and Database Storage Passed."
+            yield evt("done", "passed", overall="success", data=response_data)
+        else:
+            yield evt("storage", "failed", f"Storage warning: {db_message}")
+            response_data["overall_status"] = \
+                "Partial Success: Verification passed but database storage failed."
+            yield evt("done", "passed", overall="success", data=response_data)
+
+    except deadline.DeadlineExceeded:
+        raise
+    except Exception as db_err:
+        traceback.print_exc()
+        yield evt("storage", "failed", f"Database error: {str(db_err)}")
+        response_data["database_storage"]["message"] = str(db_err)
+        response_data["overall_status"] = "Partial: Verification passed, storage failed."
+        yield evt("done", "passed", overall="success", data=response_data)
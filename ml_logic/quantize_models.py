@@ -0,0 +1,179 @@
+# ml_logic/quantize_models.py
+"""
+Builds the fp16 / int8 variants of the Facenet and RetinaFace ONNX models and
+reports how much the reduced precision moves match decisions.
+
+  python -m ml_logic.quantize_models calibrate [image_dir]
+      Static int8 quantisation calibrated on the sample images, plus an fp16
+      conversion. Writes facenet.{fp16,int8}.onnx and retinaface.{fp16,int8}.onnx
+      next to the fp32 files in ONNX_MODEL_DIR.
+
+  python -m ml_logic.quantize_models report [image_dir]
+      Embeds every sample face at each precision and compares all pairwise
+      distances against fp32: mean/max shift, how many pairs flip across
+      CUSTOM_SYSTEM_THRESHOLD, and per-image latency.
+
+The image directory defaults to CALIBRATION_IMAGE_DIR. Use ID-card and
+selfie photos that look like production traffic — calibration quality is
+only as good as the sample.
+"""
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from ml_logic import inference_backend
+from ml_logic.inference_backend import OnnxBackend, ONNX_MODEL_DIR, model_filename
+
+CALIBRATION_IMAGE_DIR = os.getenv("CALIBRATION_IMAGE_DIR", "calibration_images")
+# Same cap the detection front-end uses, so calibration sees realistic input sizes.
+CALIBRATION_MAX_SIDE  = int(os.getenv("DETECTION_MAX_SIDE", "1024")) or 1024
+
+
+def _list_images(image_dir):
+    return [
+        os.path.join(image_dir, f) for f in sorted(os.listdir(image_dir))
+        if f.lower().endswith((".jpg", ".jpeg", ".png"))
+    ]
+
+
+def _load_for_detection(path):
+    import cv2
+    img = cv2.imread(path)
+    if img is None:
+        return None
+    h, w = img.shape[:2]
+    scale = min(1.0, CALIBRATION_MAX_SIDE / float(max(h, w)))
+    if scale < 1.0:
+        img = cv2.resize(img, (round(w * scale), round(h * scale)), interpolation=cv2.INTER_AREA)
+    return img
+
+
+def _sample_faces(image_paths, backend):
+    """Primary face crop (BGR uint8) per image, detected with the fp32 RetinaFace."""
+    faces = []
+    for path in image_paths:
+        img = _load_for_detection(path)
+        if img is None:
+            continue
+        try:
+            detected = backend.detect("retinaface", img, enforce_detection=True)
+        except ValueError:
+            print(f"  no face in {path}, skipped")
+            continue
+        area = max(detected, key=lambda f: f["facial_area"]["w"] * f["facial_area"]["h"])["facial_area"]
+        faces.append((path, img[area["y"]:area["y"] + area["h"], area["x"]:area["x"] + area["w"]]))
+    return faces
+
+
+class _BlobReader:
+    """onnxruntime CalibrationDataReader over precomputed input blobs."""
+
+    def __init__(self, input_name, blobs):
+        self._feeds = iter([{input_name: blob} for blob in blobs])
+
+    def get_next(self):
+        return next(self._feeds, None)
+
+
+def calibrate(image_dir=CALIBRATION_IMAGE_DIR, model_dir=ONNX_MODEL_DIR):
+    import onnx
+    import onnxruntime as ort
+    from onnxconverter_common import float16
+    from onnxruntime.quantization import CalibrationMethod, QuantFormat, QuantType, quantize_static
+
+    image_paths = _list_images(image_dir)
+    if not image_paths:
+        raise SystemExit(f"No calibration images found in '{image_dir}'")
+    fp32 = OnnxBackend(model_dir, precision="fp32")
+    faces = _sample_faces(image_paths, fp32)
+    print(f"Calibrating on {len(image_paths)} images / {len(faces)} faces")
+
+    blobs = {
+        "Facenet":    [inference_backend.facenet_input(face) for _, face in faces],
+        "retinaface": [inference_backend.retinaface_input(img) for img in
+                       (_load_for_detection(p) for p in image_paths) if img is not None],
+    }
+    for key, key_blobs in blobs.items():
+        src = os.path.join(model_dir, model_filename(key, "fp32"))
+        if not os.path.exists(src):
+            print(f"  {src} missing, skipping {key}")
+            continue
+
+        fp16_path = os.path.join(model_dir, model_filename(key, "fp16"))
+        onnx.save(float16.convert_float_to_float16(onnx.load(src), keep_io_types=True), fp16_path)
+        print(f"  wrote {fp16_path}")
+
+        if not key_blobs:
+            print(f"  no calibration data for {key}, int8 skipped")
+            continue
+        input_name = ort.InferenceSession(src, providers=["CPUExecutionProvider"]).get_inputs()[0].name
+        int8_path = os.path.join(model_dir, model_filename(key, "int8"))
+        quantize_static(
+            src, int8_path, _BlobReader(input_name, key_blobs),
+            quant_format=QuantFormat.QDQ,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+            per_channel=True,
+            calibrate_method=CalibrationMethod.MinMax,
+        )
+        print(f"  wrote {int8_path}")
+
+
+def _cosine_distance_matrix(embeddings):
+    normed = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return 1.0 - normed @ normed.T
+
+
+def accuracy_report(image_dir=CALIBRATION_IMAGE_DIR, model_dir=ONNX_MODEL_DIR):
+    from ml_logic.face_verifier import CUSTOM_SYSTEM_THRESHOLD
+
+    image_paths = _list_images(image_dir)
+    faces = _sample_faces(image_paths, OnnxBackend(model_dir, precision="fp32"))
+    if len(faces) < 2:
+        raise SystemExit("Need at least two detectable faces for a distance report")
+
+    distances, report = {}, {"faces": len(faces), "threshold": CUSTOM_SYSTEM_THRESHOLD, "precisions": {}}
+    iu = np.triu_indices(len(faces), k=1)
+    for precision in inference_backend.PRECISIONS:
+        backend = OnnxBackend(model_dir, precision=precision)
+        try:
+            backend.represent(faces[0][1], "Facenet")  # load the session outside the timed loop
+        except FileNotFoundError as e:
+            print(f"  {precision}: {e}")
+            continue
+        t0 = time.perf_counter()
+        embeddings = np.array([backend.represent(face, "Facenet") for _, face in faces])
+        per_face_ms = (time.perf_counter() - t0) * 1000 / len(faces)
+        distances[precision] = _cosine_distance_matrix(embeddings)[iu]
+        report["precisions"][precision] = {"embed_ms_per_face": round(per_face_ms, 2)}
+
+    if "fp32" not in distances:
+        raise SystemExit("fp32 Facenet model is required as the reference")
+    reference = distances["fp32"]
+    ref_accept = reference <= CUSTOM_SYSTEM_THRESHOLD
+    for precision, dist in distances.items():
+        shift = dist - reference
+        report["precisions"][precision].update({
+            "distance_mean": round(float(dist.mean()), 4),
+            "shift_mean": round(float(shift.mean()), 4),
+            "shift_abs_max": round(float(np.abs(shift).max()), 4),
+            "shift_p95": round(float(np.percentile(np.abs(shift), 95)), 4),
+            "decisions_flipped": int(np.sum((dist <= CUSTOM_SYSTEM_THRESHOLD) != ref_accept)),
+            "pairs": int(dist.size),
+        })
+    return report
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    image_dir = sys.argv[2] if len(sys.argv) > 2 else CALIBRATION_IMAGE_DIR
+    if command == "calibrate":
+        calibrate(image_dir)
+    elif command == "report":
+        print(json.dumps(accuracy_report(image_dir), indent=2))
+    else:
+        print("Usage: python -m ml_logic.quantize_models calibrate|report [image_dir]")
+        sys.exit(1)
@@ -0,0 +1,130 @@
+# ml_logic/sessions.py
+"""
+Two-phase verification sessions.
+
+POST /sessions uploads the ID card and starts the document stage (Gemini OCR,
+then ID face extraction) on a background thread straight away, while the user
+is still taking the selfie. POST /sessions/<id>/selfie then streams the
+document events (buffered or still arriving) followed by liveness, face match
+and storage, so the user only waits for the selfie stages.
+
+Sessions live in process memory like event streams: the selfie has to reach
+the worker that took the ID card. They expire SESSION_TTL_SECONDS after
+creation if no selfie arrives.
+"""
+import collections
+import os
+import threading
+import time
+import uuid
+
+from ml_logic import event_stream
+from ml_logic import pipeline
+
+# --- Configuration ---
+SESSION_TTL_SECONDS = float(os.getenv("SESSION_TTL_SECONDS", "600"))
+SESSION_MAX         = int(os.getenv("SESSION_MAX", "256"))
+
+
+class VerificationSession:
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.created_at = time.time()
+        self.state = pipeline.new_pipeline_state()
+        # Document-stage events; finished once the stage has its verdict.
+        self.document = event_stream.EventStream(session_id)
+        # Set once by attach_selfie(); later selfies get this stream back.
+        self.verification_stream_id = None
+        # Set when the selfie will never come (e.g. a broken upload); stops the document stage.
+        self.cancelled = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def document_status(self):
+        if not self.document.done:
+            return "running"
+        return "passed" if self.state["document_passed"] else "failed"
+
+    def summary(self):
+        return {
+            "session_id": self.session_id,
+            "document": self.document_status,
+            "id_card_processing_status": self.state["response_data"]["id_card_processing_status"],
+            "text_details": self.state["response_data"]["text_details"] if self.document.done else None,
+            "stream_id": self.verification_stream_id,
+            "expires_in": max(0, round(self.created_at + SESSION_TTL_SECONDS - time.time())),
+        }
+
+    def attach_selfie(self, stream_id):
+        """Claims the session for one selfie. Returns False if one was already attached."""
+        with self._lock:
+            if self.verification_stream_id is not None:
+                return False
+            self.verification_stream_id = stream_id
+            return True
+
+    def selfie_events(self, live_face_path, liveness_ref, track=None, poll_seconds=1.0):
+        """
+        Document events (replayed, then followed until the stage finishes),
+        then the selfie stages if the document passed. live_face_path may be
+        a list of burst frames (see pipeline.run_selfie_stages). `track` wraps the
+        selfie stages only (e.g. admission latency tracking), so replayed
+        document events are not timed twice.
+        """
+        seq = 0
+        while True:
+            events, done = self.document.events_after(seq, timeout=poll_seconds)
+            for seq, payload in events:
+                yield payload
+            if done and not self.document.events_after(seq)[0]:
+                break
+        if self.state["document_passed"]:
+            stages = pipeline.run_selfie_stages(self.state, live_face_path, liveness_ref)
+            yield from pipeline.guard_stages(self.state, track(stages) if track else stages)
+
+
+class SessionRegistry:
+    def __init__(self):
+        self._sessions = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _evict(self):
+        cutoff = time.time() - SESSION_TTL_SECONDS
+        for session_id in [sid for sid, s in self._sessions.items() if s.created_at < cutoff]:
+            del self._sessions[session_id]
+        while len(self._sessions) >= SESSION_MAX:
+            self._sessions.popitem(last=False)
+
+    def create(self):
+        with self._lock:
+            self._evict()
+            session = VerificationSession(uuid.uuid4().hex)
+            self._sessions[session.session_id] = session
+            return session
+
+    def get(self, session_id):
+        with self._lock:
+            self._evict()
+            return self._sessions.get(session_id)
+
+
+registry = SessionRegistry()
+
+
+def document_events(session, id_card_path, gemini_model):
+    """
+    The document stage for a session, to be drained into session.document
+    (event_stream.run_in_background) as soon as the ID card arrives. It stops
+    at the next event once session.cancelled is set.
+    """
+    stages = pipeline.guard_stages(
+        session.state, pipeline.run_document_stage(id_card_path, gemini_model, session.state)
+    )
+    try:
+        for event in stages:
+            if session.cancelled.is_set():
+                print(f"[Sessions] Document stage of {session.session_id} cancelled")
+                return
+            yield event
+    finally:
+        stages.close()
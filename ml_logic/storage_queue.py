@@ -0,0 +1,236 @@
+# ml_logic/storage_queue.py
+"""
+Write-behind storage for verified users (STORAGE_MODE=write_behind).
+
+Instead of waiting for the Postgres UPSERT, the pipeline appends the verified
+record to a local SQLite database (WAL mode, shared by every worker process on
+the host) and reports "accepted for storage" straight away. Writer threads
+claim due records in batches, hand them to db_storer.store_verified_users_batch
+and retry failures with exponential backoff up to STORAGE_MAX_ATTEMPTS.
+
+Each record carries its enqueue time as the verification time, so a retried
+record never overwrites a newer verification of the same document. A record
+that loses to a newer one (in its batch or already stored) is final:
+'superseded', not retried.
+
+get_write(write_id) gives read-your-writes: the record's state (queued /
+writing / stored / superseded / failed) and, once written, the database message.
+
+With the default STORAGE_MODE=sync the pipeline stores inline as before.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+
+from ml_logic import db_storer
+
+# --- Configuration ---
+STORAGE_MODE                   = os.getenv("STORAGE_MODE", "sync").lower()  # 'sync' | 'write_behind'
+STORAGE_QUEUE_DB               = os.getenv("STORAGE_QUEUE_DB", os.path.join("uploads", "storage_queue.sqlite3"))
+STORAGE_WRITERS                = int(os.getenv("STORAGE_WRITERS", "1"))      # per process; 0 = enqueue-only
+STORAGE_BATCH_SIZE             = int(os.getenv("STORAGE_BATCH_SIZE", "200"))
+STORAGE_FLUSH_INTERVAL_SECONDS = float(os.getenv("STORAGE_FLUSH_INTERVAL_SECONDS", "0.5"))
+STORAGE_MAX_ATTEMPTS           = int(os.getenv("STORAGE_MAX_ATTEMPTS", "10"))
+STORAGE_MAX_BACKOFF_SECONDS    = float(os.getenv("STORAGE_MAX_BACKOFF_SECONDS", "300"))
+# A 'writing' claim whose writer died is released after this long.
+STORAGE_STALE_SECONDS          = float(os.getenv("STORAGE_STALE_SECONDS", "120"))
+STORAGE_RETENTION_SECONDS      = float(os.getenv("STORAGE_RETENTION_SECONDS", "86400"))
+
+
+def write_behind_enabled():
+    return STORAGE_MODE == "write_behind"
+
+
+_schema_ready = False
+_schema_lock = threading.Lock()
+_writers_started = False
+_writers_lock = threading.Lock()
+
+
+def _connect():
+    conn = sqlite3.connect(STORAGE_QUEUE_DB, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    # FULL: an accepted record must survive a power loss, not just a process crash.
+    conn.execute("PRAGMA synchronous=FULL")
+    _ensure_schema(conn)
+    return conn
+
+
+def _ensure_schema(conn):
+    global _schema_ready
+    if _schema_ready:
+        return
+    with _schema_lock:
+        if _schema_ready:
+            return
+        conn.executescript("""
+        CREATE TABLE IF NOT EXISTS pending_writes (
+            id               TEXT PRIMARY KEY,
+            status           TEXT NOT NULL,          -- queued | writing | stored | superseded | failed
+            created_at       REAL NOT NULL,
+            next_attempt_at  REAL NOT NULL,
+            claimed_at       REAL,
+            finished_at      REAL,
+            attempts         INTEGER NOT NULL DEFAULT 0,
+            details          TEXT NOT NULL,          -- JSON of the OCR details
+            embedding        TEXT NOT NULL,          -- JSON list
+            message          TEXT,
+            strong_embedding TEXT                    -- JSON {"model", "embedding"} or NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_pending_writes_due ON pending_writes (status, next_attempt_at);
+        """)
+        # Queue files created before strong_embedding existed
+        columns = {r["name"] for r in conn.execute("PRAGMA table_info(pending_writes)")}
+        if "strong_embedding" not in columns:
+            try:
+                conn.execute("ALTER TABLE pending_writes ADD COLUMN strong_embedding TEXT")
+            except sqlite3.OperationalError:
+                pass    # another process added it first
+        _schema_ready = True
+
+
+def enqueue(extracted_details, id_face_embedding_list, strong_embedding=None):
+    """Durably queues a verified record and returns its write id."""
+    write_id = uuid.uuid4().hex
+    now = time.time()
+    conn = _connect()
+    try:
+        conn.execute(
+            "INSERT INTO pending_writes (id, status, created_at, next_attempt_at, details, embedding, strong_embedding) "
+            "VALUES (?, 'queued', ?, ?, ?, ?, ?)",
+            (write_id, now, now, json.dumps(extracted_details, default=str), json.dumps(id_face_embedding_list),
+             json.dumps(strong_embedding) if strong_embedding else None),
+        )
+    finally:
+        conn.close()
+    return write_id
+
+
+def get_write(write_id):
+    """State of a queued write, or None for an unknown id."""
+    conn = _connect()
+    try:
+        row = conn.execute(
+            "SELECT id, status, created_at, finished_at, attempts, message FROM pending_writes WHERE id = ?",
+            (write_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            "write_id": row["id"],
+            "status": row["status"],
+            "stored": row["status"] == "stored",
+            "attempts": row["attempts"],
+            "created_at": row["created_at"],
+            "finished_at": row["finished_at"],
+            "message": row["message"],
+        }
+    finally:
+        conn.close()
+
+
+def backlog():
+    """Counts per status, for monitoring."""
+    conn = _connect()
+    try:
+        return {r["status"]: r["n"] for r in conn.execute(
+            "SELECT status, COUNT(*) AS n FROM pending_writes GROUP BY status")}
+    finally:
+        conn.close()
+
+
+def _claim_batch(conn):
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute(
+            "UPDATE pending_writes SET status = 'queued', claimed_at = NULL "
+            "WHERE status = 'writing' AND claimed_at < ?",
+            (now - STORAGE_STALE_SECONDS,),
+        )
+        rows = conn.execute(
+            "SELECT * FROM pending_writes WHERE status = 'queued' AND next_attempt_at <= ? "
+            "ORDER BY created_at LIMIT ?",
+            (now, STORAGE_BATCH_SIZE),
+        ).fetchall()
+        conn.executemany(
+            "UPDATE pending_writes SET status = 'writing', claimed_at = ?, attempts = attempts + 1 WHERE id = ?",
+            [(now, r["id"]) for r in rows],
+        )
+        conn.execute("COMMIT")
+        return rows
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def _write_batch(conn, rows):
+    outcomes = db_storer.store_verified_users_batch(
+        [(json.loads(r["details"]), json.loads(r["embedding"]),
+          json.loads(r["strong_embedding"]) if r["strong_embedding"] else None,
+          r["created_at"]) for r in rows]
+    )
+    now = time.time()
+    updates = []
+    for row, (success, message, superseded) in zip(rows, outcomes):
+        attempts = row["attempts"] + 1
+        if success:
+            updates.append(("stored", now, now, message, row["id"]))
+        elif superseded:
+            updates.append(("superseded", now, now, message, row["id"]))
+        elif attempts >= STORAGE_MAX_ATTEMPTS:
+            print(f"[Storage] Giving up on write {row['id']} after {attempts} attempts: {message}")
+            updates.append(("failed", now, now, message, row["id"]))
+        else:
+            retry_at = now + min(2 ** attempts, STORAGE_MAX_BACKOFF_SECONDS)
+            updates.append(("queued", retry_at, None, message, row["id"]))
+    conn.executemany(
+        "UPDATE pending_writes SET status = ?, next_attempt_at = ?, finished_at = ?, message = ?, claimed_at = NULL "
+        "WHERE id = ?",
+        updates,
+    )
+    stored = sum(1 for u in updates if u[0] == "stored")
+    print(f"[Storage] Flushed {len(rows)} queued writes: {stored} stored")
+
+
+def _purge_old(conn):
+    conn.execute(
+        "DELETE FROM pending_writes WHERE status IN ('stored', 'superseded', 'failed') AND finished_at < ?",
+        (time.time() - STORAGE_RETENTION_SECONDS,),
+    )
+
+
+def _writer_loop():
+    conn = _connect()
+    last_purge = 0.0
+    while True:
+        try:
+            if time.time() - last_purge > 3600:
+                _purge_old(conn)
+                last_purge = time.time()
+            rows = _claim_batch(conn)
+            if not rows:
+                time.sleep(STORAGE_FLUSH_INTERVAL_SECONDS)
+                continue
+            _write_batch(conn, rows)
+        except Exception as e:
+            print(f"[Storage] Writer error: {e}")
+            traceback.print_exc()
+            time.sleep(STORAGE_FLUSH_INTERVAL_SECONDS)
+
+
+def start_writers():
+    """Starts STORAGE_WRITERS daemon threads in this process (once) when write-behind is on."""
+    global _writers_started
+    with _writers_lock:
+        if _writers_started or not write_behind_enabled() or STORAGE_WRITERS <= 0:
+            return
+        for i in range(STORAGE_WRITERS):
+            threading.Thread(target=_writer_loop, name=f"storage-writer-{i}", daemon=True).start()
+        _writers_started = True
+        print(f"[Storage] Started {STORAGE_WRITERS} write-behind writer thread(s)")
@@ -0,0 +1,49 @@
+# ml_logic/ttl_cache.py
+"""
+Small thread-safe LRU cache with per-entry expiry, for hot rows read far more
+often than they change (e.g. stored embeddings during election-day
+re-verification). Entries live in process memory; each gunicorn worker has
+its own copy, so writers invalidate locally and rely on the TTL elsewhere.
+"""
+import collections
+import threading
+import time
+
+
+class TTLCache:
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max(1, max_entries)
+        self.ttl_seconds = ttl_seconds
+        self._entries = collections.OrderedDict()   # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """The cached value, or None when absent or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            return entry[1] if entry else None
+
+    def snapshot(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
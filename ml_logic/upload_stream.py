@@ -0,0 +1,166 @@
+# ml_logic/upload_stream.py
+"""
+Streaming multipart/form-data ingestion.
+
+Flask normally parses (and buffers) the whole request body before the view
+runs. iter_upload() instead reads request.stream chunk by chunk through
+Werkzeug's sans-IO MultipartDecoder and yields each part the moment its
+closing boundary arrives, so the caller can start work on the ID card while
+the selfie is still uploading.
+
+Every file part is written straight to disk, SHA-256 hashed, size-checked
+against UPLOAD_MAX_PART_BYTES and validated by its magic bytes (PNG / JPEG)
+as it arrives; a bad part aborts the upload with UploadError before the rest
+of the body is read.
+"""
+import hashlib
+import os
+import uuid
+
+# --- Configuration ---
+UPLOAD_MAX_PART_BYTES  = int(os.getenv("UPLOAD_MAX_PART_BYTES", str(16 * 1024 * 1024)))
+UPLOAD_MAX_FIELD_BYTES = int(os.getenv("UPLOAD_MAX_FIELD_BYTES", str(64 * 1024)))
+UPLOAD_MAX_PARTS       = int(os.getenv("UPLOAD_MAX_PARTS", "8"))
+UPLOAD_CHUNK_BYTES     = int(os.getenv("UPLOAD_CHUNK_BYTES", str(64 * 1024)))
+
+# magic prefix → extension used for the saved file
+IMAGE_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpg"),
+)
+_SIGNATURE_BYTES = max(len(sig) for sig, _ in IMAGE_SIGNATURES)
+
+
+class UploadError(ValueError):
+    """The request body is not an acceptable multipart upload."""
+
+
+def sniff_image_type(head):
+    """'png' / 'jpg' from the first bytes of a file, or None."""
+    for signature, ext in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return ext
+    return None
+
+
+class UploadedFile:
+    """A completed file part on disk."""
+
+    def __init__(self, name, filename, path, size, sha256, image_type):
+        self.name = name              # form field name
+        self.filename = filename      # client-supplied name, informational only
+        self.path = path
+        self.size = size
+        self.sha256 = sha256
+        self.image_type = image_type  # 'png' | 'jpg'
+
+    def remove(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class _PartWriter:
+    """Writes one file part to dest_dir while hashing, size- and type-checking it."""
+
+    def __init__(self, event, dest_dir, max_bytes):
+        self.event = event
+        self.max_bytes = max_bytes
+        self.path = os.path.join(dest_dir, f"{uuid.uuid4().hex}.part")
+        self.file = open(self.path, "wb")
+        self.hash = hashlib.sha256()
+        self.size = 0
+        self.head = b""
+        self.image_type = None
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            raise UploadError(f"{self.event.name} is larger than {self.max_bytes} bytes.")
+        if self.image_type is None and len(self.head) < _SIGNATURE_BYTES:
+            self.head += data[:_SIGNATURE_BYTES]
+            if len(self.head) >= _SIGNATURE_BYTES:
+                self._check_type()
+        self.hash.update(data)
+        self.file.write(data)
+
+    def _check_type(self):
+        self.image_type = sniff_image_type(self.head)
+        if self.image_type is None:
+            raise UploadError(f"{self.event.name} is not a PNG or JPEG image.")
+
+    def finish(self):
+        self.file.close()
+        if self.image_type is None:
+            self._check_type()   # shorter than the longest signature
+        final_path = f"{self.path[:-len('.part')]}.{self.image_type}"
+        os.replace(self.path, final_path)
+        self.path = final_path
+        return UploadedFile(self.event.name, self.event.filename, final_path,
+                            self.size, self.hash.hexdigest(), self.image_type)
+
+    def discard(self):
+        self.file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def iter_upload(stream, content_type, dest_dir, file_fields, max_part_bytes=UPLOAD_MAX_PART_BYTES):
+    """
+    Reads a multipart/form-data body from `stream` and yields each part as
+    soon as it is complete: an UploadedFile for fields named in `file_fields`,
+    a (name, value) tuple for plain form fields. File parts under any other
+    name are rejected.
+
+    The caller owns the yielded files. On UploadError (or any other error) the
+    part being written is removed; files already yielded are left to the caller.
+    """
+    from werkzeug.http import parse_options_header
+    from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+
+    mimetype, options = parse_options_header(content_type or "")
+    boundary = options.get("boundary", "").encode("latin-1")
+    if mimetype != "multipart/form-data" or not boundary:
+        raise UploadError("Expected a multipart/form-data body.")
+
+    decoder = MultipartDecoder(boundary, UPLOAD_MAX_FIELD_BYTES, max_parts=UPLOAD_MAX_PARTS)
+    writer = None       # _PartWriter for the current file part
+    field = None        # (name, [chunks]) for the current plain field
+    complete = False
+    try:
+        while not complete:
+            chunk = stream.read(UPLOAD_CHUNK_BYTES)
+            decoder.receive_data(chunk or None)
+            event = decoder.next_event()
+            while not isinstance(event, NeedData):
+                if isinstance(event, File):
+                    if event.name not in file_fields:
+                        raise UploadError(f"Unexpected file field '{event.name}'.")
+                    writer = _PartWriter(event, dest_dir, max_part_bytes)
+                elif isinstance(event, Field):
+                    field = (event.name, [])
+                elif isinstance(event, Data):
+                    if writer is not None:
+                        writer.write(event.data)
+                        if not event.more_data:
+                            part, writer = writer.finish(), None
+                            yield part
+                    elif field is not None:
+                        field[1].append(event.data)
+                        if not event.more_data:
+                            name, chunks = field
+                            field = None
+                            yield name, b"".join(chunks).decode("utf-8", "replace")
+                elif isinstance(event, Epilogue):
+                    complete = True
+                    break
+                event = decoder.next_event()
+            if not chunk and not complete:
+                raise UploadError("Upload ended before the multipart body was complete.")
+    except UploadError:
+        raise
+    except Exception as e:
+        # RequestEntityTooLarge / ValueError from the decoder, client disconnects
+        raise UploadError(f"Malformed upload: {e}") from e
+    finally:
+        if writer is not None:
+            writer.discard()